@@ -1,24 +1,249 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Request, request, jsonify, send_file, g
 from flask_cors import CORS
-from audio import hide_file_in_audio_util, extract_file_from_audio_util
-from image import hide_file_in_img_util, extract_file_from_img_util
-import numpy as np
+from werkzeug.exceptions import RequestEntityTooLarge
+from audio import hide_file_in_audio_util, extract_file_chunks_from_audio_util, hide_file_in_audio_stream, extract_file_chunks_from_audio_stream
+from image import (hide_file_in_img_util, hide_file_in_img_mmap, hide_file_in_img_stream, extract_file_chunks_from_img_util,
+                   extract_file_chunks_from_img_stream, save_img, ENCODING_PROFILES)
+from tiles import open_strips
+from lsb import NoFrameHeader
 import wave
 from PIL import Image
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
-import io
+from keycache import KeyCache
+from capacity import carrier_capacity, capacity_report
+from shard import hide_file_in_carriers, extract_chunks_from_carriers
+from encrypt import COMPRESSION_CHOICES, DEFAULT_COMPRESSION
+from jobs import JobManager, JobQueueFull, job_spec
+from timings import stage
+import timings
+import metrics
+import os
+import mimetypes
+import tempfile
+import zipfile
+
+
+# Uploads are spooled to temporary files in this directory (the system's
+# temporary directory when unset), and so are the responses
+SPOOL_DIR = os.environ.get('STEGANO_SPOOL_DIR') or None
+
+# Largest request body accepted, in bytes (no limit when 0)
+MAX_UPLOAD_SIZE = int(os.environ.get('STEGANO_MAX_UPLOAD_SIZE', 1 << 30))
+
+# Carriers with more pixels or samples than this are processed in strips or
+# blocks, or memory-mapped, even when the request doesn't ask for it
+STREAM_UNITS = int(os.environ.get('STEGANO_STREAM_UNITS', 1 << 24))
+
+# PEM keys are a few KB, larger key uploads are not read into memory
+MAX_KEY_SIZE = 1 << 16
+
+
+class SpoolingRequest(Request):
+    # Every uploaded file is written to a named temporary file as it is
+    # received, whatever its size, so the handlers can open, map or decode it
+    # in strips from disk. The files are removed when the request is closed
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return tempfile.NamedTemporaryFile('wb+', dir=SPOOL_DIR)
 
 
 app = Flask(__name__)
+app.request_class = SpoolingRequest
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE or None
 CORS(app)  # Enable CORS for all routes
 
+# Parsed keys are reused across requests, clients send the same keys over and over
+key_cache = KeyCache()
+
+# Large hide and extract requests can be run in the background as jobs
+job_manager = JobManager()
+
+# Requests to these endpoints are timed stage by stage, the timings are sent
+# back in a Server-Timing header and aggregated on /metrics
+TIMED_ENDPOINTS = {'audiohide', 'imagehide', 'audioextract', 'imageextract'}
+TIMINGS_ENABLED = os.environ.get('STEGANO_TIMINGS', '1') != '0'
+
+# Encoding profile of the returned images when a request does not pick one,
+# fast saves CPU and smallest saves bandwidth
+ENCODING_PROFILE = os.environ.get('STEGANO_ENCODING_PROFILE', 'balanced')
+
+# Action, carrier type and carrier upload field of every job type
+JOB_TYPES = {
+    'audiohide': ('hide', 'audio', 'audio'),
+    'imagehide': ('hide', 'image', 'image'),
+    'audioextract': ('extract', 'audio', 'audio'),
+    'imageextract': ('extract', 'image', 'image'),
+}
+
+
+def send_extracted(filedata, filename):
+    # JSON mode is only meant for small text secrets
+    if request.form.get('format', 'file').lower() == 'json':
+        return jsonify({
+            "data": b''.join(filedata).decode("utf-8"),
+            "filename": filename,
+            "done": True
+        }), 200
+
+    # Otherwise spool the raw bytes to a temporary file a chunk at a time and
+    # send it as an attachment, with its size since send_file can't tell it
+    output = tempfile.TemporaryFile(dir=SPOOL_DIR)
+    for chunk in filedata:
+        output.write(chunk)
+    size = output.tell()
+    output.seek(0)
+
+    response = send_file(
+        output,
+        as_attachment=True,
+        download_name=filename,
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+    )
+    response.content_length = size
+    return response, 200
+
+
+def upload_path(upload):
+    # Path of the temporary file an upload was spooled to
+    return upload.stream.name
+
+
+def read_key(key_file):
+    pem = key_file.read(MAX_KEY_SIZE + 1)
+    if len(pem) > MAX_KEY_SIZE:
+        raise ValueError("Key file is too large.")
+    return pem
+
+
+def public_keys():
+    # Parsed public key of the request, or the list of them when the pubKey
+    # field is repeated, one per recipient
+    keys = [key_cache.public_key(read_key(key_file)) for key_file in request.files.getlist('pubKey')]
+    return keys[0] if len(keys) == 1 else keys
+
+
+def spool_path():
+    # A fresh temporary file for a handler to write its output to
+    fd, path = tempfile.mkstemp(dir=SPOOL_DIR)
+    os.close(fd)
+    return path
+
+
+def send_spooled(path, download_name, mimetype):
+    # Stream a spooled output as an attachment and remove it once it has been
+    # sent. The response iterates the file itself rather than handing it to the
+    # server, which would skip the close callbacks
+    response = send_file(open(path, 'rb'), as_attachment=True, download_name=download_name, mimetype=mimetype)
+    response.direct_passthrough = False
+    response.content_length = os.path.getsize(path)
+    response.call_on_close(lambda: os.remove(path))
+    return response
+
+
+def stream_requested(units):
+    # Whether a carrier of this many pixels or samples is processed in strips or blocks
+    return request.form.get('stream', '').lower() in ('1', 'true', 'yes') or units > STREAM_UNITS
+
+
+def strips_source(image_path):
+    # The image opened to be processed in strips, or None for the formats and
+    # modes that can't be. Only the header is read
+    try:
+        return open_strips(image_path)
+    except ValueError:
+        return None
+
+
+def hide_in_image(image_path, image_name, output_path, file_data, file_name, public_key, channels, depth, profile, compression):
+    # Hide the secret in a spooled image upload and write the output image to
+    # output_path. Large carriers (or any, when asked) are processed in strips
+    # or, when uncompressed, memory-mapped, so memory stays flat. Returns the
+    # output format
+    source = strips_source(image_path)
+    if source is not None and stream_requested(source.size[0] * source.size[1]):
+        hide_file_in_img_stream(image_path, output_path, file_data, file_name, public_key, channels, depth, profile, compression)
+        return source.format
+
+    with Image.open(image_path) as image:
+        if stream_requested(image.size[0] * image.size[1]) and hide_file_in_img_mmap(
+                image, image_path, output_path, file_data, file_name, public_key, channels, depth, compression=compression):
+            return image.format
+        output, host_format = hide_file_in_img_util(image, image_name, file_data, file_name, public_key, channels, depth, compression)
+    save_img(output, output_path, host_format, profile)
+    return host_format
+
+
+@app.before_request
+def spool_uploads():
+    # Parse the form up front, which spools the uploads to disk, so a request
+    # over the size limit is turned down before any handler runs
+    if request.method == 'POST':
+        try:
+            request.files
+        except RequestEntityTooLarge:
+            return jsonify({"error": f"Request is larger than the limit of {MAX_UPLOAD_SIZE} bytes.", "done": False}), 413
+
+
+@app.before_request
+def start_timings():
+    if TIMINGS_ENABLED and request.endpoint in TIMED_ENDPOINTS:
+        g.timings, g.timings_token = timings.start()
+
+
+@app.after_request
+def send_timings(response):
+    request_timings = g.pop('timings', None)
+    if request_timings is not None:
+        response.headers['Server-Timing'] = request_timings.server_timing()
+        metrics.record_request(request.endpoint, response.status_code, request_timings,
+                               request.content_length, response.content_length)
+    return response
+
+
+@app.teardown_request
+def stop_timings(error=None):
+    token = g.pop('timings_token', None)
+    if token is not None:
+        timings.stop(token)
+
 
 @app.route('/')
 def home():
     return 'Welcome'
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+@app.route('/keycache', methods=['GET'])
+def keycache():
+    return jsonify(key_cache.stats()), 200
+
+
+@app.route('/capacity', methods=['POST'])
+def capacity_endpoint():
+    try:
+        # The carrier is either an image or an audio upload, only its header is read
+        carrier_type = 'image' if 'image' in request.files else 'audio'
+        if carrier_type not in request.files:
+            return jsonify({"error": "Missing file: image or audio", "done": False}), 400
+
+        channels = request.form.get('channels', 'R')
+        depth = int(request.form.get('bits', 1))
+        secret_size = int(request.form['secretSize']) if request.form.get('secretSize') else None
+        filename = request.form.get('filename', '').encode()
+        public_key = public_keys() if 'pubKey' in request.files else None
+        compression = request.form.get('compression', DEFAULT_COMPRESSION)
+        if compression not in COMPRESSION_CHOICES:
+            return jsonify({"error": f"Unknown compression: {compression}", "done": False}), 400
+
+        capacity = carrier_capacity(carrier_type, request.files[carrier_type].stream, channels, depth)
+        return jsonify(dict(capacity_report(capacity, filename, secret_size, public_key, compression), done=True)), 200
+
+    except Exception as err:
+        return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
+
+
 @app.route('/audiohide', methods=['POST'])
 def audiohide():
     try:
@@ -29,40 +254,40 @@ def audiohide():
 
         # Extracting values from JSON request
         secret_file = request.files['secret']
-        pub_key_file = request.files['pubKey']
         audio_file = request.files['audio']
+        depth = int(request.form.get('bits', 1))
+        compression = request.form.get('compression', DEFAULT_COMPRESSION)
+        if compression not in COMPRESSION_CHOICES:
+            return jsonify({"error": f"Unknown compression: {compression}", "done": False}), 400
 
         file_name = secret_file.filename.encode()
-        file_data = secret_file.read()
-
-        # Convert PEM data to public key object
-        public_key_pem = pub_key_file.read()
-        public_key = serialization.load_pem_public_key(
-            public_key_pem,
-            backend=default_backend()
-        )
-        # Open the audio
-        audio = wave.open(audio_file, mode='rb')
-
-        # Process the data
-        output = hide_file_in_audio_util(
-            audio, file_data, file_name, public_key)
-
-        with io.BytesIO() as wav_io:
-            with wave.open(wav_io, 'wb') as wav_file:
-                wav_file.setparams(audio.getparams())
-                wav_file.writeframes(output)
-
-            wav_bytes = wav_io.getvalue()
-
-        aud_byte = io.BytesIO(wav_bytes)
-
-        return send_file(
-            aud_byte,
-            as_attachment=True,
-            download_name="",
-            mimetype='audio/wav',
-        ), 200
+        file_data = secret_file.stream  # Read a chunk at a time while it is embedded
+
+        # Convert PEM data to public key objects, the secret is encrypted once for every recipient
+        public_key = public_keys()
+
+        # The output is written to a temporary file and sent from there
+        output_path = spool_path()
+        try:
+            with wave.open(upload_path(audio_file), mode='rb') as audio:
+                if stream_requested(audio.getnframes() * audio.getnchannels()):
+                    # Write the output block by block
+                    with wave.open(output_path, 'wb') as wav_file:
+                        hide_file_in_audio_stream(
+                            audio, wav_file, file_data, file_name, public_key, depth=depth, compression=compression)
+                else:
+                    # Process the data
+                    output = hide_file_in_audio_util(
+                        audio, file_data, file_name, public_key, depth=depth, compression=compression)
+
+                    with stage('encode'), wave.open(output_path, 'wb') as wav_file:
+                        wav_file.setparams(audio.getparams())
+                        wav_file.writeframes(output)
+        except Exception:
+            os.remove(output_path)
+            raise
+
+        return send_spooled(output_path, "", 'audio/wav'), 200
 
     except Exception as err:
         return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
@@ -81,33 +306,32 @@ def imagehide():
 
         # Extracting values from JSON request
         secret_file = request.files['secret']
-        pub_key_file = request.files['pubKey']
         image_file = request.files['image']
         output_name = request.form['output']
+        channels = request.form.get('channels', 'R')
+        depth = int(request.form.get('bits', 1))
+        profile = request.form.get('profile', ENCODING_PROFILE)
+        if profile not in ENCODING_PROFILES:
+            return jsonify({"error": f"Unknown encoding profile: {profile}", "done": False}), 400
+        compression = request.form.get('compression', DEFAULT_COMPRESSION)
+        if compression not in COMPRESSION_CHOICES:
+            return jsonify({"error": f"Unknown compression: {compression}", "done": False}), 400
 
         # processing the secret file
         file_name = secret_file.filename.encode()
-        file_data = secret_file.read()
-
-        # Convert PEM data to public key object
-        public_key_pem = pub_key_file.read()
-        public_key = serialization.load_pem_public_key(
-            public_key_pem,
-            backend=default_backend()
-        )
+        file_data = secret_file.stream  # Read a chunk at a time while it is embedded
 
-        # Open the image
-        image = Image.open(image_file)
-        image_name = image_file.filename
+        # Convert PEM data to public key objects, the secret is encrypted once for every recipient
+        public_key = public_keys()
 
-        # Process the data
-        output, host_format = hide_file_in_img_util(
-            image, image_name, file_data, file_name, public_key)
-
-        img_io = io.BytesIO()
-
-        output.save(img_io, host_format)
-        img_io.seek(0)
+        # Process the data, the output image is written to a temporary file and sent from there
+        output_path = spool_path()
+        try:
+            host_format = hide_in_image(upload_path(image_file), image_file.filename, output_path, file_data, file_name, public_key,
+                                        channels, depth, profile, compression)
+        except Exception:
+            os.remove(output_path)
+            raise
 
         if host_format == 'PNG':
             mimetype = 'image/png'
@@ -120,12 +344,7 @@ def imagehide():
         else:
             mimetype = 'image/png'
 
-        return send_file(
-            img_io,
-            as_attachment=True,
-            download_name=output_name,
-            mimetype=mimetype,
-        ), 200
+        return send_spooled(output_path, output_name, mimetype), 200
 
     except Exception as err:
         return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
@@ -150,28 +369,20 @@ def audioextract():
         output_name = request.form['output']
         passphrase = request.form['passphrase']
 
-        private_key_pem = pri_key_file.read()
-        # Convert PEM data to public key object
-        private_key = serialization.load_pem_private_key(
-            private_key_pem,
-            password=passphrase.encode(),
-            backend=default_backend()
-        )
-
-        # Open the audio
-        audio = wave.open(audio_file, mode='rb')
-
-        # Process the data
-        output, filename = extract_file_from_audio_util(audio, private_key)
+        private_key_pem = read_key(pri_key_file)
+        # Convert PEM data to private key object
+        private_key = key_cache.private_key(private_key_pem, passphrase)
 
-        text = output.decode("utf-8")
-        output_name = output_name or filename
+        # Open the audio, the file data is read from it until it has been spooled
+        with wave.open(upload_path(audio_file), mode='rb') as audio:
+            # Process the data
+            if stream_requested(audio.getnframes() * audio.getnchannels()):
+                filename, filedata = extract_file_chunks_from_audio_stream(audio, private_key)
+            else:
+                filename, filedata = extract_file_chunks_from_audio_util(audio, private_key)
 
-        return jsonify({
-            "data": text,
-            "filename": output_name,
-            "done": True
-        }), 200
+            output_name = output_name or filename
+            return send_extracted(filedata, output_name)
 
     except Exception as err:
         return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
@@ -196,31 +407,210 @@ def imageextract():
         output_name = request.form['output']
         passphrase = request.form['passphrase']
 
-        private_key_pem = pri_key_file.read()
-        # Convert PEM data to public key object
-        private_key = serialization.load_pem_private_key(
-            private_key_pem,
-            password=passphrase.encode(),
-            backend=default_backend()
-        )
+        private_key_pem = read_key(pri_key_file)
+        # Convert PEM data to private key object
+        private_key = key_cache.private_key(private_key_pem, passphrase)
+
+        # Large carriers (or any, when asked) are decoded in strips, uncompressed
+        # ones are always read through a memory map. Carriers hidden in before
+        # the frame header was added can only be decoded whole
+        image_path = upload_path(image_file)
+        source = strips_source(image_path)
+        if source is not None and stream_requested(source.size[0] * source.size[1]):
+            try:
+                filename, filedata = extract_file_chunks_from_img_stream(image_path, private_key)
+                return send_extracted(filedata, output_name or filename)
+            except NoFrameHeader:
+                pass
+
+        with Image.open(image_path) as image:
+            filename, filedata = extract_file_chunks_from_img_util(image, private_key, image_path)
+            return send_extracted(filedata, output_name or filename)
 
-        # Open the audio
-        image = Image.open(image_file)
+    except Exception as err:
+        return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
 
-        output, filename = extract_file_from_img_util(image, private_key)
-        text = output.decode("utf-8")
 
-        output_name = output_name or filename
-        return jsonify({
-            "data": text,
-            "filename": output_name,
-            "done": True
-        }), 200
+def save_carriers(carrier_files, work_dir):
+    # Store the uploaded carriers under their index, their names may clash
+    # or hold paths. The extension tells the carrier type
+    carrier_paths = []
+    for index, carrier_file in enumerate(carrier_files):
+        path = os.path.join(work_dir, f"{index}{os.path.splitext(carrier_file.filename)[1].lower()}")
+        carrier_file.save(path)
+        carrier_paths.append(path)
+    return carrier_paths
+
+
+@app.route('/shardhide', methods=['POST'])
+def shardhide():
+    try:
+        required_files = ['secret', 'pubKey', 'carriers']
+        for field in required_files:
+            if field not in request.files:
+                return jsonify({"error": f"Missing file: {field}", "done": False}), 400
+
+        secret_file = request.files['secret']
+        carrier_files = request.files.getlist('carriers')
+        carrier_names = [os.path.basename(carrier_file.filename) for carrier_file in carrier_files]
+        if len(set(carrier_names)) != len(carrier_names):
+            return jsonify({"error": "Carriers must have different file names.", "done": False}), 400
+        channels = request.form.get('channels', 'R')
+        depth = int(request.form.get('bits', 1))
+        profile = request.form.get('profile', ENCODING_PROFILE)
+        if profile not in ENCODING_PROFILES:
+            return jsonify({"error": f"Unknown encoding profile: {profile}", "done": False}), 400
+        compression = request.form.get('compression', DEFAULT_COMPRESSION)
+        if compression not in COMPRESSION_CHOICES:
+            return jsonify({"error": f"Unknown compression: {compression}", "done": False}), 400
+
+        public_key = public_keys()
+
+        with tempfile.TemporaryDirectory(dir=SPOOL_DIR) as work_dir:
+            carrier_paths = save_carriers(carrier_files, work_dir)
+
+            # The secret keeps its name, it is stored in the hidden data
+            os.mkdir(os.path.join(work_dir, 'secret'))
+            secret_path = os.path.join(work_dir, 'secret', os.path.basename(secret_file.filename) or 'secret')
+            secret_file.save(secret_path)
+
+            output_paths = hide_file_in_carriers(carrier_paths, secret_path, os.path.join(work_dir, 'output'), None, channels, depth,
+                                                 overwrite=True, public_key=public_key, profile=profile, compression=compression)
+
+            # Send the carriers that got a shard back in a zip, under the names
+            # they were uploaded with
+            uploaded_names = dict(zip(map(os.path.basename, carrier_paths), carrier_names))
+            archive = tempfile.TemporaryFile(dir=SPOOL_DIR)
+            with zipfile.ZipFile(archive, 'w') as zip_file:
+                for output_path in output_paths:
+                    zip_file.write(output_path, uploaded_names[os.path.basename(output_path)])
+        archive.seek(0)
+
+        return send_file(
+            archive,
+            as_attachment=True,
+            download_name=request.form.get('output') or 'shards.zip',
+            mimetype='application/zip',
+        ), 200
 
     except Exception as err:
         return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
 
 
+@app.route('/shardextract', methods=['POST'])
+def shardextract():
+    try:
+        if 'passphrase' not in request.form:
+            return jsonify({"error": "Missing required field: passphrase", "done": False}), 400
+
+        required_files = ['priKey', 'carriers']
+        for field in required_files:
+            if field not in request.files:
+                return jsonify({"error": f"Missing file: {field}", "done": False}), 400
+
+        private_key = key_cache.private_key(read_key(request.files['priKey']), request.form['passphrase'])
+
+        with tempfile.TemporaryDirectory(dir=SPOOL_DIR) as work_dir:
+            carrier_paths = save_carriers(request.files.getlist('carriers'), work_dir)
+            filename, filedata = extract_chunks_from_carriers(carrier_paths, private_key)
+
+            output_name = request.form.get('output') or filename
+            return send_extracted(filedata, output_name)
+
+    except Exception as err:
+        return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
+
+
+@app.route('/jobs/<job_type>', methods=['POST'])
+def submit_job(job_type):
+    if job_type not in JOB_TYPES:
+        return jsonify({"error": f"Unknown job type: {job_type}", "done": False}), 404
+    action, carrier_type, carrier_field = JOB_TYPES[job_type]
+
+    if action == 'extract' and 'passphrase' not in request.form:
+        return jsonify({"error": "Missing required field: passphrase", "done": False}), 400
+
+    key_field = 'pubKey' if action == 'hide' else 'priKey'
+    required_files = (['secret'] if action == 'hide' else []) + [key_field, carrier_field]
+    for field in required_files:
+        if field not in request.files:
+            return jsonify({"error": f"Missing file: {field}", "done": False}), 400
+
+    profile = request.form.get('profile', ENCODING_PROFILE)
+    if profile not in ENCODING_PROFILES:
+        return jsonify({"error": f"Unknown encoding profile: {profile}", "done": False}), 400
+    compression = request.form.get('compression', DEFAULT_COMPRESSION)
+    if compression not in COMPRESSION_CHOICES:
+        return jsonify({"error": f"Unknown compression: {compression}", "done": False}), 400
+
+    # Reserve a slot first, so a full queue is reported before the uploads are stored
+    try:
+        job_id = job_manager.create()
+    except JobQueueFull as err:
+        return jsonify({"error": str(err), "done": False}), 503, {'Retry-After': '10'}
+
+    try:
+        # Store the uploads in the job directory, the worker reads them from there
+        job_dir = job_manager.job_dir(job_id)
+        carrier_file = request.files[carrier_field]
+        fields = {
+            "carrier": os.path.join(job_dir, 'carrier'),
+            "key": os.path.join(job_dir, 'key'),
+            "output": request.form.get('output', ''),
+        }
+        carrier_file.save(fields['carrier'])
+        request.files[key_field].save(fields['key'])
+
+        if action == 'hide':
+            secret_file = request.files['secret']
+            fields.update(
+                secret=os.path.join(job_dir, 'secret'),
+                filename=secret_file.filename.encode(),
+                carrier_name=carrier_file.filename,
+                channels=request.form.get('channels', 'R'),
+                bits=int(request.form.get('bits', 1)),
+                profile=profile,
+                compression=compression,
+            )
+            fields['output'] = fields['output'] or carrier_file.filename
+            secret_file.save(fields['secret'])
+        else:
+            fields['passphrase'] = request.form['passphrase']
+
+        job_manager.submit(job_id, job_spec(action, carrier_type, **fields))
+
+    except Exception as err:
+        job_manager.discard(job_id)
+        return jsonify({"error": f"error occurred: {str(err)}", "done": False}), 500
+
+    return jsonify({"job": job_id, "status": "queued", "done": False}), 202, {'Location': f'/jobs/{job_id}'}
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    status = job_manager.status(job_id)
+    if status is None:
+        return jsonify({"error": f"Unknown job: {job_id}", "done": False}), 404
+    return jsonify(dict(status, done=status['status'] == 'done')), 200
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    status = job_manager.status(job_id)
+    if status is None:
+        return jsonify({"error": f"Unknown job: {job_id}", "done": False}), 404
+    if status['status'] != 'done':
+        return jsonify(dict(status, done=False)), 409
+
+    filename = status['filename'] or 'result'
+    return send_file(
+        job_manager.result_path(job_id),
+        as_attachment=True,
+        download_name=filename,
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+    ), 200
+
+
 # Run the Flask application on port 8000
 if __name__ == '__main__':
     app.run(debug=True, port=8000)
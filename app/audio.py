@@ -1,98 +1,223 @@
 import os
-import random
+import shutil
 import numpy as np
 import wave
-from util import load_private_key, load_public_key, get_data_type
-from encrypt import encrypt_preprocess
-from decrypt import decrypt_postprocess
+from util import load_private_key, load_public_key, get_data_type, confirm_overwrite
+from encrypt import encrypt_stream, encrypt_for_carrier, spool_payload, DEFAULT_COMPRESSION
+from decrypt import decrypt_stream
+from lsb import payload_capacity, embed_payload, embed_payload_chunks, extract_payload_chunks, embed_payload_blocks, extract_payload_blocks
+from timings import stage
 
-def load_file_encrypt(key_path, audio_path, file_to_hide):
-    # Load the public key
-    public_key = load_public_key(key_path)
+# Number of frames read and written at a time in streaming mode
+BLOCK_FRAMES = 1 << 18
+
+def load_file_encrypt(key_path, audio_path, file_to_hide, public_key=None):
+    # Load the public key, unless it was already loaded
+    if public_key is None:
+        public_key = load_public_key(key_path)
 
     # Open the audio
     audio = wave.open(audio_path, mode='rb')
 
-    # Read the file to hide
-    with open(file_to_hide, 'rb') as f:
-        file_bytes = f.read()
+    # Open the file to hide, it is read a chunk at a time while it is embedded
+    secret_file = open(file_to_hide, 'rb')
 
     # Get secret file name
     filename = os.path.basename(file_to_hide).encode()
 
-    return public_key, audio, file_bytes, filename
+    return public_key, audio, secret_file, filename
+
+def audio_capacity(audio, depth=1):
+    # Payload bytes the audio can hold using `depth` LSBs of every sample,
+    # only the header of the audio is needed
+    return payload_capacity(audio.getnframes() * audio.getnchannels(), depth=depth)
+
+
+def hide_file_in_audio_util(audio, file_bytes, filename, public_key, audioname="", depth=1, compression=DEFAULT_COMPRESSION):
+    # Compress and encrypt the file (bytes or a binary file) chunk by chunk,
+    # unless it might not fit, in which case it is done up front so it is
+    # rejected before the frames are read
+    data_to_encode = encrypt_for_carrier(file_bytes, filename, public_key, audio_capacity(audio, depth), compression=compression)
 
-def hide_file_in_audio_util(audio, file_bytes, filename, public_key, audioname=""):
+    return embed_chunks_in_audio(audio, data_to_encode, depth)
+
+
+def embed_chunks_in_audio(audio, chunks, depth=1):
+    # Embed a payload that is already compressed and encrypted, given as
+    # chunks, in the audio. Returns the new samples
     seed = audio.getnframes()
-    prng = random.Random(seed) 
 
     # Read the original audio
     bytes_per_sample = audio.getsampwidth()
-    frames = audio.readframes(audio.getnframes())
-
     dtype = get_data_type(bytes_per_sample)
 
-    bits = np.frombuffer(frames, dtype=dtype).copy()  
-
-    # get the binary representation of the file
-    data_to_encode = encrypt_preprocess(file_bytes, filename, public_key)
-
-    # Calculate the number of samples needed
-    file_size = len(data_to_encode)
-    num_samples_required = file_size * 8 // (audio.getsampwidth() * 8)
-    if num_samples_required > len(bits):  
-        raise ValueError("Audio is not large enough to hide the file.")
-
-    # Generate a list of unique indices to hide the data
-    sample_indices = list(range(len(bits)))
-    prng.shuffle(sample_indices)  # Shuffle using the seeded PRNG
-
-    # Embed the file size in the first 64 samples (8 bytes for file size)
-    for i in range(64):
-        idx = sample_indices[i]
-        seventh_bit = (bits[idx] >> 1) & 0x1
-        xor_bit = ((file_size >> (63 - i))) & 0x1 ^ seventh_bit
-        if (bits[idx] & 0x1) != xor_bit:
-            bits[idx] ^= 0x1
-
-    # Embed each bit of the data to encode in the audio using LSB matching
-    for i, byte in enumerate(data_to_encode):
-        for bit in range(8):
-            idx = sample_indices[64 + i * 8 + bit]
-            seventh_bit = (bits[idx] >> 1) & 0x1
-            xor_bit = ((byte >> (7 - bit)) & 0x1) & 0x1 ^ seventh_bit
-            if (bits[idx] & 0x1) != xor_bit:
-                bits[idx] ^= 0x1
+    with stage('decode'):
+        frames = audio.readframes(audio.getnframes())
+        bits = np.frombuffer(frames, dtype=dtype).copy()
+
+    # Embed every chunk as it is produced at the samples selected by the
+    # keyed permutation, using `depth` LSBs of every payload sample
+    embed_payload_chunks(bits.reshape(-1, 1), seed, chunks, depth=depth)
 
     return bits
-    
 
-def hide_file_in_audio(audio_path, file_to_hide, output_audio_path, public_key_path):
-    
+
+def hide_file_in_audio_stream(audio, output_audio, file_bytes, filename, public_key, depth=1, block_frames=BLOCK_FRAMES,
+                              compression=DEFAULT_COMPRESSION):
+    # Streaming variant of hide_file_in_audio_util: the frames are read a block
+    # at a time and every block is written to the output writer before the
+    # next one is read, so memory is bounded by the block size
+    seed = audio.getnframes()
+    num_samples = audio.getnframes() * audio.getnchannels()
+    dtype = get_data_type(audio.getsampwidth())
+    output_audio.setparams(audio.getparams())
+
+    def read_blocks():
+        audio.rewind()
+        while True:
+            with stage('decode'):
+                frames = audio.readframes(block_frames)
+                block = np.frombuffer(frames, dtype=dtype).copy().reshape(-1, 1)
+            if not frames:
+                break
+            yield block
+
+    # The blocks need random access to the payload, so spool the compressed
+    # and encrypted file to a temporary file and memory-map it
+    data_to_encode = spool_payload(encrypt_stream(file_bytes, filename, public_key, compression=compression), audio_capacity(audio, depth))
+
+    for block in embed_payload_blocks(read_blocks(), num_samples, seed, data_to_encode, depth=depth,
+                                      block_size=block_frames * audio.getnchannels()):
+        with stage('encode'):
+            output_audio.writeframes(block.tobytes())
+
+
+def wav_data_chunk(audio_path):
+    # Return the file offset and size of the data chunk of a WAV file
+    with open(audio_path, 'rb') as f:
+        riff = f.read(12)
+        if len(riff) < 12 or riff[:4] != b'RIFF' or riff[8:] != b'WAVE':
+            raise ValueError("Audio is not a WAV file.")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("Audio has no data chunk.")
+            size = int.from_bytes(header[4:], 'little')
+            if header[:4] == b'data':
+                return f.tell(), size
+            # Chunks are padded to an even size
+            f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+def map_samples(audio_path, mode='r'):
+    # Memory-map the samples of a WAV file. Hidden bits only ever touch the
+    # low byte of a (little-endian) sample, so a strided view of those bytes
+    # is returned as a (samples, 1) carrier along with the audio parameters.
+    # Only the pages holding selected samples are ever read or written
+    with wave.open(audio_path, 'rb') as audio:
+        params = audio.getparams()
+    offset, _ = wav_data_chunk(audio_path)
+
+    num_samples = params.nframes * params.nchannels
+    if num_samples == 0:
+        raise ValueError("Audio has no samples.")
+
+    with stage('decode'):
+        data = np.memmap(audio_path, dtype=np.uint8, mode=mode, offset=offset, shape=(num_samples * params.sampwidth,))
+    return params, data[::params.sampwidth].reshape(-1, 1)
+
+
+def hide_file_in_audio_mmap(audio_path, output_audio_path, file_bytes, filename, public_key, depth=1, in_place=False,
+                            compression=DEFAULT_COMPRESSION):
+    # Memory-mapped variant of hide_file_in_audio_util: the carrier is copied
+    # to the output at the filesystem level (or, in place, the carrier itself
+    # is the output) and the hidden bits are written straight into the mapped
+    # samples, so neither the frames nor the output are ever held in memory
+    with wave.open(audio_path, 'rb') as audio:
+        seed = audio.getnframes()
+        capacity = audio_capacity(audio, depth)
+
+    # Compress and encrypt the file first, so a secret that does not fit is
+    # rejected before the carrier is copied or modified
+    data_to_encode = spool_payload(encrypt_stream(file_bytes, filename, public_key, compression=compression), capacity)
+
+    if not in_place:
+        with stage('encode'):
+            shutil.copyfile(audio_path, output_audio_path)
+    try:
+        _, samples = map_samples(output_audio_path, 'r+')
+        embed_payload(samples, seed, data_to_encode, depth=depth)
+        with stage('encode'):
+            samples.flush()
+    except Exception:
+        # Don't leave a half written carrier behind
+        if not in_place:
+            os.remove(output_audio_path)
+        raise
+
+
+def hide_file_in_audio(audio_path, file_to_hide, output_audio_path, public_key_path, depth=1, stream=False, overwrite=None, public_key=None,
+                       mmap=False, in_place=False, compression=DEFAULT_COMPRESSION):
+    # Pick one way of writing the output rather than silently dropping a mode
+    if stream and (mmap or in_place):
+        raise ValueError("Stream mode can't be combined with mmap or in-place embedding.")
+
     # Load the files
-    public_key, audio, file_bytes, filename = load_file_encrypt(public_key_path, audio_path, file_to_hide)
-    
-    out_bytes = hide_file_in_audio_util(audio, file_bytes, filename, public_key)
-    
-    # Check if the file already exists and prompt the user
-    if os.path.exists(output_audio_path):
-        overwrite = input(f"The file '{output_audio_path}' already exists. Overwrite? (y/n): ").lower()
-        if overwrite != 'y':
-            print("Extraction cancelled.")
-            return
-    
-    with wave.open(output_audio_path, 'wb') as output_audio:
-        output_audio.setparams(audio.getparams())
-        output_audio.writeframes(out_bytes)
+    public_key, audio, secret_file, filename = load_file_encrypt(public_key_path, audio_path, file_to_hide, public_key)
+
+    # Embedding in place modifies the carrier itself, which was asked for
+    # explicitly. Otherwise check if the file already exists and prompt the
+    # user before doing the work, in stream mode the output is written while
+    # the audio is read
+    if in_place:
+        if not (os.path.exists(output_audio_path) and os.path.samefile(audio_path, output_audio_path)):
+            secret_file.close()
+            audio.close()
+            raise ValueError("Embedding in place needs the output to be the carrier itself.")
+    elif stream and os.path.exists(output_audio_path) and os.path.samefile(audio_path, output_audio_path):
+        secret_file.close()
+        audio.close()
+        raise ValueError("The output can't be the carrier itself in stream mode.")
+    elif mmap and os.path.exists(output_audio_path) and os.path.samefile(audio_path, output_audio_path):
+        secret_file.close()
+        audio.close()
+        raise ValueError("The output can't be the carrier itself in mmap mode, use in-place embedding.")
+    elif not confirm_overwrite(output_audio_path, overwrite):
+        secret_file.close()
+        audio.close()
+        print("Extraction cancelled.")
+        return
+
+    if mmap or in_place:
+        audio.close()
+        with secret_file:
+            hide_file_in_audio_mmap(audio_path, output_audio_path, secret_file, filename, public_key, depth, in_place, compression)
+    elif stream:
+        try:
+            with secret_file, wave.open(output_audio_path, 'wb') as output_audio:
+                hide_file_in_audio_stream(audio, output_audio, secret_file, filename, public_key, depth, compression=compression)
+        except Exception:
+            # Don't leave a half written carrier behind
+            os.remove(output_audio_path)
+            raise
+    else:
+        with secret_file:
+            out_bytes = hide_file_in_audio_util(audio, secret_file, filename, public_key, depth=depth, compression=compression)
+
+        with stage('encode'), wave.open(output_audio_path, 'wb') as output_audio:
+            output_audio.setparams(audio.getparams())
+            output_audio.writeframes(out_bytes)
 
     audio.close()
 
     print(f"File '{file_to_hide}' has been successfully hidden in '{output_audio_path}'.")
+    return output_audio_path
 
 
-def load_file_decrypt(key_path, passphrase, audio_path):
-    # Load the public key
-    private_key = load_private_key(key_path, passphrase)
+def load_file_decrypt(key_path, passphrase, audio_path, private_key=None):
+    # Load the private key, unless it was already loaded
+    if private_key is None:
+        private_key = load_private_key(key_path, passphrase)
 
     # Open the audio
     audio = wave.open(audio_path, mode='rb')
@@ -100,83 +225,125 @@ def load_file_decrypt(key_path, passphrase, audio_path):
     return private_key, audio
 
 
-def extract_file_from_audio_util(audio, private_key):
+def extract_file_chunks_from_audio_util(audio, private_key):
 
     # Determine the size of the encrypted session key based on the private key size
     encrypted_session_key_size = private_key.key_size // 8
     
     seed = audio.getnframes()
-    prng = random.Random(seed)  
 
     # Read the original audio
     bytes_per_sample = audio.getsampwidth()
-    frames = audio.readframes(audio.getnframes())
-    
     dtype = get_data_type(bytes_per_sample)
 
-    bits = np.frombuffer(frames, dtype=dtype).copy()  
+    with stage('decode'):
+        frames = audio.readframes(audio.getnframes())
+        bits = np.frombuffer(frames, dtype=dtype).copy()
 
-    # Extract the file size from the first 64 pixels
-    file_size = 0
-    for i in range(64):
-        file_size = (file_size << 1) | (bits[i] & 0x1)
-    
-    # Calculate the number of bytes that can be extracted
-    num_bytes_to_extract = file_size
-    
-    # Prepare a list to store the extracted bytes
-    extracted_bytes = []
-    
-    # Generate a list of unique indices to extract the data
-    pixel_indices = list(range(len(bits)))
-    prng.shuffle(pixel_indices)  # Shuffle using the seeded PRNG
-
-    # Extract the file size from the first 64 pixels
-    file_size = 0
-    for i in range(64):
-        idx = pixel_indices[i]
-        seventh_bit = (bits[idx] >> 1) & 0x1
-        xor_bit = (bits[idx] & 0x1) ^ seventh_bit
-        file_size = (file_size << 1) | xor_bit
-
-    # Calculate the number of bytes that can be extracted
-    num_bytes_to_extract = file_size
-
-    # Extract the hidden bits and reconstruct the bytes using the same indices
-    extracted_bytes = []
-    for i in range(num_bytes_to_extract):
-        byte = 0
-        for bit in range(8):
-            idx = pixel_indices[64 + i * 8 + bit]
-            seventh_bit = (bits[idx] >> 1) & 0x1
-            xor_bit = (bits[idx] & 0x1) ^ seventh_bit
-            byte = (byte << 1) | xor_bit
-        extracted_bytes.append(byte)
-    
-    # Get the filename and filedata from extracted bytes
-    filedata, filename = decrypt_postprocess(extracted_bytes, encrypted_session_key_size, private_key)
+    # Read the hidden bytes a chunk at a time at the samples selected by the keyed permutation
+    extracted_bytes = extract_payload_chunks(bits.reshape(-1, 1), seed)
+
+    # Get the filename and an iterator over the filedata from extracted bytes
+    filename, filedata = decrypt_stream(extracted_bytes, encrypted_session_key_size, private_key)
+
+    return filename, filedata
+
+
+def extract_file_from_audio_util(audio, private_key):
+    filename, filedata = extract_file_chunks_from_audio_util(audio, private_key)
+
+    return b''.join(filedata), filename
+
+
+def extract_file_chunks_from_audio_stream(audio, private_key, block_frames=BLOCK_FRAMES):
+    # Streaming variant of extract_file_from_audio_util: only the frames that
+    # hold hidden bits are read, a block at a time
+
+    # Determine the size of the encrypted session key based on the private key size
+    encrypted_session_key_size = private_key.key_size // 8
+
+    seed = audio.getnframes()
+    channels = audio.getnchannels()
+    dtype = get_data_type(audio.getsampwidth())
+
+    def read_samples(start, count):
+        # The reader works in whole frames, so read the frames around the samples
+        first_frame = start // channels
+        with stage('decode'):
+            audio.setpos(first_frame)
+            frames = audio.readframes(-(-(start + count) // channels) - first_frame)
+        offset = start - first_frame * channels
+        return np.frombuffer(frames, dtype=dtype)[offset:offset + count].reshape(-1, 1)
+
+    # Read the hidden bytes at the samples selected by the keyed permutation
+    extracted_bytes = extract_payload_blocks(read_samples, audio.getnframes() * channels, 1, seed,
+                                             block_frames * channels)
+
+    # Get the filename and an iterator over the filedata from extracted bytes
+    filename, filedata = decrypt_stream([extracted_bytes], encrypted_session_key_size, private_key)
+
+    return filename, filedata
 
-    return filedata, filename
-    
 
-def extract_file_from_audio(audio_path, output_file_path, private_key_path, passphrase):
-    private_key, audio = load_file_decrypt(private_key_path, passphrase, audio_path)
+def extract_file_chunks_from_audio_mmap(audio_path, private_key):
+    # Memory-mapped variant of extract_file_from_audio_util: the samples are
+    # mapped read-only and only the pages holding hidden bits are read
 
-    filedata, filename = extract_file_from_audio_util(audio, private_key)
+    # Determine the size of the encrypted session key based on the private key size
+    encrypted_session_key_size = private_key.key_size // 8
+
+    params, samples = map_samples(audio_path)
+    seed = params.nframes
+
+    # Read the hidden bytes a chunk at a time at the samples selected by the keyed permutation
+    extracted_bytes = extract_payload_chunks(samples, seed)
+
+    # Get the filename and an iterator over the filedata from extracted bytes
+    filename, filedata = decrypt_stream(extracted_bytes, encrypted_session_key_size, private_key)
+
+    return filename, filedata
+
+
+def extract_file_from_audio_stream(audio, private_key, block_frames=BLOCK_FRAMES):
+    filename, filedata = extract_file_chunks_from_audio_stream(audio, private_key, block_frames)
+
+    return b''.join(filedata), filename
+
+
+def extract_file_from_audio(audio_path, output_file_path, private_key_path, passphrase, stream=False, overwrite=None, private_key=None,
+                            mmap=False):
+    # Check an explicit output before any work is done, so a skipped
+    # extraction doesn't pay for decoding and decrypting the carrier
+    if output_file_path and not confirm_overwrite(output_file_path, overwrite):
+        print("Extraction cancelled.")
+        return
+
+    private_key, audio = load_file_decrypt(private_key_path, passphrase, audio_path, private_key)
+
+    if mmap:
+        filename, filedata = extract_file_chunks_from_audio_mmap(audio_path, private_key)
+    elif stream:
+        filename, filedata = extract_file_chunks_from_audio_stream(audio, private_key)
+    else:
+        filename, filedata = extract_file_chunks_from_audio_util(audio, private_key)
     
-    # If no output file path is provided, use the extracted filename
+    # If no output file path is provided, use the extracted filename, and
+    # check if that file already exists
     if not output_file_path:
         output_file_path = os.path.join(os.getcwd(), filename)
-
-    # Check if the file already exists and prompt the user
-    if os.path.exists(output_file_path):
-        overwrite = input(f"The file '{output_file_path}' already exists. Overwrite? (y/n): ").lower()
-        if overwrite != 'y':
+        if not confirm_overwrite(output_file_path, overwrite):
             print("Extraction cancelled.")
             return
         
-    # Write the decompressed data to the output file
-    with open(output_file_path, 'wb') as f:
-        f.write(filedata)
+    # Write the decompressed data to the output file a chunk at a time
+    try:
+        with open(output_file_path, 'wb') as f:
+            for chunk in filedata:
+                f.write(chunk)
+    except Exception:
+        # Don't leave a partially extracted file behind
+        os.remove(output_file_path)
+        raise
 
     print(f"File extracted to {output_file_path}")
+    return output_file_path
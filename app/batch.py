@@ -0,0 +1,122 @@
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from keycache import KeyCache
+from image import hide_file_in_img, extract_file_from_img, DEFAULT_ENCODING_PROFILE
+from audio import hide_file_in_audio, extract_file_from_audio
+from encrypt import DEFAULT_COMPRESSION
+from util import confirm_overwrite
+
+# Columns (CSV) or keys (JSONL) a manifest job can have
+MANIFEST_FIELDS = ['action', 'type', 'carrier', 'secret', 'key', 'passphrase', 'output', 'channels', 'bits', 'stream', 'mmap', 'profile', 'compression']
+
+# Every worker process parses each key file once and reuses it for its later jobs
+_key_cache = None
+
+
+def read_manifest(manifest_path):
+    # Jobs are read from a JSONL file (one object per line) or a CSV file with a header row
+    with open(manifest_path, newline='') as manifest:
+        if manifest_path.lower().endswith(('.jsonl', '.json')):
+            jobs = [json.loads(line) for line in manifest if line.strip()]
+        else:
+            jobs = list(csv.DictReader(manifest))
+
+    for number, job in enumerate(jobs, 1):
+        unknown = set(job) - set(MANIFEST_FIELDS)
+        if unknown:
+            raise ValueError(f"Job {number}: unknown manifest fields: {', '.join(sorted(unknown))}")
+    return jobs
+
+
+def _flag(value):
+    # CSV cells are strings, JSONL values can already be booleans
+    if isinstance(value, str):
+        return value.strip().lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def _read_key(key_path):
+    with open(key_path, 'rb') as key_file:
+        return key_file.read()
+
+
+def _init_worker():
+    global _key_cache
+    _key_cache = KeyCache()
+
+
+def run_job(job, overwrite=False, passphrase=None):
+    # Run one hide or extract job and return its result row for the report
+    action = job.get('action')
+    carrier_type = job.get('type')
+    output = job.get('output') or None
+
+    if action not in ('hide', 'extract'):
+        raise ValueError(f"Unknown action: {action}")
+    if carrier_type not in ('image', 'audio'):
+        raise ValueError(f"Unknown type: {carrier_type}")
+    for field in ('carrier', 'key') + (('secret', 'output') if action == 'hide' else ()):
+        if not job.get(field):
+            raise ValueError(f"Missing field: {field}")
+
+    if action == 'hide':
+        public_key = _key_cache.public_key(_read_key(job['key']))
+        depth = int(job.get('bits') or 1)
+        compression = job.get('compression') or DEFAULT_COMPRESSION
+        if carrier_type == 'audio':
+            return hide_file_in_audio(job['carrier'], job['secret'], output, job['key'], depth, _flag(job.get('stream')),
+                                      overwrite=overwrite, public_key=public_key, mmap=_flag(job.get('mmap')), compression=compression)
+        return hide_file_in_img(job['carrier'], job['secret'], output, job['key'], job.get('channels') or 'R', depth,
+                                overwrite=overwrite, public_key=public_key, profile=job.get('profile') or DEFAULT_ENCODING_PROFILE,
+                                mmap=_flag(job.get('mmap')), compression=compression, stream=_flag(job.get('stream')))
+
+    # An existing output is skipped before the key is parsed and the carrier read
+    if output and not confirm_overwrite(output, overwrite):
+        return None
+    job_passphrase = job.get('passphrase') or passphrase
+    if job_passphrase is None:
+        raise ValueError("Missing field: passphrase")
+    private_key = _key_cache.private_key(_read_key(job['key']), job_passphrase)
+    if carrier_type == 'audio':
+        return extract_file_from_audio(job['carrier'], output, job['key'], job_passphrase, _flag(job.get('stream')),
+                                       overwrite=overwrite, private_key=private_key, mmap=_flag(job.get('mmap')))
+    return extract_file_from_img(job['carrier'], output, job['key'], job_passphrase,
+                                 overwrite=overwrite, private_key=private_key, stream=_flag(job.get('stream')))
+
+
+def _run_numbered_job(args):
+    number, job, overwrite, passphrase = args
+    start = time.perf_counter()
+    result = {"job": number, "action": job.get('action'), "type": job.get('type'), "carrier": job.get('carrier')}
+    try:
+        output = run_job(job, overwrite, passphrase)
+        if output is None:
+            result.update(status="skipped", output=job.get('output') or None, error="output file already exists")
+        else:
+            result.update(status="ok", output=output)
+    except Exception as err:
+        result.update(status="error", output=job.get('output') or None, error=str(err))
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def run_batch(manifest_path, report_path, workers=None, overwrite=False, passphrase=None):
+    # Run every job of the manifest on a process pool (one worker per core by
+    # default) and write one JSON result line per job, in manifest order
+    jobs = read_manifest(manifest_path)
+    tasks = [(number, job, overwrite, passphrase) for number, job in enumerate(jobs, 1)]
+    workers = workers or os.cpu_count() or 1
+
+    counts = {"ok": 0, "skipped": 0, "error": 0}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as executor, \
+            open(report_path, 'w') as report:
+        chunksize = max(1, len(tasks) // (workers * 8))
+        for result in executor.map(_run_numbered_job, tasks, chunksize=chunksize):
+            counts[result["status"]] += 1
+            report.write(json.dumps(result) + '\n')
+
+    print(f"{len(jobs)} jobs: {counts['ok']} done, {counts['skipped']} skipped, {counts['error']} failed. Report written to {report_path}")
+    return counts
@@ -0,0 +1,38 @@
+import wave
+from PIL import Image
+from image import image_capacity
+from audio import audio_capacity
+from encrypt import max_payload_size, max_secret_size, wrapped_key_size, DEFAULT_COMPRESSION
+
+# Size of the RSA keys made by generate_keys.py, assumed when no public key is given
+DEFAULT_KEY_SIZE = 4096
+
+
+def carrier_capacity(carrier_type, carrier, channels='R', depth=1):
+    # Payload bytes a carrier (a path or a binary file) can hold. Only its
+    # header is read, nothing is decoded
+    if carrier_type == 'audio':
+        with wave.open(carrier, 'rb') as audio:
+            return audio_capacity(audio, depth)
+    with Image.open(carrier) as img:
+        return image_capacity(img, channels, depth)
+
+
+def capacity_report(capacity, filename=b'', secret_size=None, public_key=None, compression=DEFAULT_COMPRESSION):
+    # What fits in a carrier of `capacity` payload bytes: the container
+    # overhead for this key (or list of recipient keys) and file name, and the largest secret that fits
+    # even if it does not compress at all. For a given secret size, fits is
+    # True or False, or None when it depends on how well the secret compresses
+    key_size, recipients = wrapped_key_size(public_key) if public_key is not None else (DEFAULT_KEY_SIZE // 8, 1)
+    overhead = max_payload_size(0, len(filename), key_size, compression=compression, recipients=recipients)
+    max_secret = max_secret_size(capacity, len(filename), key_size, compression=compression, recipients=recipients)
+
+    report = {"capacity": capacity, "overhead": overhead, "max_secret": max(max_secret, 0), "key_size": key_size * 8, "recipients": recipients}
+    if secret_size is not None:
+        if secret_size <= max_secret:
+            report["fits"] = True
+        elif overhead > capacity or compression == 'none':
+            report["fits"] = False
+        else:
+            report["fits"] = None
+    return report
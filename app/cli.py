@@ -1,7 +1,16 @@
 import argparse
+import os
 import sys
-from image import hide_file_in_img, extract_file_from_img
+from image import hide_file_in_img, extract_file_from_img, ENCODING_PROFILES, DEFAULT_ENCODING_PROFILE
 from audio import hide_file_in_audio, extract_file_from_audio
+from batch import run_batch
+from scan import run_scan
+from shard import hide_file_in_carriers, extract_file_from_carriers
+from capacity import carrier_capacity, capacity_report
+from encrypt import COMPRESSION_CHOICES, DEFAULT_COMPRESSION
+from util import load_public_key
+from timings import collect
+from contextlib import nullcontext
 
 def main():
     parser = argparse.ArgumentParser(description='SecretPixel - Advanced Steganography Tool', epilog="Example commands:\n"
@@ -17,6 +26,18 @@ def main():
     hide_parser.add_argument('secret', type=str, help='Path to the secret file to hide')
     hide_parser.add_argument('pubkey', type=str, help='Path to the public key for encryption')
     hide_parser.add_argument('output', type=str, help='Path to the output file with embedded data')
+    hide_parser.add_argument('--pubkey', dest='recipients', action='append', default=[], metavar='PUBKEY',
+                             help='Path to the public key of another recipient, repeat for each one (the secret is encrypted once, only the session key is wrapped for every key)')
+    hide_parser.add_argument('--channels', type=str, default='R', help='Image channels that carry the data: any of R, G, B and A, e.g. RGB (default: R)')
+    hide_parser.add_argument('--bits', type=int, choices=range(1, 5), default=1, metavar='{1-4}', help='Number of LSBs used per channel or audio sample (default: 1)')
+    hide_parser.add_argument('--stream', action='store_true', help='Process audio in fixed-size blocks and PNG/TIFF images in strips of rows to bound memory use')
+    hide_parser.add_argument('--mmap', action='store_true', help='Copy the WAV or uncompressed BMP/TGA/TIFF to the output and embed into its memory-mapped samples or pixels')
+    hide_parser.add_argument('--in-place', action='store_true', help='Embed into the memory-mapped WAV or uncompressed image itself, the output must be the host file')
+    hide_parser.add_argument('--profile', choices=list(ENCODING_PROFILES), default=DEFAULT_ENCODING_PROFILE,
+                             help=f'Output image encoding: fast, balanced or smallest, trading encode time for size (default: {DEFAULT_ENCODING_PROFILE})')
+    hide_parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=DEFAULT_COMPRESSION,
+                             help=f'Compression of the secret: auto picks none, fast or zlib from a sample of the secret, lzma is the smallest and slowest (default: {DEFAULT_COMPRESSION})')
+    hide_parser.add_argument('--timings', action='store_true', help='Print the time spent in every stage')
 
 
     # Subparser for extracting a file
@@ -29,6 +50,60 @@ def main():
     extract_parser.add_argument('passphrase', type=str, help='passphrase for decripytion')
 
     extract_parser.add_argument('extracted', nargs='?', type=str, default=None, help='Path to save the extracted secret file (optional, defaults to the original filename)')
+    extract_parser.add_argument('--stream', action='store_true', help='Process audio in fixed-size blocks and PNG/TIFF images in strips of rows to bound memory use')
+    extract_parser.add_argument('--mmap', action='store_true', help='Read the hidden bits from the memory-mapped WAV (uncompressed images are always read this way)')
+    extract_parser.add_argument('--timings', action='store_true', help='Print the time spent in every stage')
+
+    # Subparsers for splitting a secret across several carriers and joining it back
+    split_parser = subparsers.add_parser('split', help='Split a secret too large for one carrier across several images and WAVs', epilog="Example: python secret_pixel.py split secret.zip mypublickey.pem outdir/ a.png b.png c.wav --channels RGB --bits 2",
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    split_parser.add_argument('secret', type=str, help='Path to the secret file to hide')
+    split_parser.add_argument('pubkey', type=str, help='Path to the public key for encryption')
+    split_parser.add_argument('output', type=str, help='Directory the carriers with a shard are written to, under their own names')
+    split_parser.add_argument('carriers', nargs='+', type=str, help='Paths to the host images and WAVs')
+    split_parser.add_argument('--pubkey', dest='recipients', action='append', default=[], metavar='PUBKEY', help='Path to the public key of another recipient, repeat for each one')
+    split_parser.add_argument('--channels', type=str, default='R', help='Image channels that carry the data: any of R, G, B and A, e.g. RGB (default: R)')
+    split_parser.add_argument('--bits', type=int, choices=range(1, 5), default=1, metavar='{1-4}', help='Number of LSBs used per channel or audio sample (default: 1)')
+    split_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: one per carrier, up to the number of cores)')
+    split_parser.add_argument('--profile', choices=list(ENCODING_PROFILES), default=DEFAULT_ENCODING_PROFILE, help=f'Output image encoding (default: {DEFAULT_ENCODING_PROFILE})')
+    split_parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=DEFAULT_COMPRESSION, help=f'Compression of the secret (default: {DEFAULT_COMPRESSION})')
+
+    join_parser = subparsers.add_parser('join', help='Extract a secret split across several carriers, given in any order', epilog="Example: python secret_pixel.py join myprivatekey.pem passphrase c.wav a.png b.png --output secret.zip",
+                                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    join_parser.add_argument('privkey', type=str, help='Path to the private key for decryption')
+    join_parser.add_argument('passphrase', type=str, help='passphrase for decripytion')
+    join_parser.add_argument('carriers', nargs='+', type=str, help='Paths to the images and WAVs holding the shards')
+    join_parser.add_argument('--output', type=str, default=None, help='Path to save the extracted secret file (optional, defaults to the original filename)')
+    join_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: one per carrier, up to the number of cores)')
+
+    # Subparser for running many jobs from a manifest
+    batch_parser = subparsers.add_parser('batch', help='Run the hide and extract jobs of a CSV or JSONL manifest in parallel', epilog="Example: python secret_pixel.py batch jobs.csv --workers 8 --report report.jsonl\n\n"
+                                         "Manifest fields: action (hide|extract), type (image|audio), carrier, secret, key, passphrase, output, channels, bits, stream, mmap, profile, compression",
+                                         formatter_class=argparse.RawDescriptionHelpFormatter)
+    batch_parser.add_argument('manifest', type=str, help='Path to the manifest (.csv with a header row, or .jsonl)')
+    batch_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of cores)')
+    batch_parser.add_argument('--report', type=str, default=None, help='Path to the JSONL result report (default: <manifest>-report.jsonl)')
+    batch_parser.add_argument('--overwrite', action='store_true', help='Replace existing output files instead of skipping the job')
+    batch_parser.add_argument('--passphrase', type=str, default=None, help='Passphrase for extract jobs that do not set one')
+
+    # Subparser for finding the carriers that hold a payload
+    scan_parser = subparsers.add_parser('scan', help='Find the images and WAVs under a directory that hold hidden data, without any key', epilog="Example: python secret_pixel.py scan archive/ --workers 8 --report scan.jsonl",
+                                        formatter_class=argparse.RawDescriptionHelpFormatter)
+    scan_parser.add_argument('root', type=str, help='Directory (or single file) to scan')
+    scan_parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: number of cores)')
+    scan_parser.add_argument('--report', type=str, default='scan-report.jsonl', help='Path to the JSONL result report (default: scan-report.jsonl)')
+    scan_parser.add_argument('--legacy', action='store_true', help='Also look for carriers written before the frame header, which is much slower')
+
+    # Subparser for checking how much a carrier can hold
+    capacity_parser = subparsers.add_parser('capacity', help='Show how large a secret an image or audio can hold, reading only its header', epilog="Example: python secret_pixel.py capacity image host.png --secret secret.txt --channels RGB --bits 2",
+                                            formatter_class=argparse.RawDescriptionHelpFormatter)
+    capacity_parser.add_argument('type', choices=["image", "audio"], help='Type of file image or audio')
+    capacity_parser.add_argument('host', type=str, help='Path to the host file')
+    capacity_parser.add_argument('--secret', type=str, default=None, help='Path to a secret file to check')
+    capacity_parser.add_argument('--pubkey', action='append', default=[], help='Path to the public key that will be used, repeat for each recipient (default: a 4096-bit key)')
+    capacity_parser.add_argument('--channels', type=str, default='R', help='Image channels that carry the data: any of R, G, B and A, e.g. RGB (default: R)')
+    capacity_parser.add_argument('--bits', type=int, choices=range(1, 5), default=1, metavar='{1-4}', help='Number of LSBs used per channel or audio sample (default: 1)')
+    capacity_parser.add_argument('--compression', choices=COMPRESSION_CHOICES, default=DEFAULT_COMPRESSION, help=f'Compression of the secret that will be used (default: {DEFAULT_COMPRESSION})')
 
 
 
@@ -38,18 +113,66 @@ def main():
 
     args = parser.parse_args()
 
+    # Stages are only timed when asked for
+    with collect() if getattr(args, 'timings', False) else nullcontext() as timings:
+        run_command(parser, args)
+    if timings is not None:
+        print(timings.report())
+
+def load_recipients(pubkey, recipients):
+    # Public keys of every recipient, or None for a single one (loaded from its path by the hide functions)
+    if not recipients:
+        return None
+    return [load_public_key(key_path) for key_path in [pubkey] + recipients]
+
+def run_command(parser, args):
     if args.command == 'hide':
+        if args.stream and (args.mmap or args.in_place):
+            parser.error("--stream can't be combined with --mmap or --in-place")
+        public_key = load_recipients(args.pubkey, args.recipients)
         if args.type == 'audio':
-            hide_file_in_audio(args.host, args.secret, args.output, args.pubkey)
+            hide_file_in_audio(args.host, args.secret, args.output, args.pubkey, args.bits, args.stream, public_key=public_key, mmap=args.mmap,
+                               in_place=args.in_place, compression=args.compression)
         else:
-            hide_file_in_img(args.host, args.secret, args.output, args.pubkey)
+            hide_file_in_img(args.host, args.secret, args.output, args.pubkey, args.channels, args.bits, public_key=public_key, profile=args.profile,
+                             mmap=args.mmap, in_place=args.in_place, compression=args.compression, stream=args.stream)
     elif args.command == 'extract':
         # If no output file path is provided, use None to trigger default behavior
         output_file_path = args.extracted if args.extracted else None
         if args.type == 'audio':
-            extract_file_from_audio(args.carrier, output_file_path, args.privkey, args.passphrase)
+            extract_file_from_audio(args.carrier, output_file_path, args.privkey, args.passphrase, args.stream, mmap=args.mmap)
         else:
-            extract_file_from_img(args.carrier, output_file_path, args.privkey, args.passphrase)
+            extract_file_from_img(args.carrier, output_file_path, args.privkey, args.passphrase, stream=args.stream)
+    elif args.command == 'split':
+        hide_file_in_carriers(args.carriers, args.secret, args.output, args.pubkey, args.channels, args.bits, args.workers,
+                              public_key=load_recipients(args.pubkey, args.recipients), profile=args.profile, compression=args.compression)
+    elif args.command == 'join':
+        extract_file_from_carriers(args.carriers, args.output, args.privkey, args.passphrase, args.workers)
+    elif args.command == 'batch':
+        report_path = args.report or os.path.splitext(args.manifest)[0] + '-report.jsonl'
+        counts = run_batch(args.manifest, report_path, args.workers, args.overwrite, args.passphrase)
+        if counts['error']:
+            sys.exit(1)
+    elif args.command == 'scan':
+        run_scan(args.root, args.report, args.workers, args.legacy)
+    elif args.command == 'capacity':
+        public_key = [load_public_key(key_path) for key_path in args.pubkey] or None
+        filename = os.path.basename(args.secret).encode() if args.secret else b''
+        secret_size = os.path.getsize(args.secret) if args.secret else None
+        report = capacity_report(carrier_capacity(args.type, args.host, args.channels, args.bits), filename, secret_size, public_key,
+                                 args.compression)
+
+        print(f"Capacity: {report['capacity']} bytes of payload")
+        keys = f"RSA-{report['key_size']} key" if report['recipients'] == 1 else f"{report['recipients']} recipients, {report['key_size']} key bits in all"
+        print(f"Overhead: {report['overhead']} bytes ({keys}, {len(filename)} byte file name)")
+        print(f"Largest secret that always fits: {report['max_secret']} bytes")
+        if args.secret:
+            if report['fits'] is None:
+                print(f"'{args.secret}' ({secret_size} bytes) only fits if it compresses well enough")
+            else:
+                print(f"'{args.secret}' ({secret_size} bytes) {'fits' if report['fits'] else 'does not fit'}")
+            if report['fits'] is False:
+                sys.exit(1)
     else:
         parser.print_help()
 
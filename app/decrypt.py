@@ -1,61 +1,233 @@
 import zlib
+import lzma
 from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from cryptography.exceptions import InvalidTag
+from timings import stage, count
+from util import split_segments, segment_nonce, derive_key, key_id, CONTAINER_MAGIC, SHARD_MAGIC, CONTAINER_VERSION, LEGACY_CONTAINER_VERSION, AEAD_CONTAINER_VERSION, CODEC_CONTAINER_VERSION, RECIPIENTS_CONTAINER_VERSION, KEY_ID_SIZE, AEAD_SEGMENT_SIZE, AEAD_TAG_SIZE, NONCE_PREFIX_SIZE, CODEC_NONE, CODEC_ZLIB, CODEC_LZMA, LZMA_FILTERS
 
-def decrypt_data(encrypted_session_key, salt, iv, encrypted_data, private_key):
-    # Decrypt the session key with RSA
-    session_key = private_key.decrypt(
-        encrypted_session_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
+def decrypt_session_key(encrypted_session_key, private_key):
+    # Decrypt the session key with RSA, the OAEP check fails straight away
+    # when the hidden data was not encrypted for this key
+    try:
+        with stage('rsa'):
+            return private_key.decrypt(
+                encrypted_session_key,
+                padding.OAEP(
+                    mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                    algorithm=hashes.SHA256(),
+                    label=None
+                )
+            )
+    except ValueError:
+        raise ValueError("The hidden data was not encrypted for this private key.")
+
+def create_decryptor(encrypted_session_key, salt, iv, private_key, version=LEGACY_CONTAINER_VERSION):
+    session_key = decrypt_session_key(encrypted_session_key, private_key)
     
     # Derive the symmetric key from the session key
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=200000,  # Increased iterations for added security
-        backend=default_backend()
-    )
-    key = kdf.derive(session_key)
+    key = derive_key(session_key, salt, version)
     
-    # Decrypt the data with AES
+    # Create the AES decryptor
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    decryptor = cipher.decryptor()
-    decrypted_padded_data = decryptor.update(encrypted_data) + decryptor.finalize()
-    unpadder = PKCS7(algorithms.AES.block_size).unpadder()
-    decrypted_data = unpadder.update(decrypted_padded_data) + unpadder.finalize()
-    
-    return decrypted_data
+    return cipher.decryptor()
 
 
-def decrypt_postprocess(extracted_bytes, encrypted_session_key_size, private_key):
-    # Convert the extracted bytes to a byte array
-    data_to_decode = bytes(extracted_bytes)
+class ChunkReader:
+    # Reads exact byte counts from an iterable of chunks of any size
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = bytearray()
+
+    def read(self, size):
+        while len(self.buffer) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                raise ValueError("Hidden data is truncated.")
+            self.buffer += chunk
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def remaining(self):
+        # Yield whatever is left, starting with the buffered bytes
+        if self.buffer:
+            yield bytes(self.buffer)
+            self.buffer.clear()
+        yield from self.chunks
+
+
+class StoredDecompressor:
+    # Stands in for a decompressor when the secret was stored uncompressed
+
+    eof = True
+
+    def decompress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+def create_decompressor(codec):
+    if codec == CODEC_NONE:
+        return StoredDecompressor()
+    if codec == CODEC_ZLIB:
+        return zlib.decompressobj()
+    if codec == CODEC_LZMA:
+        return lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    raise ValueError(f"Unsupported compression codec: {codec}")
+
+
+def read_recipient_table(reader, private_key):
+    # Read the recipient table and the wrapped keys, and pick the session key
+    # wrapped for this private key by its key ID, so only one RSA decryption
+    # is needed. Returns it with the bytes read, which are part of the header
+    recipients = reader.read(2)
+    table = reader.read(int.from_bytes(recipients, 'big') * (KEY_ID_SIZE + 2))
+    own_id = key_id(private_key.public_key())
+
+    offset = 0
+    encrypted_session_key = None
+    for entry in range(0, len(table), KEY_ID_SIZE + 2):
+        wrapped_key_size = int.from_bytes(table[entry + KEY_ID_SIZE:entry + KEY_ID_SIZE + 2], 'big')
+        if encrypted_session_key is None and table[entry:entry + KEY_ID_SIZE] == own_id:
+            encrypted_session_key = (offset, wrapped_key_size)
+        offset += wrapped_key_size
+    wrapped_keys = reader.read(offset)
+
+    if encrypted_session_key is None:
+        raise ValueError("The hidden data was not encrypted for this private key.")
+    offset, wrapped_key_size = encrypted_session_key
+    return wrapped_keys[offset:offset + wrapped_key_size], recipients + table + wrapped_keys
+
+
+def decrypt_aead_chunks(reader, filename, encrypted_session_key_size, private_key, version, codec=CODEC_ZLIB):
+    # Extract the session key, salt and nonce prefix, which complete the header
+    if version >= RECIPIENTS_CONTAINER_VERSION:
+        encrypted_session_key, recipients = read_recipient_table(reader, private_key)
+    else:
+        encrypted_session_key = recipients = reader.read(encrypted_session_key_size)
+    salt = reader.read(16)
+    nonce_prefix = reader.read(NONCE_PREFIX_SIZE)
+    prefix = CONTAINER_MAGIC + bytes([version]) + (bytes([codec]) if version >= CODEC_CONTAINER_VERSION else b'')
+    header = prefix + len(filename).to_bytes(4, 'big') + filename + recipients + salt + nonce_prefix
+
+    session_key = decrypt_session_key(encrypted_session_key, private_key)
+    aesgcm = AESGCM(derive_key(session_key, salt, version))
+
+    def open_segment(counter, segment, final):
+        try:
+            with stage('decrypt'):
+                return aesgcm.decrypt(segment_nonce(nonce_prefix, counter, final), segment, header)
+        except InvalidTag:
+            raise ValueError("Hidden data failed authentication.")
+
+    # Open the first segment right away, so a tampered header or a carrier
+    # without hidden data is rejected before any output is written
+    segments = enumerate(split_segments(reader.remaining(), AEAD_SEGMENT_SIZE + AEAD_TAG_SIZE))
+    counter, (segment, final) = next(segments)
+    first_segment = open_segment(counter, segment, final)
+
+    def opened_segments():
+        yield first_segment
+        for counter, (segment, final) in segments:
+            yield open_segment(counter, segment, final)
+
+    def decrypt_chunks():
+        decompressor = create_decompressor(codec)
+
+        # Every segment is authenticated before it reaches the decompressor
+        for data in opened_segments():
+            with stage('decompress'):
+                decompressed_chunk = decompressor.decompress(data)
+            if decompressed_chunk:
+                count('secret', len(decompressed_chunk))
+                yield decompressed_chunk
+
+        # lzma decompressors have nothing left to flush
+        with stage('decompress'):
+            decompressed_chunk = decompressor.flush() if hasattr(decompressor, 'flush') else b''
+        count('secret', len(decompressed_chunk))
+        yield decompressed_chunk
+        if not decompressor.eof:
+            raise ValueError("Hidden data is truncated.")
+
+    return decrypt_chunks()
+
+
+def decrypt_stream(chunks, encrypted_session_key_size, private_key):
+    # Incremental pipeline: parse the header from the payload chunks, then run
+    # the rest through the AES decryptor, the unpadder and a decompressobj a
+    # chunk at a time (AEAD containers go through decrypt_aead_chunks instead).
+    # Returns the filename and an iterator over the file data
+    reader = ChunkReader(chunks)
+
+    # Versioned containers start with the magic, legacy ones with the filename size
+    prefix = reader.read(4)
+    if prefix == SHARD_MAGIC:
+        raise ValueError("The carrier holds one shard of a split secret, extract it together with the other shards.")
+    codec = CODEC_ZLIB
+    if prefix == CONTAINER_MAGIC:
+        version = reader.read(1)[0]
+        if version > CONTAINER_VERSION:
+            raise ValueError(f"Unsupported container version: {version}")
+        # Followed by the codec the secret was compressed with
+        if version >= CODEC_CONTAINER_VERSION:
+            codec = reader.read(1)[0]
+        prefix = reader.read(4)
+    else:
+        version = LEGACY_CONTAINER_VERSION
 
     # Extract the filename size and filename
-    filename_size = int.from_bytes(data_to_decode[:4], 'big')
-    filename = data_to_decode[4:4 + filename_size].decode()
-    
-    # Extract the session key, salt, iv, and encrypted data
-    offset = 4 + filename_size
-    encrypted_session_key = data_to_decode[offset:offset + encrypted_session_key_size]
-    salt = data_to_decode[offset + encrypted_session_key_size:offset + encrypted_session_key_size + 16]
-    iv = data_to_decode[offset + encrypted_session_key_size + 16:offset + encrypted_session_key_size + 32]
-    encrypted_data = data_to_decode[offset + encrypted_session_key_size + 32:]
-    
-    # Decrypt the data
-    decrypted_data = decrypt_data(encrypted_session_key, salt, iv, encrypted_data, private_key)
-    
-    # Decompress the decrypted data
-    decompressed_data = zlib.decompress(decrypted_data)
+    filename_size = int.from_bytes(prefix, 'big')
+    filename = reader.read(filename_size)
+
+    if version >= AEAD_CONTAINER_VERSION:
+        filedata = decrypt_aead_chunks(reader, filename, encrypted_session_key_size, private_key, version, codec)
+        return filename.decode(), filedata
+    filename = filename.decode()
+
+    # Extract the session key, salt and iv
+    encrypted_session_key = reader.read(encrypted_session_key_size)
+    salt = reader.read(16)
+    iv = reader.read(16)
+    decryptor = create_decryptor(encrypted_session_key, salt, iv, private_key, version)
+
+    def decrypt_chunks():
+        unpadder = PKCS7(algorithms.AES.block_size).unpadder()
+        decompressor = zlib.decompressobj()
+
+        # Decrypt and decompress the encrypted data
+        for chunk in reader.remaining():
+            with stage('decrypt'):
+                decrypted_chunk = unpadder.update(decryptor.update(chunk))
+            with stage('decompress'):
+                decompressed_chunk = decompressor.decompress(decrypted_chunk)
+            if decompressed_chunk:
+                count('secret', len(decompressed_chunk))
+                yield decompressed_chunk
+
+        with stage('decrypt'):
+            decrypted_chunk = unpadder.update(decryptor.finalize()) + unpadder.finalize()
+        with stage('decompress'):
+            decompressed_chunk = decompressor.decompress(decrypted_chunk) + decompressor.flush()
+        count('secret', len(decompressed_chunk))
+        yield decompressed_chunk
+        if not decompressor.eof:
+            raise ValueError("Hidden data is truncated.")
+
+    return filename, decrypt_chunks()
+
+
+def decrypt_postprocess(extracted_bytes, encrypted_session_key_size, private_key):
+    # Run the pipeline over the extracted bytes and join the file data in a single copy
+    filename, chunks = decrypt_stream([bytes(extracted_bytes)], encrypted_session_key_size, private_key)
+    decompressed_data = b''.join(chunks)
     
-    return decompressed_data, filename
\ No newline at end of file
+    return decompressed_data, filename
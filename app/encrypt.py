@@ -1,59 +1,270 @@
 import os
 import zlib
+import lzma
+import tempfile
+import numpy as np
 from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.backends import default_backend
+from timings import stage, count
+from util import read_chunks, data_size, sample_data, byte_entropy, split_segments, segment_nonce, derive_key, key_id, CONTAINER_MAGIC, CONTAINER_VERSION, LEGACY_CONTAINER_VERSION, AEAD_CONTAINER_VERSION, CODEC_CONTAINER_VERSION, RECIPIENTS_CONTAINER_VERSION, KEY_ID_SIZE, AEAD_SEGMENT_SIZE, AEAD_TAG_SIZE, NONCE_PREFIX_SIZE, CODEC_NONE, CODEC_ZLIB, CODEC_LZMA, LZMA_FILTERS
 
-def encrypt_data(data, public_key):
+# Codec and level of every compression mode. auto samples the secret and
+# picks none, fast or zlib: data that is already compressed (JPEGs, archives,
+# video) is stored as is, since zlib would only burn CPU and grow it
+COMPRESSION_MODES = {
+    'none': (CODEC_NONE, 0),
+    'fast': (CODEC_ZLIB, 1),
+    'zlib': (CODEC_ZLIB, 6),
+    'lzma': (CODEC_LZMA, 6),
+}
+DEFAULT_COMPRESSION = 'auto'
+COMPRESSION_CHOICES = [DEFAULT_COMPRESSION] + list(COMPRESSION_MODES)
+
+# A sample with fewer bits per byte than this is compressed without a trial
+# run (text, logs, sparse data). Otherwise the sample is compressed with the
+# fastest zlib level: when that saves less than STORE_RATIO the secret is
+# stored, when it saves less than FAST_RATIO the fastest level is used
+LOW_ENTROPY = 6.0
+STORE_RATIO = 0.97
+FAST_RATIO = 0.85
+
+# The recipient table counts its entries in two bytes
+MAX_RECIPIENTS = 0xFFFF
+
+def recipient_keys(public_key):
+    # The public keys a payload is encrypted for (a key or a list of keys) by
+    # key ID, in the given order. A key given twice gets a single slot
+    keys = {}
+    for key in public_key if isinstance(public_key, (list, tuple)) else [public_key]:
+        keys.setdefault(key_id(key), key)
+    if not keys:
+        raise ValueError("At least one public key is needed.")
+    if len(keys) > MAX_RECIPIENTS:
+        raise ValueError(f"A payload can't be encrypted for more than {MAX_RECIPIENTS} public keys.")
+    return keys
+
+def single_recipient(public_key):
+    # The one public key of a container from before the recipient table
+    keys = list(recipient_keys(public_key).values())
+    if len(keys) > 1:
+        raise ValueError(f"Containers before version {RECIPIENTS_CONTAINER_VERSION} can only be encrypted for one public key.")
+    return keys[0]
+
+def wrapped_key_size(public_key):
+    # Bytes taken by the wrapped session keys, and the number of recipients
+    keys = recipient_keys(public_key).values()
+    return sum(key.key_size // 8 for key in keys), len(keys)
+
+def wrap_session_key(session_key, public_key):
+    # Encrypt the session key with RSA
+    with stage('rsa'):
+        return public_key.encrypt(
+            session_key,
+            padding.OAEP(
+                mgf=padding.MGF1(algorithm=hashes.SHA256()),
+                algorithm=hashes.SHA256(),
+                label=None
+            )
+        )
+
+def create_session_key(public_key):
     # Generate a random session key
     session_key = os.urandom(32)  # 32 bytes for 256-bit key
     
+    return session_key, wrap_session_key(session_key, public_key)
+
+def create_recipient_table(public_key):
+    # Generate a session key and wrap it for every recipient. Returns it with
+    # the header fields that hold it: the number of recipients, the table of
+    # key IDs and wrapped key sizes, then the wrapped keys in table order
+    keys = recipient_keys(public_key)
+    session_key = os.urandom(32)
+    wrapped_keys = [wrap_session_key(session_key, key) for key in keys.values()]
+
+    table = len(keys).to_bytes(2, 'big')
+    for recipient_id, wrapped_key in zip(keys, wrapped_keys):
+        table += recipient_id + len(wrapped_key).to_bytes(2, 'big')
+    return session_key, table + b''.join(wrapped_keys)
+
+def create_encryptor(public_key, version=CONTAINER_VERSION):
+    session_key, encrypted_session_key = create_session_key(public_key)
+    
     # Derive a symmetric key from the session key
     salt = os.urandom(16)  # 16 bytes for 128-bit salt
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        length=32,
-        salt=salt,
-        iterations=200000,  # Increased iterations for added security
-        backend=default_backend()
-    )
-    key = kdf.derive(session_key)
+    key = derive_key(session_key, salt, version)
     
-    # Encrypt the data with AES
+    # Create the AES encryptor
     iv = os.urandom(16)  # 16 bytes for 128-bit IV
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
     encryptor = cipher.encryptor()
-    padder = PKCS7(algorithms.AES.block_size).padder()
-    padded_data = padder.update(data) + padder.finalize()
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
     
-    # Encrypt the session key with RSA
-    encrypted_session_key = public_key.encrypt(
-        session_key,
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA256()),
-            algorithm=hashes.SHA256(),
-            label=None
-        )
-    )
-    
-    return encrypted_session_key, salt, iv, encrypted_data
+    return encrypted_session_key, salt, iv, encryptor
 
-def encrypt_preprocess(file_bytes, filename, public_key):
-    
-    # Compress the file
-    compressed_data = zlib.compress(file_bytes)
+def choose_compression(file_data, compression=DEFAULT_COMPRESSION):
+    # Codec and level for the secret (bytes or a binary file)
+    if compression != DEFAULT_COMPRESSION:
+        if compression not in COMPRESSION_MODES:
+            raise ValueError(f"Unknown compression: {compression}, use one of {', '.join(COMPRESSION_CHOICES)}.")
+        return COMPRESSION_MODES[compression]
 
-    # Encrypt the compressed data
-    encrypted_session_key, salt, iv, encrypted_data = encrypt_data(compressed_data, public_key)
-    
-    # Get the filename to store
+    with stage('compress'):
+        sample = sample_data(file_data)
+        # A secret that can't be sampled without reading it gets the default
+        if sample is None or byte_entropy(sample) < LOW_ENTROPY:
+            return COMPRESSION_MODES['zlib']
+        ratio = len(zlib.compress(sample, 1)) / len(sample)
+    if ratio >= STORE_RATIO:
+        return COMPRESSION_MODES['none']
+    if ratio >= FAST_RATIO:
+        return COMPRESSION_MODES['fast']
+    return COMPRESSION_MODES['zlib']
+
+def compress_chunks(file_data, codec=CODEC_ZLIB, level=zlib.Z_DEFAULT_COMPRESSION):
+    if codec == CODEC_NONE:
+        for chunk in read_chunks(file_data):
+            count('secret', len(chunk))
+            yield chunk
+        return
+
+    if codec == CODEC_LZMA:
+        compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=LZMA_FILTERS)
+    else:
+        compressor = zlib.compressobj(level)
+    for chunk in read_chunks(file_data):
+        count('secret', len(chunk))
+        with stage('compress'):
+            compressed_chunk = compressor.compress(chunk)
+        yield compressed_chunk
+    with stage('compress'):
+        compressed_chunk = compressor.flush()
+    yield compressed_chunk
+
+def encrypt_aead_stream(file_data, filename, public_key, version=CONTAINER_VERSION, compression=DEFAULT_COMPRESSION):
+    # AEAD pipeline: the compressed secret is cut into segments that are each
+    # sealed with AES-GCM, so no padding is needed. Every segment authenticates
+    # the whole header, and its nonce carries the segment number and a final
+    # flag, so segments cannot be altered, reordered or cut off
+    codec, level = choose_compression(file_data, compression) if version >= CODEC_CONTAINER_VERSION else COMPRESSION_MODES['zlib']
+    if version >= RECIPIENTS_CONTAINER_VERSION:
+        # The data is encrypted once, only the session key is wrapped for every recipient
+        session_key, encrypted_session_key = create_recipient_table(public_key)
+    else:
+        session_key, encrypted_session_key = create_session_key(single_recipient(public_key))
+    salt = os.urandom(16)
+    aesgcm = AESGCM(derive_key(session_key, salt, version))
+    nonce_prefix = os.urandom(NONCE_PREFIX_SIZE)
+
+    # The header is the magic, version, codec, filename, encrypted session key
+    # (the recipient table and wrapped keys from RECIPIENTS_CONTAINER_VERSION on), salt and nonce prefix
+    prefix = CONTAINER_MAGIC + bytes([version]) + (bytes([codec]) if version >= CODEC_CONTAINER_VERSION else b'')
+    header = prefix + len(filename).to_bytes(4, 'big') + filename + encrypted_session_key + salt + nonce_prefix
+    yield header
+
+    # Followed by the sealed segments of the compressed data
+    for counter, (segment, final) in enumerate(split_segments(compress_chunks(file_data, codec, level), AEAD_SEGMENT_SIZE)):
+        with stage('encrypt'):
+            sealed_segment = aesgcm.encrypt(segment_nonce(nonce_prefix, counter, final), segment, header)
+        yield sealed_segment
+
+def encrypt_stream(file_data, filename, public_key, version=CONTAINER_VERSION, compression=DEFAULT_COMPRESSION):
+    if version >= AEAD_CONTAINER_VERSION:
+        yield from encrypt_aead_stream(file_data, filename, public_key, version, compression)
+        return
+
+    # Incremental pipeline: the secret (bytes or a binary file) goes through a
+    # compressobj, the padder and the AES encryptor a chunk at a time, and the
+    # payload is yielded piece by piece so it never has to be held in memory
+    encrypted_session_key, salt, iv, encryptor = create_encryptor(single_recipient(public_key), version)
+    compressor = zlib.compressobj()
+    padder = PKCS7(algorithms.AES.block_size).padder()
+
+    # Versioned containers start with the magic and the version byte
+    prefix = b'' if version == LEGACY_CONTAINER_VERSION else CONTAINER_MAGIC + bytes([version])
+
+    # The filename, encrypted session key, salt and iv come first
     filename_size = len(filename)
+    yield prefix + filename_size.to_bytes(4, 'big') + filename + encrypted_session_key + salt + iv
+
+    # Followed by the compressed and encrypted data
+    for chunk in read_chunks(file_data):
+        count('secret', len(chunk))
+        with stage('compress'):
+            compressed_chunk = compressor.compress(chunk)
+        with stage('encrypt'):
+            encrypted_chunk = encryptor.update(padder.update(compressed_chunk))
+        if encrypted_chunk:
+            yield encrypted_chunk
+
+    with stage('compress'):
+        compressed_chunk = compressor.flush()
+    with stage('encrypt'):
+        encrypted_chunk = encryptor.update(padder.update(compressed_chunk) + padder.finalize()) + encryptor.finalize()
+    yield encrypted_chunk
+
+def max_payload_size(secret_size, filename_size, key_size, version=CONTAINER_VERSION, compression=DEFAULT_COMPRESSION, recipients=1):
+    # Largest payload a secret of this size can turn into, i.e. when it does
+    # not compress at all. key_size is the size of all the wrapped session
+    # keys together. zlib never grows data by more than its compressBound
+    # (auto picks zlib or nothing), and LZMA2 stores incompressible data in
+    # chunks with a few bytes of framing each
+    if version >= CODEC_CONTAINER_VERSION and compression == 'none':
+        compressed = secret_size
+    elif version >= CODEC_CONTAINER_VERSION and compression == 'lzma':
+        compressed = secret_size + (secret_size >> 12) + 64
+    else:
+        compressed = secret_size + (secret_size >> 12) + (secret_size >> 14) + (secret_size >> 25) + 13
+    if version >= AEAD_CONTAINER_VERSION:
+        header = len(CONTAINER_MAGIC) + 1 + (version >= CODEC_CONTAINER_VERSION) + 4 + filename_size + key_size + 16 + NONCE_PREFIX_SIZE
+        if version >= RECIPIENTS_CONTAINER_VERSION:
+            header += 2 + recipients * (KEY_ID_SIZE + 2)
+        return header + compressed + AEAD_TAG_SIZE * max(1, -(-compressed // AEAD_SEGMENT_SIZE))
 
-    # Concatenate the encrypted session key, salt, iv, and encrypted data and return it
-    return (filename_size.to_bytes(4, 'big') + filename +
-                      encrypted_session_key + salt + iv + encrypted_data)
+    # CBC containers hold the salt and iv, and pad the data to whole blocks
+    prefix = 0 if version == LEGACY_CONTAINER_VERSION else len(CONTAINER_MAGIC) + 1
+    return prefix + 4 + filename_size + key_size + 16 + 16 + (compressed // 16 + 1) * 16
 
+def max_secret_size(capacity, filename_size, key_size, version=CONTAINER_VERSION, compression=DEFAULT_COMPRESSION, recipients=1):
+    # Largest secret that fits in `capacity` payload bytes however badly it
+    # compresses, or -1 when not even an empty secret fits
+    low, high = -1, capacity
+    while low < high:
+        middle = (low + high + 1) // 2
+        if max_payload_size(middle, filename_size, key_size, version, compression, recipients) <= capacity:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def spool_payload(chunks, capacity=None):
+    # Write the payload to a temporary file and memory-map it, so it can be
+    # read in any order. Gives up as soon as it outgrows the capacity
+    with tempfile.TemporaryFile() as spool:
+        size = 0
+        for chunk in chunks:
+            size += len(chunk)
+            if capacity is not None and size > capacity:
+                raise ValueError(f"Carrier is not large enough to hide the file (it holds {capacity} bytes of payload).")
+            spool.write(chunk)
+        spool.flush()
+        return np.memmap(spool, dtype=np.uint8, mode='r')
+
+def encrypt_for_carrier(file_data, filename, public_key, capacity, version=CONTAINER_VERSION, compression=DEFAULT_COMPRESSION):
+    # Payload chunks for a carrier that holds `capacity` payload bytes. A
+    # secret that fits even if it does not compress is streamed, anything
+    # else is compressed and encrypted up front, so a secret that is too
+    # large is rejected before the carrier is decoded
+    secret_size = data_size(file_data)
+    chunks = encrypt_stream(file_data, filename, public_key, version, compression)
+    key_size, recipients = wrapped_key_size(public_key)
+    if secret_size is not None and max_payload_size(secret_size, len(filename), key_size, version, compression, recipients) <= capacity:
+        return chunks
+    return [spool_payload(chunks, capacity)]
+
+def encrypt_preprocess(file_bytes, filename, public_key, version=CONTAINER_VERSION, compression=DEFAULT_COMPRESSION):
+    
+    # Run the pipeline and join the pieces in a single copy
+    return b''.join(encrypt_stream(file_bytes, filename, public_key, version, compression))
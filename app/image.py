@@ -1,51 +1,130 @@
 import os
-import random
+import shutil
 from PIL import Image
 import numpy as np
-from util import compute_seed_from_image_dimensions, load_private_key, load_public_key
-from encrypt import encrypt_preprocess
-from decrypt import decrypt_postprocess
-
-
-def load_file_encrypt(key_path, image_path, file_to_hide):
-    # Load the public key
-    public_key = load_public_key(key_path)
+from util import compute_seed_from_image_dimensions, load_private_key, load_public_key, confirm_overwrite
+from encrypt import encrypt_stream, encrypt_for_carrier, spool_payload, DEFAULT_COMPRESSION
+from decrypt import decrypt_stream
+from lsb import payload_capacity, embed_payload, embed_payload_chunks, extract_payload_chunks, embed_payload_blocks, extract_payload_strips
+from rawimage import map_pixels
+from tiles import open_strips, TILE_PIXELS
+from timings import stage
+
+# Band index of every channel that can carry hidden bits
+CHANNEL_BANDS = {'R': 0, 'G': 1, 'B': 2, 'A': 3}
+
+# Modes whose pixels are embedded in as they are, the gray band of an L
+# image counts as R. Other modes are converted to RGB first
+NATIVE_MODES = ('L', 'RGB', 'RGBA')
+
+# Save options of every output format for each encoding profile, trading
+# encode time for output size. All of them are lossless
+ENCODING_PROFILES = {
+    'fast': {
+        'PNG': {'compress_level': 1},
+        'TIFF': {'compression': 'raw'},
+        'TGA': {},
+        'BMP': {},
+    },
+    'balanced': {
+        'PNG': {'compress_level': 6},
+        'TIFF': {'compression': 'tiff_lzw'},
+        'TGA': {},
+        'BMP': {},
+    },
+    'smallest': {
+        'PNG': {'compress_level': 9, 'optimize': True},
+        'TIFF': {'compression': 'tiff_adobe_deflate'},
+        'TGA': {'compression': 'tga_rle'},
+        'BMP': {},
+    },
+}
+DEFAULT_ENCODING_PROFILE = 'balanced'
+
+
+def load_file_encrypt(key_path, image_path, file_to_hide, public_key=None):
+    # Load the public key, unless it was already loaded
+    if public_key is None:
+        public_key = load_public_key(key_path)
 
     # Read the original image
     img = Image.open(image_path)
  
-    # Read the file to hide
-    with open(file_to_hide, 'rb') as f:
-        file_bytes = f.read()
+    # Open the file to hide, it is read a chunk at a time while it is embedded
+    secret_file = open(file_to_hide, 'rb')
 
     # Get secret file name
     filename = os.path.basename(file_to_hide).encode()
 
-    return public_key, img, file_bytes, filename
+    return public_key, img, secret_file, filename
 
 
-def hide_file_in_img_util(img, imgname, file_to_hide, filename, public_key):
+def save_img(img, fp, host_format, profile=DEFAULT_ENCODING_PROFILE):
+    # Encode the image to a path or file object with the options of the profile
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile}, use one of {', '.join(ENCODING_PROFILES)}.")
+    options = ENCODING_PROFILES[profile].get(host_format)
+    if options is None:
+        # If the format is not one of the supported/expected formats, raise an error.
+        raise ValueError(f"Unsupported image format: {host_format}")
+
+    with stage('encode'):
+        img.save(fp, format=host_format, **options)
 
-    # Use the sum of the image dimensions as the seed
-    seed = compute_seed_from_image_dimensions(img)
-    prng = random.Random(seed)  # Create a new instance of a random number generator
 
+def channel_bands(channels, img):
+    # Map the requested channels onto RGBA band indices
+    channels = channels.upper()
+    if not channels or any(channel not in CHANNEL_BANDS for channel in channels):
+        raise ValueError("Channels must be a combination of R, G, B and A.")
+    bands = [CHANNEL_BANDS[channel] for channel in channels]
 
-    # Check if the image is in a mode that can be converted to RGB or RGBA
+    # The alpha channel is only safe to use if the image already carries one
+    if CHANNEL_BANDS['A'] in bands and img.mode != 'RGBA':
+        raise ValueError("The alpha channel can only be used for images that have one.")
+    return bands
+
+
+def image_capacity(img, channels='R', depth=1):
+    # Payload bytes the image can hold with this layout, only the header of
+    # the image (its mode and size) is needed
     if img.mode not in ['RGB', 'RGBA', 'P', 'L']:
         raise ValueError("Image mode must be RGB, RGBA, P (palette-based), or L (grayscale).")
+    width, height = img.size
+    return payload_capacity(width * height, channel_bands(channels, img), depth)
 
-    # Convert to RGB if it's P or L mode (palette-based or grayscale)
-    if img.mode == 'P' or img.mode == 'L':
-        img = img.convert('RGB')
 
-    # Convert to RGBA if not already in that format
-    if img.mode != 'RGBA':
-        img = img.convert('RGBA')
+def hide_file_in_img_util(img, imgname, file_to_hide, filename, public_key, channels='R', depth=1, compression=DEFAULT_COMPRESSION):
+
+    # Check if the image is in a mode that can be converted to RGB or RGBA
+    # and that the secret can fit before any pixel is decoded
+    capacity = image_capacity(img, channels, depth)
+
+    # Compress and encrypt the file (bytes or a binary file) chunk by chunk,
+    # unless it might not fit, in which case it is done up front
+    data_to_encode = encrypt_for_carrier(file_to_hide, filename, public_key, capacity, compression=compression)
+
+    return embed_chunks_in_img(img, imgname, data_to_encode, channels, depth)
+
+
+def embed_chunks_in_img(img, imgname, chunks, channels='R', depth=1):
+    # Embed a payload that is already compressed and encrypted, given as
+    # chunks, in the image. Returns the new image and the format to save it in
+
+    # Use the sum of the image dimensions as the seed
+    seed = compute_seed_from_image_dimensions(img)
+    bands = channel_bands(channels, img)
+
+    # This will give you the original format of the image, converted images don't keep it
+    host_format = img.format
+
+    # Work on the pixels in their own mode, so nothing is expanded to RGBA.
+    # Palette indices can't carry bits and grayscale images only have their
+    # R band, so those are converted to RGB when they need to be
+    if img.mode == 'P' or (img.mode == 'L' and max(bands) > 0):
+        with stage('decode'):
+            img = img.convert('RGB')
 
-    # This will give you the original format of the image
-    host_format = img.format  
-    
     # If the format is None, try to determine it from the file extension
     if host_format is None:
         file_extension = os.path.splitext(imgname)[1].lower()
@@ -62,172 +141,264 @@ def hide_file_in_img_util(img, imgname, file_to_hide, filename, public_key):
     if host_format not in supported_formats:
         raise ValueError(f"Unsupported image format: {host_format}")
         
-    pixels = np.array(img)
+    with stage('decode'):
+        pixels = np.array(img)
     
-    # get the binary representation of the file
-    data_to_encode = encrypt_preprocess(file_to_hide, filename, public_key)
-    
-    # Calculate the number of pixels needed
-    file_size = len(data_to_encode)
-    num_pixels_required = file_size * 8  # 8 bits per byte
-    if num_pixels_required > pixels.size // 4:  # Divide by 4 for RGBA channels
-        raise ValueError("Image is not large enough to hide the file.")
-
-    # Generate a list of unique indices to hide the data
-    pixel_indices = list(range(pixels.size // 4))
-    prng.shuffle(pixel_indices)  # Shuffle using the seeded PRNG
-
-    # Embed the file size in the first 64 pixels (8 bytes for file size)
-    for i in range(64):
-        idx = pixel_indices[i]
-        seventh_bit = ((pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0]) >> 1) & 0x1
-        xor_bit = seventh_bit ^ ((file_size >> (63 - i)) & 0x1)
-        if (pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0] & 0x1) != xor_bit:
-            pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0] ^= 0x1
-
-    # Embed each bit of the data to encode in the image using LSB matching
-    for i, byte in enumerate(data_to_encode):
-        for bit in range(8):
-            idx = pixel_indices[64 + i * 8 + bit]
-            seventh_bit = ((pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0]) >> 1) & 0x1
-            xor_bit = seventh_bit ^ ((byte >> (7 - bit)) & 0x1)
-            if (pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0] & 0x1) != xor_bit:
-                pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0] ^= 0x1
-
-    # Save the new image
-    new_img = Image.fromarray(pixels, 'RGBA')
+    # Embed every chunk in a flat (pixels, bands) view of the image as it is
+    # produced, at the pixels selected by the keyed permutation
+    embed_payload_chunks(pixels.reshape(-1, len(img.getbands())), seed, chunks, bands, depth)
+
+    # Save the new image in the same mode
+    new_img = Image.fromarray(pixels, img.mode)
 
     return new_img, host_format
 
 
+def hide_file_in_img_mmap(img, image_path, output_image_path, file_to_hide, filename, public_key, channels='R', depth=1, in_place=False,
+                          compression=DEFAULT_COMPRESSION):
+    # Memory-mapped variant of hide_file_in_img_util for uncompressed BMP, TGA
+    # and TIFF files: the carrier is copied to the output at the filesystem
+    # level (or, in place, the carrier itself is the output) and the hidden
+    # bits are written straight into the mapped pixel rows, so the image is
+    # never decoded, converted or encoded. Returns False, without doing any
+    # work, when the pixels are not stored raw
+    seed = compute_seed_from_image_dimensions(img)
+    capacity = image_capacity(img, channels, depth)
+    bands = channel_bands(channels, img)
+
+    # Grayscale carriers asked for color bands are converted, so decoded
+    carrier = map_pixels(img, image_path)
+    if carrier is None or max(bands) >= carrier.shape[1]:
+        return False
+
+    # Compress and encrypt the file first, so a secret that does not fit is
+    # rejected before the carrier is copied or modified
+    data_to_encode = spool_payload(encrypt_stream(file_to_hide, filename, public_key, compression=compression), capacity)
+
+    if not in_place:
+        with stage('encode'):
+            shutil.copyfile(image_path, output_image_path)
+    try:
+        # The copy has the same layout, so the header that was read applies to it
+        carrier = map_pixels(img, output_image_path, 'r+')
+        embed_payload(carrier, seed, data_to_encode, bands, depth)
+        with stage('encode'):
+            carrier.flush()
+    except Exception:
+        # Don't leave a half written carrier behind
+        if not in_place:
+            os.remove(output_image_path)
+        raise
+    return True
+
+
+def hide_file_in_img_stream(image_path, output_image_path, file_to_hide, filename, public_key, channels='R', depth=1,
+                            profile=DEFAULT_ENCODING_PROFILE, compression=DEFAULT_COMPRESSION):
+    # Tiled variant of hide_file_in_img_util for PNG and TIFF carriers too
+    # large to decode at once: a strip of rows is decoded, the bits that fall
+    # in it are embedded and it is encoded to the output before the next one
+    # is decoded, so memory is bounded by the strip size. The pixels are
+    # selected exactly like on the whole-image path, either reads the output
+    source = open_strips(image_path)
+    if profile not in ENCODING_PROFILES:
+        raise ValueError(f"Unknown encoding profile: {profile}, use one of {', '.join(ENCODING_PROFILES)}.")
+    seed = compute_seed_from_image_dimensions(source)
+    capacity = image_capacity(source, channels, depth)
+    bands = channel_bands(channels, source)
+    if max(bands) >= source.bands:
+        raise ValueError("Grayscale carriers only have the R channel when they are processed in strips.")
+    width, height = source.size
+
+    # The strips need random access to the payload, so spool the compressed
+    # and encrypted file to a temporary file and memory-map it
+    data_to_encode = spool_payload(encrypt_stream(file_to_hide, filename, public_key, compression=compression), capacity)
+
+    blocks = (pixels.reshape(-1, source.bands) for _, pixels in source.read_strips())
+    embedded = embed_payload_blocks(blocks, width * height, seed, data_to_encode, bands, depth, TILE_PIXELS)
+    try:
+        source.write(output_image_path, (block.reshape(-1, width, source.bands) for block in embedded), ENCODING_PROFILES[profile][source.format])
+    except Exception:
+        # Don't leave a half written image behind
+        if os.path.exists(output_image_path):
+            os.remove(output_image_path)
+        raise
+
+
+def hide_file_in_img(image_path, file_to_hide, output_image_path, public_key_path, channels='R', depth=1, overwrite=None, public_key=None,
+                     profile=DEFAULT_ENCODING_PROFILE, mmap=False, in_place=False, compression=DEFAULT_COMPRESSION, stream=False):
+
+    # Stream mode writes a new output, mmap and in-place embedding write into
+    # a copy of the carrier or the carrier itself
+    if stream and (mmap or in_place):
+        raise ValueError("Stream mode can't be combined with mmap or in-place embedding.")
+
+    # In stream mode the carrier is never opened as a whole, the output is
+    # written while the carrier is still being read so it can't be the carrier
+    if stream:
+        if public_key is None:
+            public_key = load_public_key(public_key_path)
+        if os.path.exists(output_image_path) and os.path.samefile(image_path, output_image_path):
+            raise ValueError("The output can't be the carrier itself in stream mode.")
+        if not confirm_overwrite(output_image_path, overwrite):
+            print("Hiding cancelled.")
+            return
+        with open(file_to_hide, 'rb') as secret_file:
+            hide_file_in_img_stream(image_path, output_image_path, secret_file, os.path.basename(file_to_hide).encode(), public_key,
+                                    channels, depth, profile, compression)
+        print(f"File '{file_to_hide}' has been successfully hidden in '{output_image_path}'.")
+        return output_image_path
 
-def hide_file_in_img(image_path, file_to_hide, output_image_path, public_key_path):
-    
     # Load the files
-    public_key, img, file_bytes, filename = load_file_encrypt(public_key_path, image_path, file_to_hide)
-    
-    # Get the name of input image
-    imgname = os.path.basename(file_to_hide).encode()
-
-    # Generate new image along with its formats name
-    new_img, host_format = hide_file_in_img_util(img, imgname, file_bytes, filename, public_key)
-
-    # Check if the file already exists and prompt the user
-    if os.path.exists(output_image_path):
-        overwrite = input(f"The file '{output_image_path}' already exists. Overwrite? (y/n): ").lower()
-        if overwrite != 'y':
-            print("Extraction cancelled.")
-            return
+    public_key, img, secret_file, filename = load_file_encrypt(public_key_path, image_path, file_to_hide, public_key)
     
-    if host_format == 'PNG':
-        new_img.save(output_image_path, format='PNG', optimize=True)
-    elif host_format == 'BMP':
-        new_img.save(output_image_path, format='BMP', optimize=True)
-    elif host_format == 'TGA':
-        new_img.save(output_image_path, format='TGA', optimize=True)
-    elif host_format == 'TIFF':
-        new_img.save(output_image_path, format='TIFF', optimize=True)
-    else:
-        # If the format is not one of the supported/expected formats, raise an error.
-        raise ValueError(f"Unsupported image format: {host_format}")
+    # Get the name of input image, its extension tells the format when PIL can't
+    imgname = os.path.basename(image_path)
+
+    # Embedding in place modifies the carrier itself, which was asked for
+    # explicitly. Otherwise check if the file already exists and prompt the
+    # user before doing the work
+    if in_place:
+        if not (os.path.exists(output_image_path) and os.path.samefile(image_path, output_image_path)):
+            secret_file.close()
+            raise ValueError("Embedding in place needs the output to be the carrier itself.")
+    elif mmap and os.path.exists(output_image_path) and os.path.samefile(image_path, output_image_path):
+        secret_file.close()
+        raise ValueError("The output can't be the carrier itself in mmap mode, use in-place embedding.")
+    elif not confirm_overwrite(output_image_path, overwrite):
+        secret_file.close()
+        print("Extraction cancelled.")
+        return
+
+    # Uncompressed carriers can be embedded into directly, the output then
+    # keeps the carrier's own encoding. Anything else is decoded and encoded
+    with secret_file:
+        if (mmap or in_place) and hide_file_in_img_mmap(img, image_path, output_image_path, secret_file, filename, public_key,
+                                                        channels, depth, in_place, compression):
+            host_format = None
+        elif in_place:
+            raise ValueError("Embedding in place needs an uncompressed BMP, TGA or TIFF carrier.")
+        else:
+            # Generate new image along with its formats name
+            new_img, host_format = hide_file_in_img_util(img, imgname, secret_file, filename, public_key, channels, depth, compression)
+
+    if host_format is not None:
+        save_img(new_img, output_image_path, host_format, profile)
 
     print(f"File '{file_to_hide}' has been successfully hidden in '{output_image_path}'.")
+    return output_image_path
 
 
-def load_file_decrypt(key_path, passphrase, image_path):
-    # Load the public key
-    private_key = load_private_key(key_path, passphrase)
+def load_file_decrypt(key_path, passphrase, image_path, private_key=None):
+    # Load the private key, unless it was already loaded
+    if private_key is None:
+        private_key = load_private_key(key_path, passphrase)
 
     # Open the audio
     img = Image.open(image_path)
 
     return private_key, img
 
-def extract_file_from_img_util(img, private_key):
+def img_carrier(img, image_path=None):
+    # The flat (pixels, bands) carrier of an L, RGB or RGBA image that may
+    # hold hidden bits. Uncompressed files on disk are read through a memory
+    # map, only the pages holding hidden bits are touched and nothing is decoded
+    if img.mode not in NATIVE_MODES:
+        raise ValueError("Image must be in L, RGB or RGBA format.")
+
+    carrier = map_pixels(img, image_path) if image_path else None
+    if carrier is not None:
+        return carrier
+
+    with stage('decode'):
+        pixels = np.array(img)
+
+    # A flat (pixels, bands) view of the image in its own mode
+    return pixels.reshape(-1, len(img.getbands()))
+
+def extract_file_chunks_from_img_util(img, private_key, image_path=None):
 
     # Determine the size of the encrypted session key based on the private key size
     encrypted_session_key_size = private_key.key_size // 8
     
     # Use the sum of the image dimensions as the seed
     seed = compute_seed_from_image_dimensions(img)
-    prng = random.Random(seed)  # Create a new instance of a random number generator
 
-    if img.mode not in ['RGB', 'RGBA']:
-        raise ValueError("Image must be in RGB or RGBA format.")
-    
-    # Convert to RGBA if not already in that format
-    if img.mode != 'RGBA':
-        img = img.convert('RGBA')
-    
-    pixels = np.array(img)
-    
-    # Flatten the image array for easier processing
-    flat_pixels = pixels.flatten()
-    
-    # Use only the red channel for RGBA
-    channel_multiplier = 4
+    carrier = img_carrier(img, image_path)
 
-    # Extract the file size from the first 64 pixels
-    file_size = 0
-    for i in range(64):
-        file_size = (file_size << 1) | (flat_pixels[i * channel_multiplier] & 0x1)
-    
-    # Calculate the number of bytes that can be extracted
-    num_bytes_to_extract = file_size
-    
-    # Prepare a list to store the extracted bytes
-    extracted_bytes = []
-
-    # Generate a list of unique indices to extract the data
-    pixel_indices = list(range(pixels.size // 4))
-    prng.shuffle(pixel_indices)  # Shuffle using the seeded PRNG
-
-    # Extract the file size from the first 64 pixels
-    file_size = 0
-    for i in range(64):
-        idx = pixel_indices[i]
-        seventh_bit = (((pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0]) >> 1) & 0x1)
-        xor_bit = (pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0] & 0x1) ^ seventh_bit
-        file_size = (file_size << 1) | xor_bit
-
-    # Calculate the number of bytes that can be extracted
-    num_bytes_to_extract = file_size
-
-    # Extract the hidden bits and reconstruct the bytes using the same indices
-    extracted_bytes = []
-    for i in range(num_bytes_to_extract):
-        byte = 0
-        for bit in range(8):
-            idx = pixel_indices[64 + i * 8 + bit]
-            seventh_bit = (((pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0]) >> 1) & 0x1)
-            xor_bit = (pixels[idx // pixels.shape[1], idx % pixels.shape[1], 0] & 0x1) ^ seventh_bit
-            byte = (byte << 1) | xor_bit
-        extracted_bytes.append(byte)
-    
-    # Get the filename and filedata from extracted bytes
-    filedata, filename = decrypt_postprocess(extracted_bytes, encrypted_session_key_size, private_key)
+    # Read the hidden bytes a chunk at a time, the layout is taken from the
+    # embedded frame header
+    extracted_bytes = extract_payload_chunks(carrier, seed)
+
+    # Get the filename and an iterator over the filedata from extracted bytes
+    filename, filedata = decrypt_stream(extracted_bytes, encrypted_session_key_size, private_key)
     
-    return filedata, filename
+    return filename, filedata
 
 
-def extract_file_from_img(img_path, output_file_path, private_key_path, passphrase):
-    private_key, img = load_file_decrypt(private_key_path, passphrase, img_path)
+def extract_file_chunks_from_img_stream(image_path, private_key):
+    # Tiled variant of extract_file_chunks_from_img_util for PNG and TIFF
+    # carriers too large to decode at once, only the strips holding hidden
+    # bits are decoded (for a PNG, the ones before them too), a strip at a time
 
-    filedata, filename = extract_file_from_img_util(img, private_key)
+    # Determine the size of the encrypted session key based on the private key size
+    encrypted_session_key_size = private_key.key_size // 8
+
+    source = open_strips(image_path)
+    seed = compute_seed_from_image_dimensions(source)
+    width, height = source.size
+
+    def read_blocks(units):
+        for start, pixels in source.read_strips(units):
+            yield start, pixels.reshape(-1, source.bands)
+
+    # Read the hidden bytes at the pixels selected by the keyed permutation
+    extracted_bytes = extract_payload_strips(read_blocks, width * height, source.bands, seed, TILE_PIXELS)
+
+    # Get the filename and an iterator over the filedata from extracted bytes
+    filename, filedata = decrypt_stream([extracted_bytes], encrypted_session_key_size, private_key)
+
+    return filename, filedata
+
+
+def extract_file_from_img_util(img, private_key):
+    filename, filedata = extract_file_chunks_from_img_util(img, private_key)
+
+    return b''.join(filedata), filename
+
+
+def extract_file_from_img(img_path, output_file_path, private_key_path, passphrase, overwrite=None, private_key=None, stream=False):
+    # Check an explicit output before any work is done, so a skipped
+    # extraction doesn't pay for decoding and decrypting the carrier
+    if output_file_path and not confirm_overwrite(output_file_path, overwrite):
+        print("Extraction cancelled.")
+        return
+
+    if stream:
+        # The carrier is never opened as a whole
+        if private_key is None:
+            private_key = load_private_key(private_key_path, passphrase)
+        filename, filedata = extract_file_chunks_from_img_stream(img_path, private_key)
+    else:
+        private_key, img = load_file_decrypt(private_key_path, passphrase, img_path, private_key)
+        filename, filedata = extract_file_chunks_from_img_util(img, private_key, img_path)
     
-    # If no output file path is provided, use the extracted filename
+    # If no output file path is provided, use the extracted filename, and
+    # check if that file already exists
     if not output_file_path:
         output_file_path = os.path.join(os.getcwd(), filename)
-
-    # Check if the file already exists and prompt the user
-    if os.path.exists(output_file_path):
-        overwrite = input(f"The file '{output_file_path}' already exists. Overwrite? (y/n): ").lower()
-        if overwrite != 'y':
+        if not confirm_overwrite(output_file_path, overwrite):
             print("Extraction cancelled.")
             return
         
-    # Write the decompressed data to the output file
-    with open(output_file_path, 'wb') as f:
-        f.write(filedata)
+    # Write the decompressed data to the output file a chunk at a time
+    try:
+        with open(output_file_path, 'wb') as f:
+            for chunk in filedata:
+                f.write(chunk)
+    except Exception:
+        # Don't leave a partially extracted file behind
+        os.remove(output_file_path)
+        raise
 
     print(f"File extracted to {output_file_path}")
+    return output_file_path
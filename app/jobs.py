@@ -0,0 +1,204 @@
+import os
+import time
+import uuid
+import shutil
+import tempfile
+import threading
+import wave
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from PIL import Image
+from keycache import KeyCache
+from image import hide_file_in_img_util, extract_file_chunks_from_img_util, save_img, DEFAULT_ENCODING_PROFILE
+from audio import hide_file_in_audio_stream, extract_file_chunks_from_audio_stream
+from encrypt import DEFAULT_COMPRESSION
+
+# Where the inputs and results of the jobs are kept
+JOB_DIR = os.environ.get('STEGANO_JOB_DIR', os.path.join(tempfile.gettempdir(), 'stegano-jobs'))
+
+# Number of worker processes, the most jobs that can be queued or running at
+# once, and how long a finished job's result is kept (seconds)
+JOB_WORKERS = os.cpu_count() or 1
+MAX_PENDING_JOBS = 64
+JOB_RESULT_TTL = 3600
+
+# Every worker process parses each key once and reuses it for its later jobs
+_key_cache = None
+
+
+def _init_worker():
+    global _key_cache
+    _key_cache = KeyCache()
+
+
+def run_job(spec):
+    # Run one job in a worker process. Inputs and the result are files in the
+    # job directory, so nothing large is sent between processes. Returns the
+    # name the result is downloaded under
+    with open(spec['key'], 'rb') as key_file:
+        key_pem = key_file.read()
+
+    if spec['action'] == 'hide':
+        public_key = _key_cache.public_key(key_pem)
+        with open(spec['secret'], 'rb') as secret_file:
+            if spec['type'] == 'audio':
+                # Embed block by block so memory use stays bounded for long recordings
+                with wave.open(spec['carrier'], 'rb') as audio, wave.open(spec['result'], 'wb') as output_audio:
+                    hide_file_in_audio_stream(audio, output_audio, secret_file, spec['filename'], public_key, depth=spec['bits'],
+                                              compression=spec['compression'])
+            else:
+                with Image.open(spec['carrier']) as image:
+                    output, host_format = hide_file_in_img_util(
+                        image, spec['carrier_name'], secret_file, spec['filename'], public_key, spec['channels'], spec['bits'], spec['compression'])
+                save_img(output, spec['result'], host_format, spec['profile'])
+        return spec['output']
+
+    private_key = _key_cache.private_key(key_pem, spec['passphrase'])
+    if spec['type'] == 'audio':
+        with wave.open(spec['carrier'], 'rb') as audio:
+            filename, filedata = extract_file_chunks_from_audio_stream(audio, private_key)
+            _write_chunks(spec['result'], filedata)
+    else:
+        with Image.open(spec['carrier']) as image:
+            filename, filedata = extract_file_chunks_from_img_util(image, private_key, spec['carrier'])
+            _write_chunks(spec['result'], filedata)
+    return spec['output'] or filename
+
+
+def _write_chunks(path, chunks):
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobManager:
+    # Runs hide and extract jobs on a bounded process pool. Every job gets a
+    # directory under root holding its uploaded inputs (removed once the job
+    # finishes) and its result, which is deleted ttl seconds after the job
+    # finished. Job states are queued, running, done and failed.
+
+    def __init__(self, root=JOB_DIR, workers=JOB_WORKERS, max_pending=MAX_PENDING_JOBS, ttl=JOB_RESULT_TTL):
+        self.root = root
+        self.workers = workers
+        self.max_pending = max_pending
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        os.makedirs(root, exist_ok=True)
+
+    def _executor(self):
+        # The pool is started on first use, so importing the app stays cheap
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+        return self.executor
+
+    def job_dir(self, job_id):
+        return os.path.join(self.root, job_id)
+
+    def pending(self):
+        return sum(1 for job in self.jobs.values() if job['status'] in ('queued', 'running'))
+
+    def create(self):
+        # Reserve a job slot and its directory, raise JobQueueFull when too many jobs are waiting
+        self.expire()
+        with self.lock:
+            if self.pending() >= self.max_pending:
+                raise JobQueueFull(f"Too many pending jobs ({self.max_pending}), try again later.")
+            job_id = uuid.uuid4().hex
+            self.jobs[job_id] = {"status": "queued", "error": None, "filename": None, "created": time.time(), "finished": None}
+        os.makedirs(self.job_dir(job_id))
+        return job_id
+
+    def submit(self, job_id, spec):
+        spec = dict(spec, result=os.path.join(self.job_dir(job_id), 'result'))
+        try:
+            future = self._executor().submit(run_job, spec)
+        except Exception as err:
+            # A worker that died leaves the pool unusable, start a new one for the next job
+            if isinstance(err, BrokenProcessPool):
+                self.executor = None
+            self._finish(job_id, error=str(err))
+            raise
+        with self.lock:
+            self.jobs[job_id]['future'] = future
+        future.add_done_callback(lambda future: self._done(job_id, future))
+
+    def discard(self, job_id):
+        # Drop a job that was created but could not be submitted
+        with self.lock:
+            self.jobs.pop(job_id, None)
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+    def _done(self, job_id, future):
+        error = future.exception()
+        if error is not None:
+            self._finish(job_id, error=str(error))
+        else:
+            self._finish(job_id, filename=future.result())
+
+    def _finish(self, job_id, filename=None, error=None):
+        job_dir = self.job_dir(job_id)
+
+        # Only the result is kept, the uploaded inputs are removed straight away
+        for name in os.listdir(job_dir):
+            if name != 'result':
+                os.remove(os.path.join(job_dir, name))
+        if error is not None and os.path.exists(os.path.join(job_dir, 'result')):
+            os.remove(os.path.join(job_dir, 'result'))
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return
+            job.update(status="failed" if error is not None else "done", error=error, filename=filename, finished=time.time())
+            job.pop('future', None)
+
+    def status(self, job_id):
+        # Return a copy of the job's public state, or None for an unknown or expired job
+        self.expire()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            status = job['status']
+            if status == 'queued' and 'future' in job and job['future'].running():
+                status = 'running'
+            return {"job": job_id, "status": status, "error": job['error'], "filename": job['filename']}
+
+    def result_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'result')
+
+    def expire(self):
+        # Forget finished jobs older than the ttl and delete their results,
+        # along with directories left behind by an earlier run of the service
+        now = time.time()
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items()
+                       if job['finished'] is not None and now - job['finished'] > self.ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
+            known = set(self.jobs)
+
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name in expired or (name not in known and now - os.path.getmtime(path) > self.ttl):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+
+def job_spec(action, carrier_type, **fields):
+    # Build the job description run_job expects, fields that are not given keep their defaults
+    spec = {"action": action, "type": carrier_type, "carrier": None, "carrier_name": "", "secret": None,
+            "filename": b"", "key": None, "passphrase": None, "output": "", "channels": "R", "bits": 1,
+            "profile": DEFAULT_ENCODING_PROFILE, "compression": DEFAULT_COMPRESSION}
+    spec.update(fields)
+    return spec
@@ -0,0 +1,81 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from util import parse_public_key, parse_private_key
+
+# Default number of parsed keys kept and how long each one stays valid (seconds)
+KEY_CACHE_SIZE = 128
+KEY_CACHE_TTL = 600
+
+
+class KeyCache:
+    # Thread-safe LRU cache of parsed key objects with TTL eviction. Entries
+    # are keyed on a digest of the PEM bytes and the passphrase, so neither is
+    # kept around in the clear. Keys that fail to parse are never cached.
+
+    def __init__(self, max_size=KEY_CACHE_SIZE, ttl=KEY_CACHE_TTL):
+        if max_size < 1:
+            raise ValueError("Key cache size must be positive.")
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _digest(self, kind, pem, passphrase):
+        digest = hashlib.sha256(kind)
+        for part in (pem, passphrase.encode()):
+            digest.update(len(part).to_bytes(8, 'big'))
+            digest.update(part)
+        return digest.digest()
+
+    def _get(self, digest, parse):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is not None:
+                key, expires = entry
+                if expires > now:
+                    self.entries.move_to_end(digest)
+                    self.hits += 1
+                    return key
+                del self.entries[digest]
+                self.evictions += 1
+            self.misses += 1
+
+        # Parse outside the lock, decrypting a private key is deliberately slow
+        key = parse()
+
+        with self.lock:
+            self.entries[digest] = (key, now + self.ttl)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return key
+
+    def private_key(self, pem, passphrase):
+        digest = self._digest(b'private', pem, passphrase)
+        return self._get(digest, lambda: parse_private_key(pem, passphrase))
+
+    def public_key(self, pem):
+        digest = self._digest(b'public', pem, '')
+        return self._get(digest, lambda: parse_public_key(pem))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,399 @@
+import random
+import numpy as np
+from permutation import KeyedPermutation
+from util import CHUNK_SIZE
+from timings import stage, count
+
+# Magic tag at the start of every carrier written with the keyed permutation
+FRAME_MAGIC = b'SPX1'
+
+# Carrier units taken by the frame header (magic + layout byte + 64-bit payload size)
+HEADER_BITS = 8 * len(FRAME_MAGIC) + 8 + 64
+
+# Highest number of LSBs that may be used per band
+MAX_DEPTH = 4
+
+
+class NoFrameHeader(ValueError):
+    pass
+
+
+def bytes_to_bits(data):
+    # Unpack the bytes into a flat array of bits, most significant bit first
+    return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+
+def bits_to_bytes(bits):
+    # Pack a flat array of bits back into bytes, most significant bit first
+    return np.packbits(bits).tobytes()
+
+
+def bits_to_int(bits):
+    return int.from_bytes(bits_to_bytes(bits), 'big')
+
+
+def embed_bits(values, indices, symbols, depth=1):
+    # LSB matching: the low `depth` bits of every selected value become the
+    # next `depth` bits XOR the message symbol. With a depth of 1 this is the
+    # seventh bit XOR the message bit, which only ever flips the LSB
+    mask = (1 << depth) - 1
+    selected = values[indices]
+    values[indices] = selected ^ ((selected ^ (selected >> depth) ^ symbols) & mask)
+
+
+def extract_bits(values, indices, depth=1):
+    # Undo the LSB matching rule for every selected value at once
+    selected = values[indices]
+    return ((selected ^ (selected >> depth)) & ((1 << depth) - 1)).astype(np.uint8)
+
+
+def pack_layout(bands, depth):
+    # The high nibble is a mask of the bands in use, the low nibble the LSBs per band
+    if not bands or any(band not in range(4) for band in bands):
+        raise ValueError("Layout bands must be a non-empty subset of 0..3.")
+    if not 1 <= depth <= MAX_DEPTH:
+        raise ValueError(f"Layout depth must be between 1 and {MAX_DEPTH}.")
+    return sum(1 << band for band in set(bands)) << 4 | depth
+
+
+def unpack_layout(layout):
+    bands = [band for band in range(4) if (layout >> 4) & (1 << band)]
+    return bands, layout & 0xF
+
+
+def payload_units(payload_size, bands=(0,), depth=1):
+    # Number of carrier units needed for the payload, each unit holds depth bits per band
+    bits_per_unit = len(bands) * depth
+    return -(-payload_size * 8 // bits_per_unit)
+
+
+def required_values(payload_size, bands=(0,), depth=1):
+    # Number of carrier units needed to hold the frame header and the payload
+    return HEADER_BITS + payload_units(payload_size, bands, depth)
+
+
+def payload_capacity(units, bands=(0,), depth=1):
+    # Largest payload (in bytes) a carrier of this many units can hold
+    pack_layout(bands, depth)
+    return max(0, (units - HEADER_BITS) * len(bands) * depth // 8)
+
+
+def bits_to_symbols(bits, bands, depth):
+    # Group the bits into depth-bit symbols, one per selected band of each unit
+    bits_per_unit = len(bands) * depth
+    bits = np.concatenate((bits, np.zeros(-len(bits) % bits_per_unit, dtype=np.uint8)))
+    symbols = np.packbits(bits.reshape(-1, depth), axis=1) >> (8 - depth)
+    return symbols.reshape(-1, len(bands))
+
+
+def symbols_to_bits(symbols, depth):
+    # Split every depth-bit symbol back into its bits, most significant bit first
+    shifts = np.arange(depth - 1, -1, -1, dtype=np.uint8)
+    return ((symbols[..., None] >> shifts) & 0x1).ravel()
+
+
+def unit_symbols(data, units, bands, depth):
+    # Gather the symbols of the given payload units straight from the payload
+    # bytes, so only the units that are needed get unpacked
+    bits_per_unit = len(bands) * depth
+    bit_index = units[:, None] * bits_per_unit + np.arange(bits_per_unit)
+    byte_index = np.minimum(bit_index >> 3, len(data) - 1)
+    bits = (data[byte_index] >> (7 - (bit_index & 7))) & 0x1
+    bits[bit_index >= len(data) * 8] = 0  # Padding after the last byte
+    return bits_to_symbols(bits.astype(np.uint8).ravel(), bands, depth)
+
+
+def frame_header(payload_size, bands, depth):
+    return FRAME_MAGIC + bytes([pack_layout(bands, depth)]) + payload_size.to_bytes(8, 'big')
+
+
+def parse_frame_header(header, num_bands, size):
+    # Return the (bands, depth, payload size) of a frame header, or None if
+    # the carrier does not start with the frame magic
+    if header[:len(FRAME_MAGIC)] != FRAME_MAGIC:
+        return None
+    bands, depth = unpack_layout(header[len(FRAME_MAGIC)])
+    payload_size = int.from_bytes(header[len(FRAME_MAGIC) + 1:], 'big')
+    if not bands or max(bands) >= num_bands or not 1 <= depth <= MAX_DEPTH:
+        raise ValueError("Embedded layout does not match the carrier.")
+    if required_values(payload_size, bands, depth) > size:
+        raise ValueError("Embedded payload size exceeds the carrier capacity.")
+    return bands, depth, payload_size
+
+
+def embed_payload(carrier, seed, payload, bands=(0,), depth=1):
+    # The carrier is a 2-D (units, bands) array. The frame header always goes
+    # in the LSB of band 0 so the layout can be read back before it is known,
+    # the payload then fills the following units with the requested layout.
+    # Only the indices that are used are generated from the keyed permutation,
+    # so the cost scales with the payload
+    return embed_payload_chunks(carrier, seed, [payload], bands, depth)
+
+
+def embed_payload_chunks(carrier, seed, chunks, bands=(0,), depth=1):
+    # Bit emitter for a payload that arrives as chunks of unknown total size.
+    # The payload units come after the header units in the permutation, so
+    # every chunk is embedded as soon as it arrives and the header, which
+    # holds the total size, is written last. Returns the payload size
+    bands = sorted(set(bands))
+    pack_layout(bands, depth)  # Validate the layout before any work is done
+    bits_per_unit = len(bands) * depth
+    capacity = len(carrier) - HEADER_BITS
+    if capacity < 0:
+        raise ValueError("Carrier is not large enough to hide the file.")
+    permutation = KeyedPermutation(len(carrier), seed)
+    band_index = np.array(bands)[None, :]
+
+    payload_size = 0
+    next_unit = 0
+    pending = np.zeros(0, dtype=np.uint8)
+
+    def emit(bits):
+        # Embed the bits in the next payload units, the last unit is zero padded
+        nonlocal next_unit
+        count = -(-len(bits) // bits_per_unit)
+        if next_unit + count > capacity:
+            raise ValueError("Carrier is not large enough to hide the file.")
+        units = permutation.take(HEADER_BITS + next_unit, count)
+        embed_bits(carrier, (units[:, None], band_index), bits_to_symbols(bits, bands, depth), depth)
+        next_unit += count
+
+    for chunk in chunks:
+        with stage('embed'):
+            for offset in range(0, len(chunk), CHUNK_SIZE):
+                piece = chunk[offset:offset + CHUNK_SIZE]
+                payload_size += len(piece)
+
+                # Only whole units are embedded, the leftover bits wait for the next piece
+                bits = np.concatenate((pending, bytes_to_bits(piece)))
+                whole = len(bits) - len(bits) % bits_per_unit
+                emit(bits[:whole])
+                pending = bits[whole:]
+
+    with stage('embed'):
+        if len(pending):
+            emit(pending)
+
+        header = frame_header(payload_size, bands, depth)
+        embed_bits(carrier[:, 0], permutation.take(0, HEADER_BITS), bytes_to_bits(header))
+    count('payload', payload_size)
+    return payload_size
+
+
+def extract_payload(carrier, seed):
+    return b''.join(extract_payload_chunks(carrier, seed))
+
+
+def extract_payload_chunks(carrier, seed, chunk_size=CHUNK_SIZE):
+    # Yield the payload a chunk at a time, so it can be decrypted and written
+    # out without ever holding it in memory as a whole
+
+    # Carriers written with the keyed permutation start with the frame magic
+    if len(carrier) >= HEADER_BITS:
+        with stage('extract'):
+            permutation = KeyedPermutation(len(carrier), seed)
+            header = bits_to_bytes(extract_bits(carrier[:, 0], permutation.take(0, HEADER_BITS)))
+            frame = parse_frame_header(header, carrier.shape[1], len(carrier))
+        if frame is not None:
+            bands, depth, payload_size = frame
+            bits_per_unit = len(bands) * depth
+            band_index = np.array(bands)[None, :]
+            count('payload', payload_size)
+
+            for offset in range(0, payload_size, chunk_size):
+                end = min(offset + chunk_size, payload_size)
+
+                # Read the units that cover the bits of this chunk
+                with stage('extract'):
+                    first_unit = offset * 8 // bits_per_unit
+                    last_unit = -(-end * 8 // bits_per_unit)
+                    units = permutation.take(HEADER_BITS + first_unit, last_unit - first_unit)
+                    bits = symbols_to_bits(extract_bits(carrier, (units[:, None], band_index), depth), depth)
+
+                    first_bit = offset * 8 - first_unit * bits_per_unit
+                    data = bits_to_bytes(bits[first_bit:first_bit + (end - offset) * 8])
+                yield data
+            return
+
+    # Otherwise fall back to the legacy layout
+    yield extract_legacy_payload(carrier[:, 0], seed)
+
+
+def probe_payload(carrier, seed, prefix_size):
+    # Read only the frame header and the first prefix_size bytes of the
+    # payload, at the units the keyed permutation selects first. Returns
+    # (bands, depth, payload size, prefix), or None when the carrier does not
+    # start with the frame magic. Raises ValueError for an implausible header
+    if len(carrier) < HEADER_BITS:
+        return None
+    permutation = KeyedPermutation(len(carrier), seed)
+    header = bits_to_bytes(extract_bits(carrier[:, 0], permutation.take(0, HEADER_BITS)))
+    frame = parse_frame_header(header, carrier.shape[1], len(carrier))
+    if frame is None:
+        return None
+
+    bands, depth, payload_size = frame
+    size = min(prefix_size, payload_size)
+    units = permutation.take(HEADER_BITS, payload_units(size, bands, depth))
+    bits = symbols_to_bits(extract_bits(carrier, (units[:, None], np.array(bands)[None, :]), depth), depth)
+    return bands, depth, payload_size, bits_to_bytes(bits[:size * 8])
+
+
+def _sorted_selection(permutation, used, block_size):
+    # With no more selected units than fit in a block, generate them once and
+    # sort them by carrier index. Otherwise return None and let every block
+    # invert the permutation over its own range, which keeps memory bounded
+    if used > block_size:
+        return None
+    indices = permutation.take(0, used)
+    positions = np.argsort(indices)
+    return indices[positions], positions
+
+
+def _selected_in_block(permutation, used, start, end, selection):
+    # Return the rows of the block [start, end) that hold one of the first
+    # `used` units of the permutation, and the position of each of them
+    if selection is not None:
+        indices, positions = selection
+        low, high = np.searchsorted(indices, (start, end))
+        return indices[low:high] - start, positions[low:high]
+    positions = permutation.invert(np.arange(start, end))
+    rows = np.flatnonzero(positions < used)
+    return rows, positions[rows]
+
+
+def embed_payload_blocks(blocks, size, seed, payload, bands=(0,), depth=1, block_size=1 << 20):
+    # Streaming variant of embed_payload: `blocks` yields the consecutive
+    # (units, bands) blocks of a carrier of `size` units, and every block is
+    # yielded back once the bits that fall inside it have been embedded. The
+    # result is identical to embed_payload on the whole carrier
+    bands = sorted(set(bands))
+    header_bits = bytes_to_bits(frame_header(len(payload), bands, depth))
+    data = np.frombuffer(payload, dtype=np.uint8)
+    used = required_values(len(payload), bands, depth)
+    permutation = KeyedPermutation(size, seed)
+    selection = _sorted_selection(permutation, used, block_size)
+
+    count('payload', len(payload))
+
+    start = 0
+    for block in blocks:
+        with stage('embed'):
+            rows, positions = _selected_in_block(permutation, used, start, start + len(block), selection)
+
+            # Header bits go in the LSB of band 0, payload units use the layout
+            header = positions < HEADER_BITS
+            embed_bits(block[:, 0], rows[header], header_bits[positions[header]])
+            rows, units = rows[~header], positions[~header] - HEADER_BITS
+            embed_bits(block, (rows[:, None], np.array(bands)[None, :]), unit_symbols(data, units, bands, depth), depth)
+
+        start += len(block)
+        yield block
+
+
+def extract_payload_blocks(read_units, size, num_bands, seed, block_size=1 << 20):
+    # Streaming variant of extract_payload: read_units(start, count) returns
+    # rows start .. start + count - 1 of a (units, bands) carrier of `size`
+    # units. The header units are read one by one, then the carrier is read
+    # a block at a time and blocks without selected units are skipped
+    with stage('extract'):
+        return _extract_payload_blocks(read_units, size, num_bands, seed, block_size)
+
+
+def _extract_payload_blocks(read_units, size, num_bands, seed, block_size):
+    if size >= HEADER_BITS:
+        permutation = KeyedPermutation(size, seed)
+        header_values = np.array([read_units(unit, 1)[0, 0] for unit in permutation.take(0, HEADER_BITS)])
+        header = bits_to_bytes(extract_bits(header_values, np.arange(HEADER_BITS)))
+        frame = parse_frame_header(header, num_bands, size)
+        if frame is not None:
+            bands, depth, payload_size = frame
+            used = required_values(payload_size, bands, depth)
+            selection = _sorted_selection(permutation, used, block_size)
+            symbols = np.zeros((used - HEADER_BITS, len(bands)), dtype=np.uint8)
+
+            for start in range(0, size, block_size):
+                end = min(start + block_size, size)
+                rows, positions = _selected_in_block(permutation, used, start, end, selection)
+                payload = positions >= HEADER_BITS
+                if not payload.any():
+                    continue
+                block = read_units(start, end - start)
+                rows, units = rows[payload], positions[payload] - HEADER_BITS
+                symbols[units] = extract_bits(block, (rows[:, None], np.array(bands)[None, :]), depth)
+
+            count('payload', payload_size)
+            return bits_to_bytes(symbols_to_bits(symbols, depth)[:payload_size * 8])
+
+    # Legacy carriers need the full shuffle, so they are read in one go
+    return extract_legacy_payload(read_units(0, size)[:, 0], seed)
+
+
+def extract_payload_strips(read_blocks, size, num_bands, seed, block_size=1 << 20):
+    # Variant of extract_payload_blocks for carriers that can only be decoded
+    # in order, a strip at a time. read_blocks(units) yields (start, block)
+    # for consecutive (units, bands) blocks of a carrier of `size` units: at
+    # least the blocks holding one of the sorted carrier indices in units, or
+    # every block when units is None. The strips holding the header are
+    # decoded first, then the ones holding the payload
+    with stage('extract'):
+        return _extract_payload_strips(read_blocks, size, num_bands, seed, block_size)
+
+
+def _extract_payload_strips(read_blocks, size, num_bands, seed, block_size):
+    if size < HEADER_BITS:
+        raise ValueError("No hidden data found.")
+    permutation = KeyedPermutation(size, seed)
+    header_units = permutation.take(0, HEADER_BITS)
+    order = np.argsort(header_units)
+    sorted_units = header_units[order]
+    header_values = np.zeros(HEADER_BITS, dtype=np.uint8)
+    for start, block in read_blocks(sorted_units):
+        low, high = np.searchsorted(sorted_units, (start, start + len(block)))
+        header_values[order[low:high]] = block[sorted_units[low:high] - start, 0]
+
+    header = bits_to_bytes(extract_bits(header_values, np.arange(HEADER_BITS)))
+    frame = parse_frame_header(header, num_bands, size)
+    if frame is None:
+        # Legacy carriers need the full shuffle, which doesn't fit in bounded memory
+        raise NoFrameHeader("No hidden data found, carriers without a frame header can't be read in strips.")
+
+    bands, depth, payload_size = frame
+    used = required_values(payload_size, bands, depth)
+    selection = _sorted_selection(permutation, used, block_size)
+    symbols = np.zeros((used - HEADER_BITS, len(bands)), dtype=np.uint8)
+    for start, block in read_blocks(None if selection is None else selection[0]):
+        rows, positions = _selected_in_block(permutation, used, start, start + len(block), selection)
+        payload = positions >= HEADER_BITS
+        rows, units = rows[payload], positions[payload] - HEADER_BITS
+        symbols[units] = extract_bits(block, (rows[:, None], np.array(bands)[None, :]), depth)
+
+    count('payload', payload_size)
+    return bits_to_bytes(symbols_to_bits(symbols, depth)[:payload_size * 8])
+
+
+def probe_legacy_payload(values, seed, prefix_size):
+    # Read only the size and the first prefix_size bytes of a legacy payload.
+    # Returns (payload size, prefix), or None when the size does not fit. The
+    # legacy shuffle still has to run over the whole index list
+    if len(values) < 64:
+        return None
+    with stage('shuffle'):
+        indices = list(range(len(values)))
+        random.Random(seed).shuffle(indices)
+    file_size = bits_to_int(extract_bits(values, indices[:64]))
+    if 64 + file_size * 8 > len(values):
+        return None
+    size = min(prefix_size, file_size)
+    return file_size, bits_to_bytes(extract_bits(values, indices[64:64 + size * 8]))
+
+
+def extract_legacy_payload(values, seed):
+    # Legacy carriers shuffle the full index list and store a bare 64-bit size
+    with stage('shuffle'):
+        indices = list(range(len(values)))
+        random.Random(seed).shuffle(indices)
+    file_size = bits_to_int(extract_bits(values, indices[:64]))
+    if 64 + file_size * 8 > len(values):
+        raise ValueError("No hidden data found.")
+    return bits_to_bytes(extract_bits(values, indices[64:64 + file_size * 8]))
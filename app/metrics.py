@@ -0,0 +1,87 @@
+import threading
+
+# Upper bounds (seconds) of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{value}"' for name, value in zip(names, values))
+
+
+class Counter:
+
+    def __init__(self, name, description, labelnames):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{{{_labels(self.labelnames, labels)}}} {value}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, description, labelnames, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self.lock:
+            counts, observations, total = self.values.get(labels, ([0] * len(self.buckets), 0, 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[labels] = (counts, observations + 1, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for labels, (counts, observations, total) in sorted(self.values.items()):
+                label_text = _labels(self.labelnames, labels)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{{{label_text},le=\"{bound}\"}} {bucket_count}")
+                lines.append(f"{self.name}_bucket{{{label_text},le=\"+Inf\"}} {observations}")
+                lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+                lines.append(f"{self.name}_count{{{label_text}}} {observations}")
+        return lines
+
+
+REQUESTS = Counter('stegano_requests_total', 'Requests handled, by endpoint and status code', ('endpoint', 'status'))
+REQUEST_SECONDS = Histogram('stegano_request_duration_seconds', 'Time spent handling a request', ('endpoint',))
+STAGE_SECONDS = Histogram('stegano_stage_duration_seconds', 'Time spent in every stage of a request', ('endpoint', 'stage'))
+BYTES = Counter('stegano_bytes_total', 'Bytes received, sent and processed, by endpoint and kind', ('endpoint', 'kind'))
+
+
+def record_request(endpoint, status, timings, request_bytes, response_bytes):
+    REQUESTS.inc((endpoint, status))
+    REQUEST_SECONDS.observe((endpoint,), timings.finish())
+    for name, seconds in timings.stages.items():
+        STAGE_SECONDS.observe((endpoint, name), seconds)
+    for name, amount in timings.counts.items():
+        BYTES.inc((endpoint, name), amount)
+    if request_bytes:
+        BYTES.inc((endpoint, 'request'), request_bytes)
+    if response_bytes:
+        BYTES.inc((endpoint, 'response'), response_bytes)
+
+
+def render():
+    # All metrics in the Prometheus text exposition format
+    lines = []
+    for metric in (REQUESTS, REQUEST_SECONDS, STAGE_SECONDS, BYTES):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,109 @@
+import hashlib
+import numpy as np
+from timings import stage
+
+# Number of Feistel rounds used to scramble the indices
+ROUNDS = 6
+
+# Indices are generated in batches small enough to stay in the CPU cache
+BATCH_SIZE = 1 << 16
+
+
+def _mix(values, key):
+    # Keyed 64-bit mixing function (splitmix64 finaliser) used as the Feistel round function
+    z = values + key
+    z *= np.uint64(0x9E3779B97F4A7C15)
+    z ^= z >> np.uint64(30)
+    z *= np.uint64(0xBF58476D1CE4E5B9)
+    z ^= z >> np.uint64(27)
+    z *= np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    return z
+
+
+class KeyedPermutation:
+    # A keyed permutation of range(size) that produces the k-th selected index
+    # on demand. A Feistel network permutes the smallest power-of-two domain
+    # covering size, and cycle walking maps it back into range(size), so
+    # nothing proportional to size is ever allocated.
+
+    def __init__(self, size, seed):
+        if size < 1:
+            raise ValueError("Permutation size must be positive.")
+        self.size = size
+
+        # Split the domain bits into a left and a right half (the left one
+        # takes the odd bit), the halves swap sizes on every round
+        bits = max(1, (size - 1).bit_length())
+        self.left_bits = (bits + 1) // 2
+        self.right_bits = bits // 2
+
+        # Derive the round keys from the seed
+        digest = hashlib.sha512(b'stegano-permutation:' + str(seed).encode()).digest()
+        self.round_keys = [np.uint64(int.from_bytes(digest[i * 8:(i + 1) * 8], 'big')) for i in range(ROUNDS)]
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, k):
+        return int(self.take(k, 1)[0])
+
+    def _encrypt(self, values):
+        left_bits, right_bits = self.left_bits, self.right_bits
+        left = values >> np.uint64(right_bits)
+        right = values & np.uint64((1 << right_bits) - 1)
+        for key in self.round_keys:
+            mixed = _mix(right, key)
+            mixed &= np.uint64((1 << left_bits) - 1)
+            mixed ^= left
+            left, right = right, mixed
+            left_bits, right_bits = right_bits, left_bits
+        left <<= np.uint64(right_bits)
+        left |= right
+        return left
+
+    def _decrypt(self, values):
+        left_bits, right_bits = self.left_bits, self.right_bits
+        left = values >> np.uint64(right_bits)
+        right = values & np.uint64((1 << right_bits) - 1)
+        for key in reversed(self.round_keys):
+            # Undo one round, the current left half is the previous right half
+            mixed = _mix(left, key)
+            mixed &= np.uint64((1 << right_bits) - 1)
+            mixed ^= right
+            left, right = mixed, left
+            left_bits, right_bits = right_bits, left_bits
+        left <<= np.uint64(right_bits)
+        left |= right
+        return left
+
+    def _walk(self, values, step):
+        # Re-apply the step until every value falls back inside range(size)
+        values = step(values)
+        pending = np.flatnonzero(values >= self.size)
+        while pending.size:
+            values[pending] = step(values[pending])
+            pending = pending[values[pending] >= self.size]
+        return values
+
+    def take(self, start, count):
+        # Return the selected indices for positions start .. start + count - 1
+        if start < 0 or start + count > self.size:
+            raise IndexError("Permutation position out of range.")
+        with stage('permute'):
+            indices = np.empty(count, dtype=np.int64)
+            for offset in range(0, count, BATCH_SIZE):
+                end = min(offset + BATCH_SIZE, count)
+                positions = np.arange(start + offset, start + end, dtype=np.uint64)
+                indices[offset:end] = self._walk(positions, self._encrypt)
+        return indices
+
+    def invert(self, indices):
+        # Return the permutation position of every given index, so a block of
+        # the carrier can find out which of its values were selected
+        with stage('permute'):
+            indices = np.asarray(indices, dtype=np.uint64)
+            positions = np.empty(len(indices), dtype=np.int64)
+            for offset in range(0, len(indices), BATCH_SIZE):
+                positions[offset:offset + BATCH_SIZE] = self._walk(indices[offset:offset + BATCH_SIZE], self._decrypt)
+        return positions
@@ -0,0 +1,87 @@
+import os
+import numpy as np
+from timings import stage
+
+# Byte position of the R, G, B (and A) band, or of the gray band, inside a
+# pixel for every raw layout PIL reports for uncompressed BMP, TGA and TIFF files
+RAW_BANDS = {
+    'L': (0,),
+    'RGB': (0, 1, 2),
+    'RGBA': (0, 1, 2, 3),
+    'RGBX': (0, 1, 2),
+    'BGR': (2, 1, 0),
+    'BGRA': (2, 1, 0, 3),
+    'BGRX': (2, 1, 0),
+}
+
+# Formats whose pixels can be stored as raw rows
+RAW_FORMATS = {'BMP', 'TGA', 'TIFF'}
+
+
+class PixelCarrier:
+    # A (pixels, bands) carrier over the memory-mapped pixel rows of an image
+    # file. The rows can be padded, stored bottom-up and hold their bands in
+    # any order, so they can't be flattened without a copy. Flat pixel indices
+    # and RGBA band indices are translated on every access instead, so only
+    # the pages holding selected pixels are ever touched.
+
+    def __init__(self, rows, bands=None):
+        # rows is a (height, width, bytes per pixel) view, or (height, width)
+        # for a single band, in which case bands is None
+        self.rows = rows
+        self.bands = None if bands is None else np.asarray(bands)
+        self.width = rows.shape[1]
+        size = rows.shape[0] * rows.shape[1]
+        self.shape = (size,) if bands is None else (size, len(bands))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _index(self, key):
+        units, *bands = key if isinstance(key, tuple) else (key,)
+        rows, columns = np.divmod(units, self.width)
+        if bands:
+            return rows, columns, self.bands[bands[0]]
+        return rows, columns
+
+    def __getitem__(self, key):
+        # carrier[:, band] is the carrier of a single band
+        if isinstance(key, tuple) and isinstance(key[0], slice):
+            return PixelCarrier(self.rows[:, :, self.bands[key[1]]])
+        return self.rows[self._index(key)]
+
+    def __setitem__(self, key, value):
+        self.rows[self._index(key)] = value
+
+    def flush(self):
+        self.rows.flush()
+
+
+def map_pixels(img, image_path, mode='r'):
+    # Memory-map the pixels of an uncompressed BMP, TGA or TIFF file that PIL
+    # opened (only its header has been read). Returns a PixelCarrier with the
+    # bands of img.mode, or None when the pixels are not stored as one block
+    # of raw 8-bit rows, e.g. compressed, palette or tiled images
+    if img.format not in RAW_FORMATS or img.mode not in ('L', 'RGB', 'RGBA') or len(img.tile) != 1:
+        return None
+    decoder, box, offset, args = img.tile[0]
+    if decoder != 'raw' or box != (0, 0) + img.size or not isinstance(args, tuple) or len(args) != 3:
+        return None
+    rawmode, stride, orientation = args
+    if rawmode not in RAW_BANDS or len(RAW_BANDS[rawmode]) != len(img.mode):
+        return None
+
+    width, height = img.size
+    pixel_size = len(rawmode)
+    stride = stride or width * pixel_size
+    if stride < width * pixel_size or os.path.getsize(image_path) < offset + height * stride:
+        return None
+
+    with stage('decode'):
+        data = np.memmap(image_path, dtype=np.uint8, mode=mode, offset=offset, shape=(height, stride))
+    rows = data[:, :width * pixel_size].reshape(height, width, pixel_size)
+
+    # A negative orientation means the rows are stored bottom-up
+    if orientation < 0:
+        rows = rows[::-1]
+    return PixelCarrier(rows, RAW_BANDS[rawmode])
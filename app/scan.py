@@ -0,0 +1,177 @@
+import codecs
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from audio import map_samples
+from image import img_carrier, NATIVE_MODES
+from lsb import probe_payload, probe_legacy_payload
+from shard import parse_shard_header, SHARD_HEADER_SIZE
+from util import compute_seed_from_image_dimensions, CARRIER_EXTENSIONS, CONTAINER_MAGIC, CONTAINER_VERSION, LEGACY_CONTAINER_VERSION, CODEC_CONTAINER_VERSION, CODEC_NONE, CODEC_ZLIB, CODEC_LZMA
+
+CODEC_NAMES = {CODEC_NONE: 'none', CODEC_ZLIB: 'zlib', CODEC_LZMA: 'lzma'}
+
+# Payload bytes read past the frame header, enough for a shard header or the
+# container magic, version, codec, filename size and the start of the filename
+PROBE_SIZE = SHARD_HEADER_SIZE
+
+# Longest filename a plausible container holds, and the fewest bytes of
+# encrypted session key (RSA-1024), salt and iv or nonce that follow it
+MAX_FILENAME_SIZE = 4096
+MIN_KEY_SIZE = 128
+MIN_KEY_FIELDS_SIZE = MIN_KEY_SIZE + 16 + 7
+
+# Carriers handed to the process pool at a time, so the paths of a corpus of
+# millions of files are never all held in memory
+SCAN_BATCH = 4096
+
+
+def container_info(prefix, payload_size):
+    # Version and codec of the payload container that starts with `prefix`,
+    # or None when those bytes can't start a container of payload_size bytes.
+    # Only the plaintext framing is looked at, nothing is decrypted
+    if prefix[:len(CONTAINER_MAGIC)] == CONTAINER_MAGIC:
+        offset = len(CONTAINER_MAGIC) + 1
+        if len(prefix) < offset or prefix[offset - 1] > CONTAINER_VERSION:
+            return None
+        version = prefix[offset - 1]
+        codec = CODEC_ZLIB
+        if version >= CODEC_CONTAINER_VERSION:
+            if len(prefix) <= offset or prefix[offset] not in CODEC_NAMES:
+                return None
+            codec = prefix[offset]
+            offset += 1
+    else:
+        version, codec, offset = LEGACY_CONTAINER_VERSION, CODEC_ZLIB, 0
+
+    if len(prefix) < offset + 4:
+        return None
+    filename_size = int.from_bytes(prefix[offset:offset + 4], 'big')
+    offset += 4
+    if filename_size > MAX_FILENAME_SIZE or offset + filename_size + MIN_KEY_FIELDS_SIZE > payload_size:
+        return None
+
+    # The filename is UTF-8, the prefix may end in the middle of a character
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(prefix[offset:offset + filename_size])
+    except UnicodeDecodeError:
+        return None
+    return {"version": version, "codec": CODEC_NAMES[codec]}
+
+
+def load_carrier(path, carrier_type):
+    # The carrier of a file and its seed, or None for images in a mode that
+    # can't hold hidden bits. WAVs and uncompressed images are memory-mapped,
+    # so only the pages holding the probed units are read
+    if carrier_type == 'audio':
+        params, carrier = map_samples(path)
+        return carrier, params.nframes
+    with Image.open(path) as img:
+        if img.mode not in NATIVE_MODES:
+            return None, None
+        return img_carrier(img, path), compute_seed_from_image_dimensions(img)
+
+
+def scan_carrier(path, carrier_type, legacy=False):
+    # Check if a carrier holds a payload by decoding only the frame header and
+    # the first bytes of the container, without any key. Legacy carriers have
+    # no frame magic and need a full shuffle to probe, so they are only looked
+    # for when asked. Returns the fields of the carrier's report line
+    carrier, seed = load_carrier(path, carrier_type)
+    if carrier is None:
+        return {"status": "none"}
+    try:
+        frame = probe_payload(carrier, seed, PROBE_SIZE)
+    except ValueError as err:
+        return {"status": "invalid", "error": str(err)}
+
+    if frame is not None:
+        bands, depth, payload_size, prefix = frame
+        result = {"status": "payload", "bits": depth, "payload": payload_size}
+        if carrier_type == 'image':
+            result["channels"] = ''.join('RGBA'[band] for band in bands)
+
+        # One shard of a secret split across several carriers
+        shard = parse_shard_header(prefix)
+        if shard is not None:
+            set_id, index, total = shard
+            result.update(status="shard", set=set_id.hex(), shard=index, shards=total)
+            return result
+    elif legacy:
+        frame = probe_legacy_payload(carrier[:, 0], seed, PROBE_SIZE)
+        if frame is None:
+            return {"status": "none"}
+        payload_size, prefix = frame
+        result = {"status": "legacy", "payload": payload_size}
+    else:
+        return {"status": "none"}
+
+    info = container_info(prefix, payload_size)
+    if info is None:
+        # A legacy size that happens to fit is just noise
+        if result["status"] == "legacy":
+            return {"status": "none"}
+        return {"status": "invalid", "error": "Payload does not start with a container."}
+    result.update(info)
+    return result
+
+
+def carrier_paths(root):
+    # Yield (path, carrier type) for every carrier under root, in a stable order
+    if os.path.isfile(root):
+        carrier_type = CARRIER_EXTENSIONS.get(os.path.splitext(root)[1].lower())
+        if carrier_type:
+            yield root, carrier_type
+        return
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories.sort()
+        for filename in sorted(filenames):
+            carrier_type = CARRIER_EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+            if carrier_type:
+                yield os.path.join(directory, filename), carrier_type
+
+
+def _scan_task(args):
+    path, carrier_type, legacy = args
+    start = time.perf_counter()
+    result = {"path": path, "type": carrier_type}
+    try:
+        result.update(scan_carrier(path, carrier_type, legacy))
+    except Exception as err:
+        result.update(status="error", error=str(err))
+    result["seconds"] = round(time.perf_counter() - start, 4)
+    return result
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def run_scan(root, report_path, workers=None, legacy=False):
+    # Scan every image and WAV under root on a process pool (one worker per
+    # core by default) and write one JSON result line per carrier, in path
+    # order. No key is needed and nothing is decrypted
+    workers = workers or os.cpu_count() or 1
+    tasks = ((path, carrier_type, legacy) for path, carrier_type in carrier_paths(root))
+
+    counts = {"payload": 0, "legacy": 0, "shard": 0, "invalid": 0, "none": 0, "error": 0}
+    with ProcessPoolExecutor(max_workers=workers) as executor, open(report_path, 'w') as report:
+        for batch in _batches(tasks, SCAN_BATCH):
+            chunksize = max(1, len(batch) // (workers * 8))
+            for result in executor.map(_scan_task, batch, chunksize=chunksize):
+                counts[result["status"]] += 1
+                report.write(json.dumps(result) + '\n')
+
+    total = sum(counts.values())
+    print(f"{total} carriers: {counts['payload'] + counts['legacy']} with a payload ({counts['legacy']} legacy), {counts['shard']} with a shard, "
+          f"{counts['invalid']} with an invalid header, {counts['none']} without, {counts['error']} unreadable. "
+          f"Report written to {report_path}")
+    return counts
@@ -0,0 +1,268 @@
+import os
+import wave
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from audio import embed_chunks_in_audio, map_samples
+from image import embed_chunks_in_img, img_carrier, save_img, DEFAULT_ENCODING_PROFILE
+from capacity import carrier_capacity
+from encrypt import encrypt_stream, DEFAULT_COMPRESSION
+from decrypt import decrypt_stream
+from lsb import extract_payload_chunks
+from util import compute_seed_from_image_dimensions, CARRIER_EXTENSIONS, CHUNK_SIZE, SHARD_MAGIC, load_public_key, load_private_key, confirm_overwrite
+
+# Every shard starts with the shard magic, the random ID of its set, its
+# index and the number of shards in the set, followed by its slice of the payload
+SET_ID_SIZE = 16
+SHARD_HEADER_SIZE = len(SHARD_MAGIC) + SET_ID_SIZE + 2 + 2
+MAX_SHARDS = 0xFFFF
+
+
+def carrier_type(path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in CARRIER_EXTENSIONS:
+        raise ValueError(f"Unsupported carrier: {path}")
+    return CARRIER_EXTENSIONS[extension]
+
+
+def shard_header(set_id, index, total):
+    return SHARD_MAGIC + set_id + index.to_bytes(2, 'big') + total.to_bytes(2, 'big')
+
+
+def parse_shard_header(header):
+    # Return the (set ID, index, total) of a shard header, or None if the
+    # bytes don't start with one
+    if len(header) < SHARD_HEADER_SIZE or header[:len(SHARD_MAGIC)] != SHARD_MAGIC:
+        return None
+    offset = len(SHARD_MAGIC) + SET_ID_SIZE
+    index = int.from_bytes(header[offset:offset + 2], 'big')
+    total = int.from_bytes(header[offset + 2:offset + 4], 'big')
+    if index >= total:
+        return None
+    return header[len(SHARD_MAGIC):offset], index, total
+
+
+def plan_shards(capacities, payload_size):
+    # Payload bytes every carrier takes, in proportion to its capacity, so
+    # every carrier is used about as densely and the workers get even work.
+    # Carriers too small for a shard header get no share
+    room = [max(capacity - SHARD_HEADER_SIZE, 0) for capacity in capacities]
+    total_room = sum(room)
+    if payload_size > total_room:
+        raise ValueError(f"Carriers are not large enough to hide the file (they hold {total_room} bytes of payload).")
+
+    sizes = [payload_size * carrier_room // total_room for carrier_room in room]
+    # Hand out what the rounding left to the carriers that still have room
+    left = payload_size - sum(sizes)
+    for index, carrier_room in enumerate(room):
+        extra = min(left, carrier_room - sizes[index])
+        sizes[index] += extra
+        left -= extra
+    return sizes
+
+
+def shard_chunks(header, spool_path, offset, size):
+    # Yield the shard header, then size bytes of the spool from offset a chunk at a time
+    yield header
+    with open(spool_path, 'rb') as spool:
+        spool.seek(offset)
+        for start in range(0, size, CHUNK_SIZE):
+            yield spool.read(min(CHUNK_SIZE, size - start))
+
+
+def _embed_shard(args):
+    # Hide one shard in its carrier and write the output, in a worker process.
+    # The worker reads its slice of the payload from the spool itself, so the
+    # shards are never copied or sent to the workers
+    kind, carrier_path, output_path, header, spool_path, offset, size, channels, depth, profile = args
+    shard = shard_chunks(header, spool_path, offset, size)
+    if kind == 'audio':
+        with wave.open(carrier_path, 'rb') as audio:
+            samples = embed_chunks_in_audio(audio, shard, depth)
+            params = audio.getparams()
+        with wave.open(output_path, 'wb') as output_audio:
+            output_audio.setparams(params)
+            output_audio.writeframes(samples)
+    else:
+        with Image.open(carrier_path) as img:
+            new_img, host_format = embed_chunks_in_img(img, carrier_path, shard, channels, depth)
+        save_img(new_img, output_path, host_format, profile)
+    return output_path
+
+
+def hide_file_in_carriers(carrier_paths, file_to_hide, output_dir, public_key_path, channels='R', depth=1, workers=None, overwrite=None,
+                          public_key=None, profile=DEFAULT_ENCODING_PROFILE, compression=DEFAULT_COMPRESSION):
+    # Split a secret too large for any one carrier across several images and
+    # WAVs. The secret is compressed and encrypted once, the payload is cut
+    # into one shard per carrier and the shards are hidden in parallel. Every
+    # output is written to output_dir under the name of its carrier
+    if public_key is None:
+        public_key = load_public_key(public_key_path)
+    if not 0 < len(carrier_paths) <= MAX_SHARDS:
+        raise ValueError(f"Give between 1 and {MAX_SHARDS} carriers.")
+    types = [carrier_type(path) for path in carrier_paths]
+    output_paths = [os.path.join(output_dir, os.path.basename(path)) for path in carrier_paths]
+    if len(set(output_paths)) != len(output_paths):
+        raise ValueError("Carriers must have different file names.")
+
+    # Check if any output already exists and prompt the user before doing the work
+    for output_path in output_paths:
+        if not confirm_overwrite(output_path, overwrite):
+            print("Hiding cancelled.")
+            return
+
+    # Only the headers of the carriers are read to size the shards
+    capacities = [carrier_capacity(kind, path, channels, depth) for kind, path in zip(types, carrier_paths)]
+
+    # Compress and encrypt the file to a spool, the shards are slices of it
+    filename = os.path.basename(file_to_hide).encode()
+    fd, spool_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as spool, open(file_to_hide, 'rb') as secret_file:
+            for chunk in encrypt_stream(secret_file, filename, public_key, compression=compression):
+                spool.write(chunk)
+            payload_size = spool.tell()
+        sizes = plan_shards(capacities, payload_size)
+
+        # Carriers without a share are left out of the set and get no output
+        for carrier_path, size in zip(carrier_paths, sizes):
+            if not size:
+                print(f"Carrier '{carrier_path}' gets no share of the payload and is left out.")
+        used = [index for index, size in enumerate(sizes) if size]
+        output_paths = [output_paths[index] for index in used]
+
+        set_id = os.urandom(SET_ID_SIZE)
+        tasks = []
+        offset = 0
+        for shard_index, index in enumerate(used):
+            header = shard_header(set_id, shard_index, len(used))
+            tasks.append((types[index], carrier_paths[index], output_paths[shard_index], header, spool_path, offset, sizes[index], channels,
+                          depth, profile))
+            offset += sizes[index]
+
+        os.makedirs(output_dir, exist_ok=True)
+        try:
+            with ProcessPoolExecutor(max_workers=workers or min(len(tasks), os.cpu_count() or 1)) as executor:
+                list(executor.map(_embed_shard, tasks))
+        except Exception:
+            # Don't leave an incomplete set behind
+            for output_path in output_paths:
+                if os.path.exists(output_path):
+                    os.remove(output_path)
+            raise
+    finally:
+        os.remove(spool_path)
+
+    print(f"File '{file_to_hide}' has been split into {len(tasks)} shards in '{output_dir}'.")
+    return output_paths
+
+
+def _read_shard(args):
+    # Extract the shard of one carrier to shard_path, in a worker process.
+    # Only the (set ID, index, total) of its header are sent back
+    kind, path, shard_path = args
+    head = b''
+    try:
+        if kind == 'audio':
+            params, carrier = map_samples(path)
+            seed = params.nframes
+        else:
+            with Image.open(path) as img:
+                carrier = img_carrier(img, path)
+                seed = compute_seed_from_image_dimensions(img)
+        chunks = extract_payload_chunks(carrier, seed)
+        for chunk in chunks:
+            head += chunk
+            if len(head) >= SHARD_HEADER_SIZE:
+                break
+    except ValueError:
+        head = b''
+
+    shard = parse_shard_header(head)
+    if shard is None:
+        raise ValueError(f"'{path}' does not hold a shard.")
+    with open(shard_path, 'wb') as f:
+        f.write(head[SHARD_HEADER_SIZE:])
+        for chunk in chunks:
+            f.write(chunk)
+    return shard
+
+
+def read_shards(work_dir, shard_paths):
+    # Yield the shards in index order a chunk at a time, the extracted shards
+    # are removed once they have all been read
+    with work_dir:
+        for shard_path in shard_paths:
+            with open(shard_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk
+
+
+def extract_chunks_from_carriers(carrier_paths, private_key, workers=None):
+    # Extract the shards of the carriers in parallel, in any order, and
+    # decrypt the reassembled payload. The set ID and index only put the
+    # shards back in order, the AEAD tags of the payload catch any shard
+    # that is missing, reordered or altered. Every shard is extracted to a
+    # temporary file and the files are read back in order, so the shards are
+    # never held in memory. Returns the filename and an iterator over the
+    # file data
+    if not carrier_paths:
+        raise ValueError("Give at least one carrier.")
+    work_dir = tempfile.TemporaryDirectory()
+    try:
+        tasks = [(carrier_type(path), path, os.path.join(work_dir.name, str(position))) for position, path in enumerate(carrier_paths)]
+        with ProcessPoolExecutor(max_workers=workers or min(len(tasks), os.cpu_count() or 1)) as executor:
+            shards = list(executor.map(_read_shard, tasks))
+
+        if len({set_id for set_id, _, _ in shards}) != 1:
+            raise ValueError("The carriers hold shards of more than one secret.")
+        total = shards[0][2]
+        shard_paths = {}
+        for (_, index, shard_total), (_, _, shard_path) in zip(shards, tasks):
+            if shard_total != total:
+                raise ValueError("The shards disagree on the size of their set.")
+            shard_paths[index] = shard_path
+        missing = [str(index) for index in range(total) if index not in shard_paths]
+        if missing:
+            raise ValueError(f"{len(missing)} of {total} shards are missing: {', '.join(missing)}.")
+
+        encrypted_session_key_size = private_key.key_size // 8
+        return decrypt_stream(read_shards(work_dir, [shard_paths[index] for index in range(total)]), encrypted_session_key_size,
+                              private_key)
+    except Exception:
+        work_dir.cleanup()
+        raise
+
+
+def extract_file_from_carriers(carrier_paths, output_file_path, private_key_path, passphrase, workers=None, overwrite=None, private_key=None):
+    # Check an explicit output before the shards are extracted
+    if output_file_path and not confirm_overwrite(output_file_path, overwrite):
+        print("Extraction cancelled.")
+        return
+
+    # Load the private key, unless it was already loaded
+    if private_key is None:
+        private_key = load_private_key(private_key_path, passphrase)
+
+    filename, filedata = extract_chunks_from_carriers(carrier_paths, private_key, workers)
+
+    # If no output file path is provided, use the extracted filename, and
+    # check if that file already exists
+    if not output_file_path:
+        output_file_path = os.path.join(os.getcwd(), filename)
+        if not confirm_overwrite(output_file_path, overwrite):
+            print("Extraction cancelled.")
+            return
+
+    # Write the decompressed data to the output file a chunk at a time
+    try:
+        with open(output_file_path, 'wb') as f:
+            for chunk in filedata:
+                f.write(chunk)
+    except Exception:
+        # Don't leave a partially extracted file behind
+        os.remove(output_file_path)
+        raise
+
+    print(f"File extracted to {output_file_path}")
+    return output_file_path
@@ -0,0 +1,363 @@
+import io
+import struct
+import zlib
+import numpy as np
+from PIL import Image, TiffImagePlugin
+from timings import stage
+
+# Pixels decoded at a time in stream mode, a strip holds about this many rows of pixels
+TILE_PIXELS = 1 << 20
+
+# Bytes read from the carrier at a time
+READ_SIZE = 1 << 20
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# Modes of the PNG color types that can be processed in strips (8 bits per sample)
+PNG_MODES = {0: 'L', 2: 'RGB', 6: 'RGBA'}
+
+# Modes of the TIFF (photometric interpretation, samples per pixel) pairs
+# that can be processed in strips (8 bits per sample, samples interleaved)
+TIFF_MODES = {(1, 1): 'L', (2, 3): 'RGB', (2, 4): 'RGBA'}
+
+# TIFF compressions Pillow can decode a strip of, and the ones it encodes
+TIFF_COMPRESSIONS = {1, 5, 8, 32773, 32946}
+
+# Tags that describe how the samples of a TIFF strip are stored
+TIFF_SAMPLE_TAGS = {258: 3, 259: 3, 262: 3, 266: 3, 277: 3, 284: 3, 317: 3, 338: 3}
+
+# Tags copied from the carrier to the output, with their type
+TIFF_COPIED_TAGS = {282: 5, 283: 5, 296: 3, 34675: 7}
+
+# struct format of a value of every TIFF type that is written, rationals are two LONGs
+TIFF_TYPES = {3: 'H', 4: 'L', 5: 'L', 7: 'B', 16: 'Q'}
+
+
+def strip_rows(width, unit_rows=1):
+    # Rows per strip, a multiple of unit_rows, so a strip holds about TILE_PIXELS pixels
+    return unit_rows * max(1, TILE_PIXELS // (width * unit_rows))
+
+
+def open_strips(path):
+    # Open a PNG or TIFF carrier to be processed in strips. Only its header
+    # is read, so carriers of any size can be opened
+    with open(path, 'rb') as f:
+        signature = f.read(8)
+    if signature == PNG_SIGNATURE:
+        return PngStrips(path)
+    if signature[:4] in (b'II*\0', b'MM\0*', b'II+\0'):
+        return TiffStrips(path)
+    raise ValueError("Only PNG and TIFF carriers can be processed in strips.")
+
+
+class PngStrips:
+    # A PNG decoded and encoded a strip of rows at a time. The scanlines are
+    # inflated as they are needed, and Pillow undoes their filters with the
+    # row above the strip prepended, so no more than a strip is ever decoded
+
+    format = 'PNG'
+
+    def __init__(self, path):
+        self.path = path
+        # Type, data offset and length of every chunk
+        self.chunks = []
+        header = None
+        with open(path, 'rb') as f:
+            if f.read(8) != PNG_SIGNATURE:
+                raise ValueError("Not a PNG file.")
+            while not self.chunks or self.chunks[-1][0] != b'IEND':
+                head = f.read(8)
+                if len(head) < 8:
+                    raise ValueError("Truncated PNG file.")
+                length, kind = struct.unpack('>I4s', head)
+                self.chunks.append((kind, f.tell(), length))
+                if kind == b'IHDR':
+                    header = f.read(length)
+                    f.seek(4, 1)
+                else:
+                    f.seek(length + 4, 1)
+
+        if header is None or len(header) != 13:
+            raise ValueError("PNG file has no header.")
+        width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', header)
+        if bit_depth != 8 or color_type not in PNG_MODES or interlace:
+            raise ValueError("Only 8-bit grayscale, RGB and RGBA PNGs that are not interlaced can be processed in strips.")
+        self.size = (width, height)
+        self.mode = PNG_MODES[color_type]
+        self.bands = len(self.mode)
+        self.strip_rows = strip_rows(width)
+
+    def _scanlines(self, size):
+        # Yield the inflated scanlines, `size` bytes at a time
+        decompressor = zlib.decompressobj()
+        data = bytearray()
+        with open(self.path, 'rb') as f:
+            for kind, offset, length in self.chunks:
+                if kind != b'IDAT':
+                    continue
+                f.seek(offset)
+                while length:
+                    compressed = f.read(min(length, READ_SIZE))
+                    length -= len(compressed)
+                    while compressed:
+                        data += decompressor.decompress(compressed, size - len(data))
+                        compressed = decompressor.unconsumed_tail
+                        if len(data) == size:
+                            yield data
+                            data = bytearray()
+        if data:
+            yield data
+
+    def read_strips(self, units=None):
+        # Yield (first pixel, pixels) for the strips in order, or only for
+        # the strips holding one of the sorted pixel indices in units. The
+        # strips before the last one needed still have to be decoded
+        width, height = self.size
+        row_size = width * self.bands
+        strip_units = self.strip_rows * width
+        wanted = None if units is None else set((np.asarray(units) // strip_units).tolist())
+        last = height if wanted is None else min(height, (max(wanted, default=-1) + 1) * self.strip_rows)
+
+        prior = np.zeros(row_size, dtype=np.uint8)
+        row = 0
+        scanlines = self._scanlines(self.strip_rows * (row_size + 1))
+        while row < last:
+            with stage('decode'):
+                filtered = next(scanlines, b'')
+                rows = min(len(filtered) // (row_size + 1), height - row)
+                if rows == 0:
+                    raise ValueError("Truncated PNG file.")
+                # The row above goes first, unfiltered, for the filters of the first row to refer to
+                data = zlib.compress(b'\0' + prior.tobytes() + filtered[:rows * (row_size + 1)], 0)
+                pixels = np.array(Image.frombytes(self.mode, (width, rows + 1), data, 'zip', self.mode))
+                pixels = pixels.reshape(rows + 1, width, self.bands)[1:]
+            # The pixels may be changed once yielded, the next strip is unfiltered with the original row
+            prior = pixels[-1].reshape(-1).copy()
+            if wanted is None or row // self.strip_rows in wanted:
+                yield row * width, pixels
+            row += rows
+
+    def write(self, output_path, strips, options):
+        # Write a PNG with the chunks of the carrier and the pixels of the
+        # strips, which must come in order and cover the whole image
+        written = False
+        with open(self.path, 'rb') as source, open(output_path, 'wb') as output:
+            output.write(PNG_SIGNATURE)
+            for kind, offset, length in self.chunks:
+                if kind == b'IDAT':
+                    # The pixels replace the IDAT chunks of the carrier
+                    if not written:
+                        self._write_pixels(output, strips, options.get('compress_level', 6))
+                        written = True
+                elif kind != b'IEND':
+                    source.seek(offset - 8)
+                    _copy(source, output, length + 12)
+            _write_png_chunk(output, b'IEND', b'')
+
+    def _write_pixels(self, output, strips, level):
+        compressor = zlib.compressobj(level)
+        prior = np.zeros((self.size[0], self.bands), dtype=np.uint8)
+        for pixels in strips:
+            with stage('encode'):
+                _write_png_chunk(output, b'IDAT', compressor.compress(png_filter(pixels, prior, self.mode)))
+            prior = pixels[-1]
+        with stage('encode'):
+            _write_png_chunk(output, b'IDAT', compressor.flush())
+
+
+def png_filter(pixels, prior, mode):
+    # Filter the scanlines with Pillow's PNG encoder, which picks the filter
+    # of every row like libpng does, without compressing them. The row above
+    # goes first so the filters of the first row refer to it, and is dropped
+    rows = np.concatenate((prior[None], pixels))
+    img = Image.fromarray(rows.reshape(len(rows), -1) if mode == 'L' else rows, mode)
+    filtered = zlib.decompress(img.tobytes('zip', mode, 0, 0))
+    return memoryview(filtered)[len(filtered) // len(rows):]
+
+
+def _write_png_chunk(output, kind, data):
+    if kind == b'IDAT' and not data:
+        return
+    output.write(struct.pack('>I', len(data)) + kind)
+    output.write(data)
+    output.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(kind))))
+
+
+def _copy(source, output, size):
+    while size:
+        data = source.read(min(size, READ_SIZE))
+        if not data:
+            raise ValueError("Truncated carrier.")
+        output.write(data)
+        size -= len(data)
+
+
+class TiffStrips:
+    # A TIFF decoded and encoded a strip of rows at a time. Every strip or
+    # tile of the carrier is decoded on its own by Pillow, so only the strips
+    # that are needed are read. The output is always stored in strips
+
+    format = 'TIFF'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(8)
+            if header[2] == 43:
+                header += f.read(8)
+            ifd = TiffImagePlugin.ImageFileDirectory_v2(header)
+            f.seek(ifd.next)
+            ifd.load(f)
+        self.ifd = ifd
+
+        width, height = ifd[256], ifd[257]
+        samples = ifd.get(277, 1)
+        mode = TIFF_MODES.get((ifd.get(262), samples))
+        if mode is None or set(_values(ifd.get(258, 1))) != {8} or ifd.get(284, 1) != 1 or set(_values(ifd.get(339, 1))) != {1}:
+            raise ValueError("Only 8-bit grayscale, RGB and RGBA TIFFs with interleaved samples can be processed in strips.")
+        if ifd.get(259, 1) not in TIFF_COMPRESSIONS:
+            raise ValueError(f"TIFF compression {ifd.get(259)} can't be processed in strips.")
+        self.size = (width, height)
+        self.mode = mode
+        self.bands = len(mode)
+
+        # Tiles are stored like strips of their own width and height
+        self.tiled = 322 in ifd
+        if self.tiled:
+            self.tile_size = (ifd[322], ifd[323])
+            self.offsets, self.counts = _values(ifd[324]), _values(ifd[325])
+        else:
+            self.tile_size = (width, min(ifd.get(278, height), height))
+            self.offsets, self.counts = _values(ifd[273]), _values(ifd[279])
+        self.strip_rows = strip_rows(width, self.tile_size[1])
+
+    def _decode_tile(self, f, index, rows):
+        # Decode one strip or tile of the carrier as a single strip TIFF
+        tile_width = self.tile_size[0]
+        f.seek(self.offsets[index])
+        data = f.read(self.counts[index])
+        tags = [(tag, kind, _values(self.ifd[tag])) for tag, kind in TIFF_SAMPLE_TAGS.items() if tag in self.ifd]
+        with Image.open(io.BytesIO(strip_tiff(tile_width, rows, tags, data))) as img:
+            return np.asarray(img).reshape(rows, tile_width, self.bands)
+
+    def read_strips(self, units=None):
+        # Yield (first pixel, pixels) for the strips in order, or only for
+        # the strips holding one of the sorted pixel indices in units
+        width, height = self.size
+        tile_width, tile_height = self.tile_size
+        across = -(-width // tile_width)
+        strip_units = self.strip_rows * width
+        strips = range(-(-height // self.strip_rows))
+        if units is not None:
+            strips = sorted(set((np.asarray(units) // strip_units).tolist()))
+
+        with open(self.path, 'rb') as f:
+            for strip in strips:
+                first_row = strip * self.strip_rows
+                rows = min(self.strip_rows, height - first_row)
+                with stage('decode'):
+                    pixels = np.empty((rows, width, self.bands), dtype=np.uint8)
+                    for row in range(first_row, first_row + rows, tile_height):
+                        # Tiles are padded to their full height, the last strip is not
+                        used_rows = min(tile_height, height - row)
+                        tile_rows = tile_height if self.tiled else used_rows
+                        for column in range(across):
+                            tile = self._decode_tile(f, row // tile_height * across + column, tile_rows)
+                            x = column * tile_width
+                            pixels[row - first_row:row - first_row + used_rows, x:x + tile_width] = tile[:used_rows, :width - x]
+                yield first_row * width, pixels
+
+    def write(self, output_path, strips, options):
+        # Write a TIFF with the pixels of the strips, which must come in order
+        # and cover the whole image, in the compression of the options. The
+        # strips are written as they come and the directory goes last. Outputs
+        # that may not fit the 4 GB of a classic TIFF are written as BigTIFF
+        width, height = self.size
+        compression = options.get('compression', 'raw')
+        big = width * height * self.bands >= 1 << 31
+        offsets, counts = [], []
+        rows_per_strip = height
+        with open(output_path, 'wb') as output:
+            output.write(bytes(16 if big else 8))
+            for pixels in strips:
+                if not offsets:
+                    rows_per_strip = len(pixels)
+                with stage('encode'):
+                    data = encode_tiff_strip(pixels, self.mode, compression)
+                offsets.append(output.tell())
+                counts.append(len(data))
+                output.write(data)
+                if output.tell() & 1:
+                    output.write(b'\0')
+
+            offset_type = 16 if big else 4
+            tags = [
+                (256, 4, (width,)),
+                (257, 4, (height,)),
+                (258, 3, (8,) * self.bands),
+                (259, 3, (TiffImagePlugin.COMPRESSION_INFO_REV[compression],)),
+                (262, 3, (1 if self.mode == 'L' else 2,)),
+                (273, offset_type, tuple(offsets)),
+                (277, 3, (self.bands,)),
+                (278, 4, (rows_per_strip,)),
+                (279, offset_type, tuple(counts)),
+                (284, 3, (1,)),
+            ]
+            if self.mode == 'RGBA':
+                tags.append((338, 3, _values(self.ifd.get(338, 2))))
+            tags += [(tag, kind, _values(self.ifd[tag])) for tag, kind in TIFF_COPIED_TAGS.items() if tag in self.ifd]
+
+            ifd_offset = output.tell()
+            output.write(tiff_ifd(tags, ifd_offset, big))
+            output.seek(0)
+            output.write(b'II+\0' + struct.pack('<HHQ', 8, 0, ifd_offset) if big else b'II*\0' + struct.pack('<L', ifd_offset))
+
+
+def encode_tiff_strip(pixels, mode, compression):
+    # The stored bytes of one strip, compressed by Pillow when asked for
+    if compression == 'raw':
+        return pixels.tobytes()
+    rows = len(pixels)
+    img = Image.fromarray(pixels.reshape(rows, -1) if mode == 'L' else pixels, mode)
+    output = io.BytesIO()
+    img.save(output, 'TIFF', compression=compression, tiffinfo={278: rows})
+    with Image.open(output) as encoded:
+        offset, count = encoded.tag_v2[273][0], encoded.tag_v2[279][0]
+    return output.getbuffer()[offset:offset + count].tobytes()
+
+
+def strip_tiff(width, rows, tags, data):
+    # A little-endian TIFF holding a single strip, for Pillow to decode
+    offset = 8 + len(data) + (len(data) & 1)
+    tags = tags + [(256, 4, (width,)), (257, 4, (rows,)), (273, 4, (8,)), (278, 4, (rows,)), (279, 4, (len(data),))]
+    return b'II*\0' + struct.pack('<L', offset) + data + bytes(len(data) & 1) + tiff_ifd(tags, offset, False)
+
+
+def tiff_ifd(tags, offset, big=False):
+    # Serialize a little-endian image file directory that starts at offset,
+    # followed by the values that don't fit in their entry. tags holds
+    # (tag, type, values) tuples
+    count_format, entry_format, inline = ('<Q', '<HHQ', 8) if big else ('<H', '<HHL', 4)
+    data_offset = offset + struct.calcsize(count_format) + len(tags) * (struct.calcsize(entry_format) + inline) + inline
+
+    entries = b''
+    extra = b''
+    for tag, kind, values in sorted(tags):
+        if kind == 7:
+            data = bytes(values[0]) if isinstance(values[0], bytes) else bytes(values)
+        elif kind == 5:
+            data = b''.join(struct.pack('<LL', value.numerator, value.denominator) for value in values)
+        else:
+            data = struct.pack(f'<{len(values)}{TIFF_TYPES[kind]}', *values)
+        count = len(data) if kind == 7 else len(values)
+        if len(data) <= inline:
+            value = data.ljust(inline, b'\0')
+        else:
+            value = struct.pack('<Q' if big else '<L', data_offset + len(extra))
+            extra += data + bytes(len(data) & 1)
+        entries += struct.pack(entry_format, tag, kind, count) + value
+    return struct.pack(count_format, len(tags)) + entries + bytes(inline) + extra
+
+
+def _values(value):
+    return value if isinstance(value, tuple) else (value,)
@@ -0,0 +1,124 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Collector of the current CLI run or HTTP request, None when timings are off
+_active = ContextVar('stegano_timings', default=None)
+
+
+class Timings:
+    # Accumulates the time spent in every named stage and a few byte counts.
+    # Stages can nest (e.g. the compressor runs while the embedder pulls the
+    # next chunk), the inner stage pauses the outer one, so every stage only
+    # gets its own time and the stage times add up to at most the total
+
+    def __init__(self):
+        self.stages = {}
+        self.counts = {}
+        self.stack = []
+        self.start = time.perf_counter()
+        self.mark = self.start
+        self.total = None
+
+    def _charge(self, now):
+        name = self.stack[-1]
+        self.stages[name] = self.stages.get(name, 0.0) + now - self.mark
+        self.mark = now
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self._charge(now)
+        self.stack.append(name)
+        self.mark = now
+
+    def exit(self):
+        self._charge(time.perf_counter())
+        self.stack.pop()
+
+    def add(self, name, count):
+        self.counts[name] = self.counts.get(name, 0) + count
+
+    def finish(self):
+        if self.total is None:
+            self.total = time.perf_counter() - self.start
+        return self.total
+
+    def server_timing(self):
+        # Value of a Server-Timing header, durations are in milliseconds
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items()]
+        entries.append(f"total;dur={self.finish() * 1000:.2f}")
+        return ', '.join(entries)
+
+    def report(self):
+        total = self.finish()
+        lines = ["Timings:"]
+        for name, seconds in sorted(self.stages.items(), key=lambda item: -item[1]):
+            lines.append(f"  {name:<12} {seconds * 1000:10.1f} ms")
+        lines.append(f"  {'other':<12} {(total - sum(self.stages.values())) * 1000:10.1f} ms")
+        lines.append(f"  {'total':<12} {total * 1000:10.1f} ms")
+        for name, count in self.counts.items():
+            lines.append(f"  {name:<12} {count:10d} bytes")
+        return '\n'.join(lines)
+
+
+class _Stage:
+    __slots__ = ('timings', 'name')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.timings.enter(self.name)
+
+    def __exit__(self, *exc):
+        self.timings.exit()
+
+
+class _NoStage:
+    # Shared do-nothing stage, so disabled timings cost a single lookup
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name):
+    # Context manager that charges the time spent inside it to the stage
+    timings = _active.get()
+    if timings is None:
+        return _NO_STAGE
+    return _Stage(timings, name)
+
+
+def count(name, amount):
+    timings = _active.get()
+    if timings is not None:
+        timings.add(name, amount)
+
+
+def start():
+    # Start collecting in the current context, returns the collector and the
+    # token stop() needs
+    timings = Timings()
+    return timings, _active.set(timings)
+
+
+def stop(token):
+    _active.reset(token)
+
+
+@contextmanager
+def collect():
+    timings, token = start()
+    try:
+        yield timings
+    finally:
+        timings.finish()
+        stop(token)
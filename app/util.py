@@ -1,29 +1,127 @@
+import os
+import lzma
+import hashlib
 import numpy as np
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
+from timings import stage
+
+# Size of the chunks the secret and the payload are processed in
+CHUNK_SIZE = 1 << 18
+
+# Versioned payload containers start with this magic followed by a version
+# byte. Legacy containers have no magic and start with the filename size
+CONTAINER_MAGIC = b'SPXC'
+
+# Shards of a secret split across several carriers start with this magic
+# instead, followed by their set ID, index and the number of shards
+SHARD_MAGIC = b'SPXS'
+LEGACY_CONTAINER_VERSION = 0
+HKDF_CONTAINER_VERSION = 1
+AEAD_CONTAINER_VERSION = 2
+CODEC_CONTAINER_VERSION = 3
+RECIPIENTS_CONTAINER_VERSION = 4
+CONTAINER_VERSION = RECIPIENTS_CONTAINER_VERSION
+
+# From RECIPIENTS_CONTAINER_VERSION on the session key is wrapped for every
+# recipient. The header holds the number of recipients and a table with the
+# key ID and the size of the wrapped key of each, followed by the wrapped keys
+KEY_ID_SIZE = 8
+
+# AEAD containers seal the compressed secret in segments of this size, each
+# followed by its tag. The nonce is a random prefix, the segment number and a
+# flag marking the final segment
+AEAD_SEGMENT_SIZE = CHUNK_SIZE
+AEAD_TAG_SIZE = 16
+NONCE_PREFIX_SIZE = 7
+
+# Codecs the secret can be compressed with. From CODEC_CONTAINER_VERSION on
+# the header holds the codec byte, older containers always use zlib. lzma
+# data is stored as a raw LZMA2 stream, the AEAD tags already protect it
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}]
+
+# Carrier type of every file extension that can hold hidden data
+CARRIER_EXTENSIONS = {'.png': 'image', '.bmp': 'image', '.tga': 'image', '.tif': 'image', '.tiff': 'image', '.wav': 'audio'}
+
+# Number and size of the blocks sampled from a secret to pick its compression
+SAMPLE_BLOCKS = 4
+SAMPLE_BLOCK_SIZE = 1 << 14
+
+def derive_key(session_key, salt, version):
+    if version == LEGACY_CONTAINER_VERSION:
+        # Legacy containers stretch the session key with PBKDF2
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=200000,
+            backend=default_backend()
+        )
+    else:
+        # The session key is 256 random bits, so a single HKDF step is enough
+        kdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            info=b'stegano payload key',
+            backend=default_backend()
+        )
+    with stage('kdf'):
+        return kdf.derive(session_key)
+
+def segment_nonce(nonce_prefix, counter, final):
+    return nonce_prefix + counter.to_bytes(4, 'big') + bytes([final])
 
 def compute_seed_from_image_dimensions(img):
     width, height = img.size
     return width + height
 
-def load_public_key(key_path):
-    with open(key_path, 'rb') as key_file:
-        public_key = serialization.load_pem_public_key(
-            key_file.read(),
+def parse_public_key(pem):
+    with stage('parse_key'):
+        return serialization.load_pem_public_key(
+            pem,
+            backend=default_backend()
+        )
+
+def parse_private_key(pem, passphrase):
+    with stage('parse_key'):
+        return serialization.load_pem_private_key(
+            pem,
+            password=passphrase.encode(),
             backend=default_backend()
         )
+
+def key_id(public_key):
+    # Short ID of a public key in the recipient table, the start of the
+    # SHA-256 of its DER encoding
+    der = public_key.public_bytes(serialization.Encoding.DER, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.sha256(der).digest()[:KEY_ID_SIZE]
+
+def load_public_key(key_path):
+    with open(key_path, 'rb') as key_file:
+        public_key = parse_public_key(key_file.read())
     return public_key
 
 def load_private_key(key_path, passphrase):
     # passphrase = getpass("Enter the private key passphrase: ")
     with open(key_path, 'rb') as key_file:
-        private_key = serialization.load_pem_private_key(
-            key_file.read(),
-            password=passphrase.encode(),
-            backend=default_backend()
-        )
+        private_key = parse_private_key(key_file.read(), passphrase)
     return private_key
 
+def confirm_overwrite(path, overwrite=None):
+    # Ask before replacing an existing file, unless an overwrite policy is
+    # given (True replaces it, False keeps it) so batch runs never block
+    if not os.path.exists(path):
+        return True
+    if overwrite is None:
+        return input(f"The file '{path}' already exists. Overwrite? (y/n): ").lower() == 'y'
+    return overwrite
+
 def get_data_type(bytes_per_sample):
      # Convert frames to a numpy array
     if bytes_per_sample == 1:
@@ -35,4 +133,76 @@ def get_data_type(bytes_per_sample):
     else:
         raise ValueError("Unsupported sample width")
     
-    return dtype
\ No newline at end of file
+    return dtype
+
+def read_chunks(data, chunk_size=CHUNK_SIZE):
+    # Yield the secret a chunk at a time, it can be given as bytes or as a binary file
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        yield data
+        return
+    while True:
+        chunk = data.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+def data_size(data):
+    # Number of bytes left in the secret (bytes or a binary file), or None
+    # when the file can't tell without reading it
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    try:
+        position = data.tell()
+        size = data.seek(0, os.SEEK_END)
+        data.seek(position)
+    except (AttributeError, OSError, ValueError):
+        return None
+    return size - position
+
+def sample_data(data, blocks=SAMPLE_BLOCKS, block_size=SAMPLE_BLOCK_SIZE):
+    # Evenly spaced blocks of the secret (bytes or a binary file) joined
+    # together, or the whole secret when it is small. A file is left where
+    # it was. Returns None when the file can't be sampled without consuming it
+    size = data_size(data)
+    if size is None:
+        return None
+    if size <= blocks * block_size:
+        positions, block_size = [0], size
+    else:
+        positions = [i * (size - block_size) // (blocks - 1) for i in range(blocks)]
+
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return b''.join(bytes(data[position:position + block_size]) for position in positions)
+    start = data.tell()
+    try:
+        sample = bytearray()
+        for position in positions:
+            data.seek(start + position)
+            sample += data.read(block_size)
+    finally:
+        data.seek(start)
+    return bytes(sample)
+
+def byte_entropy(data):
+    # Shannon entropy of the byte values in bits per byte, 8 for random data
+    if not data:
+        return 0.0
+    counts = np.bincount(np.frombuffer(data, dtype=np.uint8), minlength=256)
+    probabilities = counts[counts > 0] / len(data)
+    return float(-(probabilities * np.log2(probabilities)).sum())
+
+def split_segments(pieces, segment_size):
+    # Regroup pieces of any size into segments of exactly segment_size bytes.
+    # Yields (segment, final) pairs, the final segment holds whatever is left
+    # and is never larger than segment_size (it may be empty)
+    pending = bytearray()
+    for piece in pieces:
+        pending += piece
+        if len(pending) <= segment_size:
+            continue
+        count = (len(pending) - 1) // segment_size
+        with memoryview(pending) as view:
+            for i in range(count):
+                yield bytes(view[i * segment_size:(i + 1) * segment_size]), False
+        del pending[:count * segment_size]
+    yield bytes(pending), True
@@ -0,0 +1,136 @@
+# Compare the compression modes of the payload on typical secrets: text and
+# JSON, sensor data, JPEGs, zip archives, video (random bytes stand in for
+# it) and a tar mixing them. Every secret is run through the whole encrypt
+# and decrypt pipeline with each mode, and the time spent compressing, the
+# payload size and the mode auto picked are reported
+import argparse
+import io
+import os
+import sys
+import tarfile
+import zipfile
+import numpy as np
+from PIL import Image
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from encrypt import encrypt_preprocess, choose_compression, COMPRESSION_CHOICES, COMPRESSION_MODES
+from decrypt import decrypt_postprocess
+from timings import collect
+
+WORDS = 'GET POST /api/v1/items /login user session ok error timeout cache miss hit retry worker queue'.split()
+
+
+def make_text(size, rng):
+    lines = []
+    length = 0
+    while length < size:
+        words = ' '.join(rng.choice(WORDS, 6))
+        line = f"2024-05-{rng.integers(1, 29):02d} 12:{rng.integers(0, 60):02d}:{rng.integers(0, 60):02d} {words} {rng.integers(0, 100000)}\n"
+        lines.append(line)
+        length += len(line)
+    return ''.join(lines).encode()[:size]
+
+
+def make_json(size, rng):
+    records = []
+    length = 0
+    while length < size:
+        record = f'{{"id": {rng.integers(0, 1 << 31)}, "name": "{rng.choice(WORDS)}", "score": {rng.random():.6f}, "tags": ["{rng.choice(WORDS)}", "{rng.choice(WORDS)}"]}},\n'
+        records.append(record)
+        length += len(record)
+    return ('[' + ''.join(records)).encode()[:size]
+
+
+def make_sensor(size, rng):
+    # float32 readings of a slowly drifting signal with noise
+    values = np.cumsum(rng.normal(0, 0.01, size // 4)).astype(np.float32)
+    return values.tobytes()
+
+
+def make_jpeg(size, rng):
+    # Noisy photos saved as JPEGs, concatenated
+    jpegs = bytearray()
+    while len(jpegs) < size:
+        x = np.linspace(0, 200, 1024, dtype=np.float32)[None, :, None]
+        y = np.linspace(0, 200, 768, dtype=np.float32)[:, None, None]
+        pixels = (x + y) / 2 + rng.normal(0, 12, (768, 1024, 3))
+        output = io.BytesIO()
+        Image.fromarray(pixels.clip(0, 255).astype(np.uint8), 'RGB').save(output, 'JPEG', quality=90)
+        jpegs += output.getvalue()
+    return bytes(jpegs[:size])
+
+
+def make_zip(size, rng):
+    output = io.BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+        part = 0
+        while output.tell() < size:
+            archive.writestr(f'log-{part}.txt', make_text(1 << 20, rng))
+            part += 1
+    return output.getvalue()[:size]
+
+
+def make_video(size, rng):
+    return rng.bytes(size)
+
+
+def make_mixed(size, rng):
+    # A tar holding a third of text, a third of JPEGs and a third of zip
+    output = io.BytesIO()
+    with tarfile.open(fileobj=output, mode='w') as archive:
+        for name, make in (('notes.txt', make_text), ('photos.jpg', make_jpeg), ('logs.zip', make_zip)):
+            data = make(size // 3, rng)
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return output.getvalue()
+
+
+SECRETS = {
+    'text': make_text,
+    'json': make_json,
+    'sensor': make_sensor,
+    'jpeg': make_jpeg,
+    'zip': make_zip,
+    'video': make_video,
+    'mixed': make_mixed,
+}
+
+
+def run(secret, compression, public_key, private_key, repeat):
+    best = None
+    for _ in range(repeat):
+        with collect() as timings:
+            payload = encrypt_preprocess(secret, b'secret.bin', public_key, compression=compression)
+        seconds = timings.stages.get('compress', 0.0)
+        best = seconds if best is None else min(best, seconds)
+    data, _ = decrypt_postprocess(payload, private_key.key_size // 8, private_key)
+    assert data == secret
+    return best, len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the compression modes of the payload on typical secrets')
+    parser.add_argument('--size', type=int, default=8, help='Size of every secret in MB (default: 8)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per secret and mode, the fastest is kept (default: 3)')
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    public_key = private_key.public_key()
+    rng = np.random.default_rng(0)
+    modes = {codec_level: name for name, codec_level in COMPRESSION_MODES.items()}
+
+    print(f"{args.size} MB secrets, best of {args.repeat}")
+    print(f"  {'secret':8}{'mode':6}{'compress':>12}{'payload':>12}{'ratio':>8}")
+    for name, make in SECRETS.items():
+        secret = make(args.size << 20, rng)
+        for compression in COMPRESSION_CHOICES:
+            seconds, size = run(secret, compression, public_key, private_key, args.repeat)
+            picked = f"  -> {modes[choose_compression(secret)]}" if compression == 'auto' else ''
+            print(f"  {name:8}{compression:6}{seconds * 1000:9.1f} ms{size / 1e6:9.2f} MB{size / len(secret):8.3f}{picked}")
+
+
+if __name__ == '__main__':
+    main()
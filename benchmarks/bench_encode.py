@@ -0,0 +1,67 @@
+# Compare the encoding profiles of the output image: every supported format
+# is saved with the fast, balanced and smallest profile and the encode time
+# and output size are reported, so a deployment can pick between CPU time
+# and bandwidth
+import argparse
+import io
+import os
+import sys
+import time
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from image import save_img, ENCODING_PROFILES
+
+
+def make_carrier(width, height, channels, depth):
+    # A smooth gradient with a little noise, with the low bits of the carrying
+    # channels replaced by random bits as if a secret filled the image
+    rng = np.random.default_rng(width * height)
+    x = np.linspace(0, 247, width, dtype=np.float32)[None, :]
+    y = np.linspace(0, 247, height, dtype=np.float32)[:, None]
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    pixels[:, :, 0] = x
+    pixels[:, :, 1] = y
+    pixels[:, :, 2] = (x + y) / 2
+    pixels[:, :, 3] = 255
+    pixels[:, :, :3] += rng.integers(0, 8, (height, width, 3), dtype=np.uint8)
+
+    mask = np.uint8((1 << depth) - 1)
+    for band in channels:
+        pixels[:, :, band] = (pixels[:, :, band] & ~mask) | rng.integers(0, 1 << depth, (height, width), dtype=np.uint8)
+    return Image.fromarray(pixels, 'RGBA')
+
+
+def encode(img, host_format, profile, repeat):
+    best = None
+    for _ in range(repeat):
+        output = io.BytesIO()
+        start = time.perf_counter()
+        save_img(img, output, host_format, profile)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, output.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the encode time and output size of every encoding profile')
+    parser.add_argument('--width', type=int, default=2000, help='Image width (default: 2000)')
+    parser.add_argument('--height', type=int, default=1000, help='Image height (default: 1000)')
+    parser.add_argument('--channels', type=str, default='RGB', help='Channels filled with hidden bits (default: RGB)')
+    parser.add_argument('--bits', type=int, default=1, help='Hidden bits per channel (default: 1)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per format and profile, the fastest is kept (default: 3)')
+    args = parser.parse_args()
+
+    img = make_carrier(args.width, args.height, ['RGBA'.index(channel) for channel in args.channels.upper()], args.bits)
+
+    print(f"{args.width}x{args.height} RGBA, {args.bits} hidden bit(s) in {args.channels.upper()}, best of {args.repeat}")
+    print(f"  {'format':8}{'profile':10}{'encode':>12}{'size':>14}")
+    for host_format in ('PNG', 'TIFF', 'TGA', 'BMP'):
+        for profile in ENCODING_PROFILES:
+            seconds, size = encode(img, host_format, profile, args.repeat)
+            print(f"  {host_format:8}{profile:10}{seconds * 1000:9.1f} ms{size / 1e6:11.2f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# Compare the throughput of the legacy PBKDF2 container with the HKDF
+# container: every request runs encrypt_preprocess and decrypt_postprocess
+# on a small secret, which is the crypto work of one hide plus one extract
+import argparse
+import os
+import sys
+import time
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from encrypt import encrypt_preprocess
+from decrypt import decrypt_postprocess
+from util import LEGACY_CONTAINER_VERSION, HKDF_CONTAINER_VERSION
+
+
+def requests_per_second(version, private_key, secret, duration):
+    public_key = private_key.public_key()
+    key_size = private_key.key_size // 8
+
+    requests = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        payload = encrypt_preprocess(secret, b'secret.txt', public_key, version)
+        data, _ = decrypt_postprocess(payload, key_size, private_key)
+        assert data == secret
+        requests += 1
+
+    return requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the payload key derivation of each container version')
+    parser.add_argument('--key-size', type=int, default=4096, help='RSA key size (default: 4096, as generate_keys.py)')
+    parser.add_argument('--secret-size', type=int, default=1024, help='Size of the secret in bytes (default: 1024)')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds to run each version for (default: 5)')
+    args = parser.parse_args()
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=args.key_size, backend=default_backend())
+    secret = os.urandom(args.secret_size)
+
+    legacy = requests_per_second(LEGACY_CONTAINER_VERSION, private_key, secret, args.duration)
+    hkdf = requests_per_second(HKDF_CONTAINER_VERSION, private_key, secret, args.duration)
+
+    print(f"RSA-{args.key_size}, {args.secret_size} byte secret, hide + extract per request, single core")
+    print(f"  PBKDF2 (legacy): {legacy:8.1f} requests/s")
+    print(f"  HKDF:            {hkdf:8.1f} requests/s")
+    print(f"  speedup:         {hkdf / legacy:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,417 @@
+# Reproducible benchmark suite for the hide and extract hot paths.
+#
+# Synthetic carriers (PNG images and 16-bit stereo WAVs) and random secrets
+# are generated into a work directory and cached there. Every carrier/secret
+# case runs in a fresh process and times each stage of the image and audio
+# pipelines (decode, encrypt, embed, encode, and back), recording the
+# process' peak RSS after every stage. Results are written as JSON and can
+# be compared against a stored baseline to catch regressions:
+#
+#   python benchmarks/bench_suite.py run --output results.json
+#   python benchmarks/bench_suite.py run --suite full --baseline baseline.json
+#   python benchmarks/bench_suite.py compare results.json baseline.json
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.backends import default_backend
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+from util import load_public_key, load_private_key, compute_seed_from_image_dimensions, get_data_type
+from encrypt import encrypt_preprocess
+from decrypt import decrypt_postprocess
+from lsb import required_values, embed_payload, extract_payload
+from image import CHANNEL_BANDS, hide_file_in_img_util, extract_file_from_img_util, img_carrier
+from audio import hide_file_in_audio_util, hide_file_in_audio_stream, extract_file_from_audio_util, extract_file_from_audio_stream
+
+KB = 1 << 10
+MB = 1 << 20
+
+# Carriers and secrets of every suite. Images are (name, width, height),
+# WAVs are (name, seconds) at 44.1 kHz, 16-bit stereo
+SUITES = {
+    'quick': {
+        'images': [('img-0.3mp', 640, 480), ('img-2mp', 1920, 1080)],
+        'audio': [('wav-10s', 10), ('wav-60s', 60)],
+        'secrets': [('1kb', KB), ('64kb', 64 * KB), ('1mb', MB)],
+    },
+    'full': {
+        'images': [('img-0.3mp', 640, 480), ('img-2mp', 1920, 1080), ('img-12mp', 4000, 3000), ('img-50mp', 8192, 6144)],
+        'audio': [('wav-10s', 10), ('wav-5min', 300), ('wav-60min', 3600)],
+        'secrets': [('1kb', KB), ('1mb', MB), ('10mb', 10 * MB), ('100mb', 100 * MB)],
+    },
+}
+
+# Layouts tried for every case, the first one with enough capacity is used
+IMAGE_LAYOUTS = [('R', 1), ('RGB', 1), ('RGB', 2), ('RGB', 4)]
+AUDIO_LAYOUTS = [1, 2, 4]
+
+SAMPLE_RATE = 44100
+
+# Stage timings that differ by less than this are treated as noise when comparing
+NOISE_FLOOR = 0.005
+
+
+def max_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / MB if sys.platform == 'darwin' else rss / KB
+
+
+def estimated_payload_size(secret_size):
+    # Random secrets don't compress, allow for the container header, the
+    # zlib framing and the AEAD tags
+    return secret_size + secret_size // 100 + 4 * KB
+
+
+def make_keys(workdir):
+    private_path = os.path.join(workdir, 'private.pem')
+    public_path = os.path.join(workdir, 'public.pem')
+    if not os.path.exists(private_path):
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=4096, backend=default_backend())
+        with open(private_path, 'wb') as f:
+            f.write(private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.BestAvailableEncryption(b'benchmark')))
+        with open(public_path, 'wb') as f:
+            f.write(private_key.public_key().public_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PublicFormat.SubjectPublicKeyInfo))
+    return public_path, private_path
+
+
+def make_image(workdir, name, width, height):
+    # A smooth gradient with a little noise, so the PNG codec does realistic work
+    path = os.path.join(workdir, name + '.png')
+    if not os.path.exists(path):
+        rng = np.random.default_rng(width * height)
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        x = np.linspace(0, 247, width, dtype=np.float32)
+        for row in range(0, height, 512):
+            rows = min(512, height - row)
+            y = np.linspace(row, row + rows - 1, rows, dtype=np.float32)[:, None] * 247 / max(1, height - 1)
+            noise = rng.integers(0, 8, (rows, width, 3), dtype=np.uint8)
+            pixels[row:row + rows, :, 0] = x[None, :]
+            pixels[row:row + rows, :, 1] = y
+            pixels[row:row + rows, :, 2] = (x[None, :] + y) / 2
+            pixels[row:row + rows] += noise
+        Image.fromarray(pixels, 'RGB').save(path, format='PNG', compress_level=1)
+    return path
+
+
+def make_audio(workdir, name, seconds):
+    # A tone with some noise, written a block at a time
+    path = os.path.join(workdir, name + '.wav')
+    if not os.path.exists(path):
+        rng = np.random.default_rng(seconds)
+        with wave.open(path, 'wb') as audio:
+            audio.setnchannels(2)
+            audio.setsampwidth(2)
+            audio.setframerate(SAMPLE_RATE)
+            for start in range(0, seconds * SAMPLE_RATE, MB):
+                frames = np.arange(start, min(start + MB, seconds * SAMPLE_RATE))
+                tone = 8000 * np.sin(2 * np.pi * 440 * frames / SAMPLE_RATE)
+                samples = tone[:, None] + rng.normal(0, 200, (len(frames), 2))
+                audio.writeframes(samples.astype(np.int16).tobytes())
+    return path
+
+
+def make_secret(workdir, name, size):
+    path = os.path.join(workdir, 'secret-' + name + '.bin')
+    if not os.path.exists(path):
+        rng = np.random.default_rng(size)
+        with open(path, 'wb') as f:
+            for start in range(0, size, 16 * MB):
+                f.write(rng.integers(0, 256, min(16 * MB, size - start), dtype=np.uint8).tobytes())
+    return path
+
+
+def plan_cases(suite, names=None):
+    # Pair every carrier with every secret it has room for
+    cases = []
+    for secret_name, secret_size in suite['secrets']:
+        payload_size = estimated_payload_size(secret_size)
+        for image_name, width, height in suite['images']:
+            for channels, depth in IMAGE_LAYOUTS:
+                bands = [CHANNEL_BANDS[channel] for channel in channels]
+                if required_values(payload_size, bands, depth) <= width * height:
+                    cases.append({"name": f"{image_name}/{secret_name}", "kind": "image", "carrier": image_name,
+                                  "width": width, "height": height, "secret": secret_name, "secret_size": secret_size,
+                                  "channels": channels, "bits": depth})
+                    break
+        for audio_name, seconds in suite['audio']:
+            for depth in AUDIO_LAYOUTS:
+                if required_values(payload_size, depth=depth) <= seconds * SAMPLE_RATE * 2:
+                    cases.append({"name": f"{audio_name}/{secret_name}", "kind": "audio", "carrier": audio_name,
+                                  "seconds": seconds, "secret": secret_name, "secret_size": secret_size, "bits": depth})
+                    break
+    if names:
+        cases = [case for case in cases if any(name in case['name'] for name in names)]
+    return cases
+
+
+class Timer:
+    # Times stages (best of repeat runs) and records the peak RSS after each one
+
+    def __init__(self, repeat):
+        self.repeat = repeat
+        self.stages = {}
+
+    def __call__(self, name, fn):
+        best = None
+        for _ in range(self.repeat):
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        self.stages[name] = {"seconds": round(best, 6), "peak_rss_mb": round(max_rss_mb(), 1)}
+        return result
+
+
+def load_image(data):
+    img = Image.open(data)
+    img.load()
+    return img
+
+
+def encode_image(img, host_format='PNG'):
+    output = io.BytesIO()
+    img.save(output, format=host_format)
+    return output.getvalue()
+
+
+def encode_audio(params, samples):
+    output = io.BytesIO()
+    with wave.open(output, 'wb') as audio:
+        audio.setparams(params)
+        audio.writeframes(samples)
+    return output.getvalue()
+
+
+def read_samples(data):
+    with wave.open(data, 'rb') as audio:
+        dtype = get_data_type(audio.getsampwidth())
+        return audio.getparams(), np.frombuffer(audio.readframes(audio.getnframes()), dtype=dtype).copy()
+
+
+def native_pixels(img, bands):
+    # The pixels in the mode embed_chunks_in_img works on: the image's own,
+    # RGB for palette images and for grayscale ones that need G or B
+    if img.mode == 'P' or (img.mode == 'L' and max(bands) > 0):
+        img = img.convert('RGB')
+    return np.array(img), img.mode
+
+
+def run_image_case(case, timer, carrier_path, secret, public_key, private_key):
+    bands = [CHANNEL_BANDS[channel] for channel in case['channels']]
+    depth = case['bits']
+
+    # Hide, stage by stage
+    img = timer('hide.decode', lambda: load_image(carrier_path))
+    seed = compute_seed_from_image_dimensions(img)
+    pixels, mode = timer('hide.convert', lambda: native_pixels(img, bands))
+    payload = timer('hide.encrypt', lambda: encrypt_preprocess(secret, b'secret.bin', public_key))
+    timer('hide.embed', lambda: embed_payload(pixels.reshape(-1, len(mode)), seed, payload, bands, depth))
+    carrier = timer('hide.encode', lambda: encode_image(Image.fromarray(pixels, mode)))
+    del img, pixels, payload
+
+    # And end to end through the library function
+    timer('hide.total', lambda: encode_image(*hide_file_in_img_util(
+        Image.open(carrier_path), os.path.basename(carrier_path), secret, b'secret.bin', public_key, case['channels'], depth)))
+
+    # Extract, stage by stage
+    img = timer('extract.decode', lambda: load_image(io.BytesIO(carrier)))
+    values = timer('extract.convert', lambda: img_carrier(img))
+    extracted = timer('extract.unembed', lambda: extract_payload(values, seed))
+    data, _ = timer('extract.decrypt', lambda: decrypt_postprocess(extracted, private_key.key_size // 8, private_key))
+    del img, values, extracted
+
+    data_total, _ = timer('extract.total', lambda: extract_file_from_img_util(Image.open(io.BytesIO(carrier)), private_key))
+    return data == secret and data_total == secret
+
+
+def run_audio_case(case, timer, carrier_path, secret, public_key, private_key):
+    depth = case['bits']
+
+    # Hide, stage by stage
+    params, samples = timer('hide.decode', lambda: read_samples(carrier_path))
+    seed = params.nframes
+    payload = timer('hide.encrypt', lambda: encrypt_preprocess(secret, b'secret.bin', public_key))
+    timer('hide.embed', lambda: embed_payload(samples.reshape(-1, 1), seed, payload, depth=depth))
+    carrier = timer('hide.encode', lambda: encode_audio(params, samples))
+    del samples, payload
+
+    # And end to end through the in-memory and the streaming library functions
+    def hide_total():
+        with wave.open(carrier_path, 'rb') as audio:
+            return encode_audio(audio.getparams(), hide_file_in_audio_util(audio, secret, b'secret.bin', public_key, depth=depth))
+
+    def hide_stream_total():
+        with wave.open(carrier_path, 'rb') as audio, tempfile.TemporaryFile() as output:
+            with wave.open(output, 'wb') as output_audio:
+                hide_file_in_audio_stream(audio, output_audio, secret, b'secret.bin', public_key, depth)
+
+    timer('hide.total', hide_total)
+    timer('hide.stream_total', hide_stream_total)
+
+    # Extract, stage by stage
+    params, samples = timer('extract.decode', lambda: read_samples(io.BytesIO(carrier)))
+    extracted = timer('extract.unembed', lambda: extract_payload(samples.reshape(-1, 1), seed))
+    data, _ = timer('extract.decrypt', lambda: decrypt_postprocess(extracted, private_key.key_size // 8, private_key))
+    del samples, extracted
+
+    def extract_total(extract):
+        with wave.open(io.BytesIO(carrier), 'rb') as audio:
+            return extract(audio, private_key)[0]
+
+    data_total = timer('extract.total', lambda: extract_total(extract_file_from_audio_util))
+    data_stream = timer('extract.stream_total', lambda: extract_total(extract_file_from_audio_stream))
+    return data == secret and data_total == secret and data_stream == secret
+
+
+def run_case(case, workdir, repeat):
+    # Runs in a fresh process, so the peak RSS belongs to this case alone
+    public_path, private_path = make_keys(workdir)
+    public_key = load_public_key(public_path)
+    private_key = load_private_key(private_path, 'benchmark')
+    with open(make_secret(workdir, case['secret'], case['secret_size']), 'rb') as f:
+        secret = f.read()
+
+    timer = Timer(repeat)
+    if case['kind'] == 'image':
+        carrier_path = make_image(workdir, case['carrier'], case['width'], case['height'])
+        ok = run_image_case(case, timer, carrier_path, secret, public_key, private_key)
+    else:
+        carrier_path = make_audio(workdir, case['carrier'], case['seconds'])
+        ok = run_audio_case(case, timer, carrier_path, secret, public_key, private_key)
+
+    if not ok:
+        raise ValueError(f"{case['name']}: the extracted secret does not match")
+    return dict(case, stages=timer.stages, peak_rss_mb=round(max_rss_mb(), 1))
+
+
+def prepare(cases, workdir):
+    # Generate the keys, carriers and secrets up front so they are not timed
+    make_keys(workdir)
+    for case in cases:
+        make_secret(workdir, case['secret'], case['secret_size'])
+        if case['kind'] == 'image':
+            make_image(workdir, case['carrier'], case['width'], case['height'])
+        else:
+            make_audio(workdir, case['carrier'], case['seconds'])
+
+
+def run(args):
+    cases = plan_cases(SUITES[args.suite], args.case)
+    os.makedirs(args.workdir, exist_ok=True)
+    print(f"Preparing {len(cases)} cases in {args.workdir}")
+
+    # Every process starts with the peak RSS of the process it was forked
+    # from, so the inputs are generated in a child and this one stays small
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        executor.submit(prepare, cases, args.workdir).result()
+
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            result = executor.submit(run_case, case, args.workdir, args.repeat).result()
+        results.append(result)
+        hide = result['stages']['hide.total']['seconds']
+        extract = result['stages']['extract.total']['seconds']
+        print(f"{case['name']:24} hide {hide:9.3f}s  extract {extract:9.3f}s  peak {result['peak_rss_mb']:8.1f} MB")
+
+    report = {
+        "suite": args.suite,
+        "repeat": args.repeat,
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cases": results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        return compare(args.output, args.baseline, args.tolerance)
+    return 0
+
+
+def compare(results_path, baseline_path, tolerance):
+    # Report every stage that got slower (or used more memory) than the
+    # baseline by more than the tolerance, return 1 if there are any
+    with open(results_path) as f:
+        results = {case['name']: case for case in json.load(f)['cases']}
+    with open(baseline_path) as f:
+        baseline = {case['name']: case for case in json.load(f)['cases']}
+
+    regressions = 0
+    for name in sorted(results.keys() & baseline.keys()):
+        for stage, current in results[name]['stages'].items():
+            previous = baseline[name]['stages'].get(stage)
+            if previous is None:
+                continue
+            ratio = current['seconds'] / max(previous['seconds'], 1e-9)
+            slower = ratio > 1 + tolerance and current['seconds'] - previous['seconds'] > NOISE_FLOOR
+            marker = 'REGRESSION' if slower else ''
+            regressions += slower
+            print(f"{name:24} {stage:22} {previous['seconds']:9.3f}s -> {current['seconds']:9.3f}s  x{ratio:5.2f}  {marker}")
+
+        previous_rss, current_rss = baseline[name]['peak_rss_mb'], results[name]['peak_rss_mb']
+        grew = current_rss > previous_rss * (1 + tolerance)
+        regressions += grew
+        print(f"{name:24} {'peak_rss_mb':22} {previous_rss:9.1f}   -> {current_rss:9.1f}    {'REGRESSION' if grew else ''}")
+
+    for name in sorted(baseline.keys() - results.keys()):
+        print(f"{name:24} not in the results")
+
+    print(f"{regressions} regressions (tolerance {tolerance:.0%})")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the hide and extract pipelines on synthetic carriers')
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='Run a benchmark suite')
+    run_parser.add_argument('--suite', choices=sorted(SUITES), default='quick', help='Carriers and secrets to run (default: quick)')
+    run_parser.add_argument('--case', action='append', help='Only run the cases whose name contains this (can be repeated)')
+    run_parser.add_argument('--repeat', type=int, default=1, help='Runs of every stage, the fastest one is kept (default: 1)')
+    run_parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'stegano-bench'), help='Where the synthetic inputs are generated and cached')
+    run_parser.add_argument('--output', default='bench-results.json', help='Path to the JSON results (default: bench-results.json)')
+    run_parser.add_argument('--baseline', help='Compare the results against this baseline and exit with 1 on regressions')
+    run_parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before a stage counts as a regression (default: 0.2)')
+
+    compare_parser = subparsers.add_parser('compare', help='Compare stored results against a baseline')
+    compare_parser.add_argument('results', help='Path to the JSON results')
+    compare_parser.add_argument('baseline', help='Path to the JSON baseline')
+    compare_parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown before a stage counts as a regression (default: 0.2)')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        sys.exit(run(args))
+    elif args.command == 'compare':
+        sys.exit(compare(args.results, args.baseline, args.tolerance))
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+import io
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+# The modules of the app import each other by bare name
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+PASSPHRASE = 'passphrase'
+
+
+@pytest.fixture(scope='session')
+def private_key():
+    # Generating a key is the slow part, every test shares this one
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture(scope='session')
+def public_key(private_key):
+    return private_key.public_key()
+
+
+@pytest.fixture(scope='session')
+def keys(private_key):
+    # The PEM data of the public key and of the private key, encrypted with PASSPHRASE
+    private_pem = private_key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                            serialization.BestAvailableEncryption(PASSPHRASE.encode()))
+    public_pem = private_key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+    return public_pem, private_pem
+
+
+@pytest.fixture(scope='session')
+def key_files(keys, tmp_path_factory):
+    # The same keys as files, for the functions that take key paths
+    directory = tmp_path_factory.mktemp('keys')
+    public_path, private_path = directory / 'public.pem', directory / 'private.pem'
+    public_path.write_bytes(keys[0])
+    private_path.write_bytes(keys[1])
+    return str(public_path), str(private_path)
+
+
+@pytest.fixture(scope='session')
+def carrier():
+    # A 200x100 RGB PNG holds 7500 payload bytes in R
+    pixels = np.random.default_rng(0).integers(0, 256, (100, 200, 3), dtype=np.uint8)
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, 'PNG')
+    return output.getvalue()
@@ -0,0 +1,115 @@
+import numpy as np
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from encrypt import encrypt_preprocess, max_payload_size, wrapped_key_size, COMPRESSION_CHOICES, COMPRESSION_MODES
+from decrypt import decrypt_postprocess, decrypt_stream
+from util import (CONTAINER_MAGIC, CONTAINER_VERSION, LEGACY_CONTAINER_VERSION, HKDF_CONTAINER_VERSION, AEAD_CONTAINER_VERSION,
+                  CODEC_CONTAINER_VERSION, RECIPIENTS_CONTAINER_VERSION, AEAD_SEGMENT_SIZE)
+
+FILENAME = 'secret.bin'
+VERSIONS = [LEGACY_CONTAINER_VERSION, HKDF_CONTAINER_VERSION, AEAD_CONTAINER_VERSION, CODEC_CONTAINER_VERSION, RECIPIENTS_CONTAINER_VERSION]
+AEAD_VERSIONS = [version for version in VERSIONS if version >= AEAD_CONTAINER_VERSION]
+
+# An empty secret, one that compresses well and one that spans several AEAD segments
+SECRETS = {
+    'empty': b'',
+    'text': b'container secret ' * 1000,
+    'segments': np.random.default_rng(0).bytes(2 * AEAD_SEGMENT_SIZE + 1),
+}
+
+
+@pytest.fixture(scope='module')
+def other_keys():
+    return [rsa.generate_private_key(public_exponent=65537, key_size=size) for size in (2048, 3072)]
+
+
+def test_current_version():
+    assert CONTAINER_VERSION == RECIPIENTS_CONTAINER_VERSION
+
+
+@pytest.mark.parametrize('secret', SECRETS.values(), ids=SECRETS.keys())
+@pytest.mark.parametrize('version', VERSIONS)
+def test_round_trip(private_key, public_key, version, secret):
+    payload = encrypt_preprocess(secret, FILENAME.encode(), public_key, version)
+
+    # Legacy containers start with the filename size, the others with the magic and their version
+    if version == LEGACY_CONTAINER_VERSION:
+        assert payload[:4] == len(FILENAME).to_bytes(4, 'big')
+    else:
+        assert payload[:len(CONTAINER_MAGIC) + 1] == CONTAINER_MAGIC + bytes([version])
+    assert len(payload) <= max_payload_size(len(secret), len(FILENAME), private_key.key_size // 8, version, 'zlib')
+
+    key_size = private_key.key_size // 8
+    assert decrypt_postprocess(payload, key_size, private_key) == (secret, FILENAME)
+
+    # The payload may arrive in pieces of any size
+    pieces = [payload[offset:offset + 777] for offset in range(0, len(payload), 777)]
+    filename, filedata = decrypt_stream(pieces, key_size, private_key)
+    assert (filename, b''.join(filedata)) == (FILENAME, secret)
+
+
+@pytest.mark.parametrize('compression', COMPRESSION_CHOICES)
+@pytest.mark.parametrize('version', [CODEC_CONTAINER_VERSION, RECIPIENTS_CONTAINER_VERSION])
+def test_codecs(private_key, public_key, version, compression):
+    for secret in SECRETS.values():
+        payload = encrypt_preprocess(secret, FILENAME.encode(), public_key, version, compression)
+        if compression in COMPRESSION_MODES:
+            assert payload[len(CONTAINER_MAGIC) + 1] == COMPRESSION_MODES[compression][0]
+        assert decrypt_postprocess(payload, private_key.key_size // 8, private_key) == (secret, FILENAME)
+
+
+def test_recipients(private_key, public_key, other_keys):
+    secret = SECRETS['text']
+    public_keys = [public_key] + [key.public_key() for key in other_keys]
+    # A key given twice is only wrapped for once
+    payload = encrypt_preprocess(secret, FILENAME.encode(), public_keys + [public_key], compression='none')
+    key_size, recipients = wrapped_key_size(public_keys)
+    assert recipients == 3
+    assert len(payload) == max_payload_size(len(secret), len(FILENAME), key_size, compression='none', recipients=recipients)
+
+    for key in [private_key] + other_keys:
+        assert decrypt_postprocess(payload, key.key_size // 8, key) == (secret, FILENAME)
+
+    with pytest.raises(ValueError, match='not encrypted for this private key'):
+        decrypt_postprocess(encrypt_preprocess(secret, FILENAME.encode(), public_key), 256, other_keys[0])
+
+
+@pytest.mark.parametrize('version', VERSIONS[:RECIPIENTS_CONTAINER_VERSION])
+def test_older_versions_have_one_recipient(public_key, other_keys, version):
+    with pytest.raises(ValueError, match='one public key'):
+        encrypt_preprocess(b'secret', FILENAME.encode(), [public_key, other_keys[0].public_key()], version)
+
+
+@pytest.mark.parametrize('version', AEAD_VERSIONS)
+def test_wrong_key_is_rejected(public_key, other_keys, version):
+    payload = encrypt_preprocess(SECRETS['text'], FILENAME.encode(), public_key, version)
+    with pytest.raises(ValueError):
+        decrypt_postprocess(payload, 256, other_keys[0])
+
+
+@pytest.mark.parametrize('version', AEAD_VERSIONS)
+def test_tampering_is_detected(private_key, public_key, version):
+    payload = encrypt_preprocess(SECRETS['segments'], FILENAME.encode(), public_key, version, 'none')
+    key_size = private_key.key_size // 8
+
+    # The filename is part of the authenticated header
+    tampered = bytearray(payload)
+    tampered[payload.index(FILENAME.encode())] ^= 1
+    with pytest.raises(ValueError, match='authentication'):
+        decrypt_postprocess(bytes(tampered), key_size, private_key)
+
+    tampered = bytearray(payload)
+    tampered[-5] ^= 1
+    with pytest.raises(ValueError, match='authentication'):
+        decrypt_postprocess(bytes(tampered), key_size, private_key)
+
+    # Cutting the last segment off is caught as well
+    with pytest.raises(ValueError):
+        decrypt_postprocess(payload[:-AEAD_SEGMENT_SIZE // 2], key_size, private_key)
+
+
+def test_unknown_version(private_key, public_key):
+    payload = bytearray(encrypt_preprocess(b'secret', FILENAME.encode(), public_key))
+    payload[len(CONTAINER_MAGIC)] = CONTAINER_VERSION + 1
+    with pytest.raises(ValueError, match='Unsupported container version'):
+        decrypt_postprocess(bytes(payload), private_key.key_size // 8, private_key)
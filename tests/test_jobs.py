@@ -0,0 +1,125 @@
+import io
+import os
+import time
+import pytest
+import app as app_module
+from jobs import JobManager
+from conftest import PASSPHRASE
+
+SECRET = b'job queue secret ' * 64
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    # Every test gets its own job directory and a single worker process
+    job_manager = JobManager(root=str(tmp_path / 'jobs'), workers=1, max_pending=2, ttl=3600)
+    monkeypatch.setattr(app_module, 'job_manager', job_manager)
+    monkeypatch.setattr(app_module, 'SPOOL_DIR', str(tmp_path))
+    yield job_manager
+    job_manager.shutdown()
+
+
+@pytest.fixture
+def client(manager):
+    return app_module.app.test_client()
+
+
+def submit_hide(client, keys, carrier, secret=SECRET):
+    return client.post('/jobs/imagehide', data={
+        'output': 'carrier.png',
+        'secret': (io.BytesIO(secret), 'secret.bin'),
+        'pubKey': (io.BytesIO(keys[0]), 'public.pem'),
+        'image': (io.BytesIO(carrier), 'carrier.png'),
+    })
+
+
+def wait(client, job_id, timeout=60):
+    # Poll the job until it has finished
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        response = client.get(f'/jobs/{job_id}')
+        assert response.status_code == 200
+        if response.json['status'] in ('done', 'failed'):
+            return response.json
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish in {timeout} seconds")
+
+
+def test_hide_and_extract_jobs(client, manager, keys, carrier):
+    response = submit_hide(client, keys, carrier)
+    assert response.status_code == 202
+    assert response.json['status'] == 'queued'
+    job_id = response.json['job']
+
+    status = wait(client, job_id)
+    assert status == {"job": job_id, "status": "done", "error": None, "filename": "carrier.png", "done": True}
+    # Only the result is kept once the job has finished
+    assert os.listdir(manager.job_dir(job_id)) == ['result']
+
+    result = client.get(f'/jobs/{job_id}/result')
+    assert result.status_code == 200
+    assert result.headers['Content-Disposition'] == 'attachment; filename=carrier.png'
+    hidden = result.data
+
+    response = client.post('/jobs/imageextract', data={
+        'output': '',
+        'passphrase': PASSPHRASE,
+        'priKey': (io.BytesIO(keys[1]), 'private.pem'),
+        'image': (io.BytesIO(hidden), 'carrier.png'),
+    })
+    assert response.status_code == 202
+    job_id = response.json['job']
+    assert wait(client, job_id)['filename'] == 'secret.bin'
+    assert client.get(f'/jobs/{job_id}/result').data == SECRET
+
+
+def test_failed_job_reports_its_error(client, manager, keys, carrier):
+    response = submit_hide(client, keys, carrier, secret=os.urandom(20000))
+    assert response.status_code == 202
+    job_id = response.json['job']
+
+    status = wait(client, job_id)
+    assert status['status'] == 'failed'
+    assert status['done'] is False
+    assert 'Carrier is not large enough' in status['error']
+
+    # A failed job has no result, and its inputs are gone
+    assert client.get(f'/jobs/{job_id}/result').status_code == 409
+    assert os.listdir(manager.job_dir(job_id)) == []
+
+
+def test_full_queue_is_refused(client, manager, keys, carrier):
+    # Fill both slots, the next submission is turned down before its uploads are stored
+    for _ in range(manager.max_pending):
+        manager.create()
+    jobs_before = set(os.listdir(manager.root))
+
+    response = submit_hide(client, keys, carrier)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '10'
+    assert response.json['done'] is False
+    assert set(os.listdir(manager.root)) == jobs_before
+
+
+def test_expired_jobs_are_removed(client, manager, keys, carrier):
+    job_id = submit_hide(client, keys, carrier).json['job']
+    wait(client, job_id)
+
+    # A directory left behind by an earlier run of the service
+    stale_dir = os.path.join(manager.root, 'stale')
+    os.makedirs(stale_dir)
+    old = time.time() - 2 * manager.ttl
+    os.utime(stale_dir, (old, old))
+
+    # Age the finished job past the ttl
+    manager.jobs[job_id]['finished'] -= 2 * manager.ttl
+
+    assert client.get(f'/jobs/{job_id}').status_code == 404
+    assert client.get(f'/jobs/{job_id}/result').status_code == 404
+    assert not os.path.exists(manager.job_dir(job_id))
+    assert not os.path.exists(stale_dir)
+
+
+def test_unknown_job(client):
+    assert client.get('/jobs/nope').status_code == 404
+    assert client.post('/jobs/videohide').status_code == 404
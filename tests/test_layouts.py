@@ -0,0 +1,100 @@
+import os
+import wave
+import numpy as np
+import pytest
+from PIL import Image
+from permutation import KeyedPermutation
+from lsb import FRAME_MAGIC, HEADER_BITS, bits_to_bytes, extract_bits, embed_payload, extract_payload, probe_payload
+from image import hide_file_in_img, extract_file_from_img
+from audio import hide_file_in_audio, extract_file_from_audio
+from conftest import PASSPHRASE
+
+SEED = 350
+
+
+@pytest.mark.parametrize('size', [1, 2, 7, 1000, 4097])
+def test_permutation_covers_every_index(size):
+    indices = KeyedPermutation(size, SEED).take(0, size)
+    assert sorted(indices.tolist()) == list(range(size))
+
+
+def test_permutation_is_keyed_and_lazy():
+    permutation = KeyedPermutation(10000, SEED)
+    indices = permutation.take(0, 10000)
+
+    # Any stretch of positions can be generated on its own, and mapped back
+    assert np.array_equal(permutation.take(2500, 100), indices[2500:2600])
+    assert permutation[9999] == indices[9999]
+    assert np.array_equal(permutation.invert(indices[:100]), np.arange(100))
+
+    assert np.array_equal(KeyedPermutation(10000, SEED).take(0, 10000), indices)
+    assert not np.array_equal(KeyedPermutation(10000, SEED + 1).take(0, 10000), indices)
+
+
+@pytest.mark.parametrize('bands, depth', [([0], 1), ([0, 1, 2], 2), ([0, 1, 2, 3], 4), ([1, 3], 3)])
+def test_frame_round_trip(bands, depth):
+    rng = np.random.default_rng(depth)
+    original = rng.integers(0, 256, (40000, 4), dtype=np.uint8)
+    carrier = original.copy()
+    payload = rng.bytes(3000)
+    embed_payload(carrier, SEED, payload, bands, depth)
+
+    # The frame header is in the LSB of band 0 at the first permuted units
+    units = KeyedPermutation(len(carrier), SEED).take(0, HEADER_BITS)
+    assert bits_to_bytes(extract_bits(carrier[:, 0], units)).startswith(FRAME_MAGIC)
+    assert probe_payload(carrier, SEED, 16) == (bands, depth, len(payload), payload[:16])
+    assert extract_payload(carrier, SEED) == payload
+
+    # Only the low bits of the layout's bands change, and the LSB of band 0 for the header
+    changed = carrier ^ original
+    assert changed[:, bands].max() < 1 << depth
+    assert changed[:, 0].max() < (1 << depth if 0 in bands else 2)
+    assert not changed[:, [band for band in range(1, 4) if band not in bands]].any()
+
+
+def test_payload_larger_than_the_carrier():
+    with pytest.raises(ValueError, match='not large enough'):
+        embed_payload(np.zeros((1000, 1), dtype=np.uint8), SEED, bytes(200))
+
+
+@pytest.mark.parametrize('bands, extension, channels, depth, options', [
+    (3, 'png', 'R', 1, {}),
+    (3, 'png', 'RGB', 2, {}),
+    (4, 'png', 'GA', 3, {}),
+    (1, 'png', 'R', 4, {}),
+    (3, 'tif', 'RGB', 1, {'mmap': True}),
+    (3, 'png', 'GB', 2, {'stream': True}),
+])
+def test_image_layout_round_trip(tmp_path, key_files, bands, extension, channels, depth, options):
+    pixels = np.random.default_rng(depth).integers(0, 256, (120, 160, bands), dtype=np.uint8)
+    carrier_path = str(tmp_path / f'carrier.{extension}')
+    Image.fromarray(pixels.squeeze()).save(carrier_path)
+    secret = os.urandom(1500)
+    (tmp_path / 'secret.bin').write_bytes(secret)
+
+    output_path = str(tmp_path / f'output.{extension}')
+    hide_file_in_img(carrier_path, str(tmp_path / 'secret.bin'), output_path, key_files[0], channels, depth, overwrite=True, **options)
+    extracted_path = str(tmp_path / 'extracted.bin')
+    extract_file_from_img(output_path, extracted_path, key_files[1], PASSPHRASE, overwrite=True, stream=options.get('stream', False))
+    with open(extracted_path, 'rb') as f:
+        assert f.read() == secret
+
+
+@pytest.mark.parametrize('depth, options', [(1, {}), (2, {'stream': True}), (4, {'mmap': True})])
+def test_audio_layout_round_trip(tmp_path, key_files, depth, options):
+    samples = np.random.default_rng(depth).integers(-2 ** 15, 2 ** 15, 40000, dtype=np.int16)
+    carrier_path = str(tmp_path / 'carrier.wav')
+    with wave.open(carrier_path, 'wb') as audio:
+        audio.setnchannels(2)
+        audio.setsampwidth(2)
+        audio.setframerate(44100)
+        audio.writeframes(samples.tobytes())
+    secret = os.urandom(3000)
+    (tmp_path / 'secret.bin').write_bytes(secret)
+
+    output_path = str(tmp_path / 'output.wav')
+    hide_file_in_audio(carrier_path, str(tmp_path / 'secret.bin'), output_path, key_files[0], depth, overwrite=True, **options)
+    extracted_path = str(tmp_path / 'extracted.bin')
+    extract_file_from_audio(output_path, extracted_path, key_files[1], PASSPHRASE, overwrite=True, **options)
+    with open(extracted_path, 'rb') as f:
+        assert f.read() == secret
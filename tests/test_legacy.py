@@ -0,0 +1,148 @@
+import io
+import random
+import wave
+import numpy as np
+import pytest
+from PIL import Image
+import app as app_module
+from encrypt import encrypt_preprocess
+from util import LEGACY_CONTAINER_VERSION
+from lsb import NoFrameHeader
+from rawimage import map_pixels
+from image import extract_file_chunks_from_img_util, extract_file_chunks_from_img_stream, extract_file_from_img
+from audio import (extract_file_chunks_from_audio_util, extract_file_chunks_from_audio_stream, extract_file_chunks_from_audio_mmap,
+                   extract_file_from_audio)
+from conftest import PASSPHRASE
+
+SECRET = b'legacy secret ' * 100
+FILENAME = 'legacy.txt'
+
+
+def legacy_embed(values, seed, payload):
+    # The layout of the original release: the whole index list shuffled by
+    # random.Random(seed), a bare 64-bit payload size, then the payload, one
+    # bit per value with the LSB matching rule
+    indices = list(range(len(values)))
+    random.Random(seed).shuffle(indices)
+    bits = np.unpackbits(np.frombuffer(len(payload).to_bytes(8, 'big') + payload, dtype=np.uint8))
+    selected = np.array(indices[:len(bits)])
+    values[selected] ^= (values[selected] ^ (values[selected] >> 1) ^ bits) & 1
+
+
+@pytest.fixture(scope='module')
+def legacy_payload(public_key):
+    # The container of the original release: zlib, PBKDF2 and AES-CBC, no magic
+    return encrypt_preprocess(SECRET, FILENAME.encode(), public_key, LEGACY_CONTAINER_VERSION)
+
+
+@pytest.fixture(scope='module')
+def legacy_images(legacy_payload, tmp_path_factory):
+    # The original release converted every carrier to RGBA and hid in R,
+    # seeded with the sum of the dimensions
+    pixels = np.random.default_rng(0).integers(0, 256, (150, 200, 4), dtype=np.uint8)
+    legacy_embed(pixels.reshape(-1, 4)[:, 0], 200 + 150, legacy_payload)
+    directory = tmp_path_factory.mktemp('legacy')
+    paths = {}
+    for extension in ('png', 'tif'):
+        paths[extension] = str(directory / f'legacy.{extension}')
+        Image.fromarray(pixels).save(paths[extension])
+    return paths
+
+
+@pytest.fixture(scope='module')
+def legacy_audio(legacy_payload, tmp_path_factory):
+    # Every sample of every channel is a candidate, seeded with the number of frames
+    samples = np.random.default_rng(1).integers(-2 ** 15, 2 ** 15, 40000, dtype=np.int16)
+    legacy_embed(samples, 20000, legacy_payload)
+    path = str(tmp_path_factory.mktemp('legacy') / 'legacy.wav')
+    with wave.open(path, 'wb') as audio:
+        audio.setnchannels(2)
+        audio.setsampwidth(2)
+        audio.setframerate(44100)
+        audio.writeframes(samples.tobytes())
+    return path
+
+
+@pytest.mark.parametrize('extension', ['png', 'tif'])
+def test_legacy_image_decoded(legacy_images, private_key, extension):
+    with Image.open(legacy_images[extension]) as img:
+        filename, filedata = extract_file_chunks_from_img_util(img, private_key)
+        assert (filename, b''.join(filedata)) == (FILENAME, SECRET)
+
+
+def test_legacy_image_memory_mapped(legacy_images, private_key):
+    path = legacy_images['tif']
+    with Image.open(path) as img:
+        assert map_pixels(img, path) is not None
+        filename, filedata = extract_file_chunks_from_img_util(img, private_key, path)
+        assert (filename, b''.join(filedata)) == (FILENAME, SECRET)
+
+
+@pytest.mark.parametrize('extension', ['png', 'tif'])
+def test_legacy_image_file(legacy_images, key_files, tmp_path, extension):
+    output_path = str(tmp_path / FILENAME)
+    extract_file_from_img(legacy_images[extension], output_path, key_files[1], PASSPHRASE, overwrite=True)
+    with open(output_path, 'rb') as f:
+        assert f.read() == SECRET
+
+
+@pytest.mark.parametrize('extension', ['png', 'tif'])
+def test_legacy_image_strips_are_refused(legacy_images, private_key, extension):
+    # The full shuffle of a legacy carrier doesn't fit in bounded memory
+    with pytest.raises(NoFrameHeader):
+        extract_file_chunks_from_img_stream(legacy_images[extension], private_key)
+
+
+@pytest.mark.parametrize('stream', ['', 'true'])
+@pytest.mark.parametrize('extension', ['png', 'tif'])
+def test_legacy_image_endpoint(legacy_images, keys, extension, stream):
+    with open(legacy_images[extension], 'rb') as f:
+        response = app_module.app.test_client().post('/imageextract', data={
+            'output': '',
+            'passphrase': PASSPHRASE,
+            'stream': stream,
+            'priKey': (io.BytesIO(keys[1]), 'private.pem'),
+            'image': (f, f'legacy.{extension}'),
+        })
+    assert response.status_code == 200
+    assert response.headers['Content-Disposition'] == f'attachment; filename={FILENAME}'
+    assert response.data == SECRET
+
+
+def test_legacy_audio_decoded(legacy_audio, private_key):
+    with wave.open(legacy_audio, 'rb') as audio:
+        filename, filedata = extract_file_chunks_from_audio_util(audio, private_key)
+        assert (filename, b''.join(filedata)) == (FILENAME, SECRET)
+
+
+def test_legacy_audio_stream(legacy_audio, private_key):
+    with wave.open(legacy_audio, 'rb') as audio:
+        filename, filedata = extract_file_chunks_from_audio_stream(audio, private_key, block_frames=1000)
+        assert (filename, b''.join(filedata)) == (FILENAME, SECRET)
+
+
+def test_legacy_audio_memory_mapped(legacy_audio, private_key):
+    filename, filedata = extract_file_chunks_from_audio_mmap(legacy_audio, private_key)
+    assert (filename, b''.join(filedata)) == (FILENAME, SECRET)
+
+
+@pytest.mark.parametrize('options', [{}, {'stream': True}, {'mmap': True}])
+def test_legacy_audio_file(legacy_audio, key_files, tmp_path, options):
+    output_path = str(tmp_path / FILENAME)
+    extract_file_from_audio(legacy_audio, output_path, key_files[1], PASSPHRASE, overwrite=True, **options)
+    with open(output_path, 'rb') as f:
+        assert f.read() == SECRET
+
+
+@pytest.mark.parametrize('stream', ['', 'true'])
+def test_legacy_audio_endpoint(legacy_audio, keys, stream):
+    with open(legacy_audio, 'rb') as f:
+        response = app_module.app.test_client().post('/audioextract', data={
+            'output': '',
+            'passphrase': PASSPHRASE,
+            'stream': stream,
+            'priKey': (io.BytesIO(keys[1]), 'private.pem'),
+            'audio': (f, 'legacy.wav'),
+        })
+    assert response.status_code == 200
+    assert response.data == SECRET